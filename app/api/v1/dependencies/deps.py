@@ -1,13 +1,19 @@
 from app.db.database import SessionLocal  # Import SessionLocal from the appropriate module
-from fastapi import Depends, HTTPException, status
+import asyncio
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 from app.core.config import settings
 from app.db import crud
+from app.services.model_loader import ModelNotReady, model_loader
+from app.services.LLM_handling.generation_control import GenerationControl, cancel_generation
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Status of the response to a client that closed the connection, never received (nginx's convention)
+CLIENT_CLOSED_REQUEST = 499
+
 """
 get_db(): is a function called to get a session to the DB everytime we get a request through our APIs that needs
 to talk to the database, so we can call as much as we want, and after that close the session.
@@ -67,4 +73,68 @@ async def get_current_user(db: Session = Depends(get_db), token: str = Depends(o
         raise credentials_exception
     
     print(f"user at the end of get_current_user = {user}")
-    return user
\ No newline at end of file
+    return user
+
+
+def _model_not_ready(e: ModelNotReady) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e),
+                         headers={"Retry-After": str(e.retry_after)})
+
+
+def get_llm_model():
+    """
+    Get the loaded LLM for the routes that generate answers.
+
+    Models load in the background after startup (see model_loader.py), so this is a dependency
+    rather than a global set at startup.
+
+    Returns:
+        LLM: The loaded model (or the LLM replica pool).
+
+    Raises:
+        HTTPException: While the LLM or the embedding model is still loading, or if one of them failed to load,
+                       a 503 status code is returned with a Retry-After header.
+    """
+    try:
+        return model_loader.get_llm()
+    except ModelNotReady as e:
+        raise _model_not_ready(e)
+
+
+def require_embeddings():
+    """
+    Let a request through only once the embedding model is loaded, for the routes that search without the LLM.
+
+    Raises:
+        HTTPException: While the embedding model is still loading, or if it failed to load, a 503 status code
+                       is returned with a Retry-After header.
+    """
+    try:
+        model_loader.require("embeddings")
+    except ModelNotReady as e:
+        raise _model_not_ready(e)
+
+
+async def _wait_for_disconnect(request: Request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(settings.QUERY_DISCONNECT_POLL_SECONDS)
+
+
+async def await_generation(request: Request, control: GenerationControl, generation: asyncio.Future):
+    """
+    Await the generation of a non-streamed answer, checking every QUERY_DISCONNECT_POLL_SECONDS whether the
+    client went away, and cancelling the generation if so.
+
+    Raises:
+        HTTPException: 499 if the client disconnected first, nobody receives it.
+    """
+    disconnect = asyncio.create_task(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait([generation, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        if not generation.done():
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="The client closed the request.")
+        return generation.result()
+    finally:
+        disconnect.cancel()
+        if not generation.done():
+            cancel_generation(control, generation)
@@ -0,0 +1,156 @@
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
+import asyncio
+from sqlalchemy.orm import Session
+from app.core.config import settings
+from app.db import schemas, crud
+from app.db.database import SessionLocal
+from app.services.LLM_handling.inference_executor import inference_executor, InferenceQueueFull
+from app.services.LLM_handling.generation_control import FINISH_DEADLINE, request_control
+from app.api.v1.dependencies.deps import await_generation, get_db, get_current_user, get_llm_model
+
+chat_router = APIRouter(prefix="/chat", tags=["Chat"])
+
+# Sessions whose summary is being updated, so a turn saved meanwhile doesn't queue the same update again
+_summarizing_sessions = set()
+
+
+async def _get_user_chat_session(db: Session, session_id: str, user_id: int):
+    chat_session = await crud.get_chat_session(db, session_id)
+    if chat_session is None or chat_session.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return chat_session
+
+
+async def _update_chat_summary(llm_model, session_id: str):
+    """
+    Fold the oldest turns of a chat session window into its summary, once the answer that filled the window
+    was sent. The summary is generated as a job of its own on the inference executor: if the queue is full,
+    the next turn of the session tries again.
+    """
+    from app.services.LLM_handling.chat_memory import summarize, turns_to_fold
+    try:
+        # Don't hold a database connection while the summary is generated.
+        db = SessionLocal()
+        try:
+            chat_session = await crud.get_chat_session(db, session_id)
+            folded_count = turns_to_fold(chat_session.recent_turns) if chat_session is not None else 0
+            if not folded_count:
+                return
+            previous_summary = chat_session.summary
+            folded = chat_session.recent_turns[:folded_count]
+        finally:
+            db.close()
+        try:
+            summary = await inference_executor.submit(summarize, llm_model, previous_summary, folded)
+        except InferenceQueueFull:
+            print(f"Inference queue full, the summary of chat session {session_id} is updated at its next turn")
+            return
+        except Exception as e:
+            print(f"Updating the summary of chat session {session_id} failed: {e}")
+            return
+        db = SessionLocal()
+        try:
+            await crud.fold_chat_summary(db, session_id, previous_summary, folded_count, summary)
+        finally:
+            db.close()
+    finally:
+        _summarizing_sessions.discard(session_id)
+
+
+@chat_router.post("", response_model=schemas.ChatSession, status_code=status.HTTP_201_CREATED)
+async def create_chat_session(db: Session = Depends(get_db),
+                              current_user: schemas.User = Depends(get_current_user)):
+    """
+    Endpoint to start a chat session about the user's files.
+
+    Args:
+        db (Session): Database session dependency.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        schemas.ChatSession: The new session, its id is used to send messages to it.
+    """
+    return await crud.create_chat_session(db, current_user.id)
+
+
+@chat_router.get("/{session_id}", response_model=schemas.ChatSession)
+async def get_chat_session(session_id: str,
+                           db: Session = Depends(get_db),
+                           current_user: schemas.User = Depends(get_current_user)):
+    """
+    Endpoint to get the memory of a chat session: the summary of its older turns and its recent turns.
+
+    Raises:
+        HTTPException: If the session doesn't exist or belongs to another user, a 404 status code is returned.
+    """
+    return await _get_user_chat_session(db, session_id, current_user.id)
+
+
+@chat_router.post("/{session_id}", response_model=schemas.ChatAnswer)
+async def chat(session_id: str,
+               message: schemas.UserQuery,
+               request: Request,
+               background_tasks: BackgroundTasks,
+               db: Session = Depends(get_db),
+               current_user: schemas.User = Depends(get_current_user),
+               llm_model=Depends(get_llm_model)):
+    """
+    Endpoint to send a message to a chat session and get its answer from the user's files.
+
+    The prompt holds the summary of the older turns of the session and its most recent turns (see
+    chat_memory.py), so follow-up questions don't need to repeat earlier context, and the prompt stays the
+    same size however long the conversation gets. Answers have the same limits as with /query (max_tokens,
+    deadline with partial answers, cancellation on disconnect). A partial answer is remembered like a
+    complete one, a cancelled one is not remembered. When the turn fills the window, the summary is updated
+    after the response is sent, so the answer never waits for it.
+
+    Args:
+        session_id (str): The id returned when the session was created.
+        message (schemas.UserQuery): The user message and the limits of its answer.
+        request (Request): The request, to stop generating if the client disconnects.
+        background_tasks (BackgroundTasks): Runs the summary update after the response is sent.
+        db (Session): Database session dependency.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        schemas.ChatAnswer: The answer, its finish_reason and its turn number in the session.
+
+    Raises:
+        HTTPException: 404 if the session doesn't exist or belongs to another user, or if the user has no vector
+                       store yet, 409 if another message of the session was answered meanwhile, 503 with a
+                       Retry-After header if the inference queue is full or the models are loading, 504 if the
+                       deadline passed before the first token of the answer.
+    """
+    # Lazy imports: the ML libraries are loaded in the background with the models (see model_loader.py).
+    from app.services.LLM_handling import querying
+    from app.services.LLM_handling.chat_memory import answer_chat_turn, turns_to_fold
+    from app.services.LLM_handling.sharded_store import user_store_path
+    chat_session = await _get_user_chat_session(db, session_id, current_user.id)
+    control = request_control(message.max_tokens, message.timeout_seconds)
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+    db_faiss_path = user_store_path(user_folder, current_user.id)
+    if not await asyncio.to_thread(querying.vector_store_exists, db_faiss_path):
+        raise HTTPException(status_code=404, detail="No vector store found, upload a file first.")
+    qa_result = await asyncio.to_thread(querying.qa_bot, db_faiss_path, llm_model, owner_id=current_user.id)
+    try:
+        generation = inference_executor.submit(answer_chat_turn, qa_result, message.query, chat_session.summary,
+                                               chat_session.recent_turns, control)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The model is busy answering other questions, please retry later.",
+                            headers={"Retry-After": str(e.retry_after)})
+    result = await await_generation(request, control, generation)
+    if result["finish_reason"] == FINISH_DEADLINE and not result["result"]:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail="The deadline passed before the answer started, please retry later.")
+    turn = chat_session.turn_count
+    recent_turns = await crud.save_chat_turn(db, chat_session, message.query, result["result"],
+                                             result["finish_reason"], result["turn"])
+    if recent_turns is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Another message of this chat session was answered meanwhile, please resend it.")
+    if turns_to_fold(recent_turns) and session_id not in _summarizing_sessions:
+        _summarizing_sessions.add(session_id)
+        background_tasks.add_task(_update_chat_summary, llm_model, session_id)
+    return {"session_id": session_id, "turn": turn, "answer": result["result"],
+            "finish_reason": result["finish_reason"]}
@@ -1,18 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
 from fastapi.responses import JSONResponse
 from pathlib import Path
+import asyncio
 import shutil
+import os
 from app.db import schemas, crud
 from app.api.v1.dependencies.deps import get_current_user, get_db
 from typing import List, Annotated
 from sqlalchemy.orm import Session
 import mimetypes
 from app.core.config import settings
-from app.services.LLM_handling.embedding import create_vector_db
+from app.services.ingestion_queue import ingestion_queue
 
 files_router = APIRouter(prefix="", tags=["files"])
 
 
+def _save_upload(file: UploadFile, file_path: Path):
+    try:
+        with file_path.open("wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
+    finally:
+        file.file.close()  # Close the file object to release resources
+
+
+async def _queue_ingestion(db: Session, db_file, user_id: int, user_folder: str):
+    # Lazy import: the vector store modules pull in FAISS, they are loaded in the background after startup.
+    from app.services.LLM_handling.sharded_store import user_store_path
+    # Index the file in the background, the client polls GET /jobs/{job_id} for the status
+    job = await crud.create_ingestion_job(db, file_id=db_file.id, user_id=user_id, file_path=db_file.file_path,
+                                          user_folder=user_folder, db_faiss_path=user_store_path(user_folder, user_id))
+    ingestion_queue.submit(job)
+    return job
+
+
+async def _remove_file_vectors(db: Session, db_file, user_id: int, user_folder: str):
+    """
+    Hide the vectors of a file from searches right away and compact the index in the background
+    once enough of it is deleted.
+
+    Files indexed before their vector ids were recorded have their vectors looked up in the store by file name.
+    """
+    from app.services.LLM_handling.querying import file_vector_ids
+    from app.services.LLM_handling.sharded_store import BACKEND_SHARDED, shard_vector_count, user_store_path
+    from app.services.LLM_handling.vector_store import add_tombstones
+    db_faiss_path = user_store_path(user_folder, user_id)
+    vector_ids = db_file.vector_ids
+    if vector_ids is None:
+        # Reading the store is blocking, keep it off the event loop.
+        vector_ids = await asyncio.to_thread(file_vector_ids, db_faiss_path, db_file.filename, user_id)
+    if not vector_ids:
+        return
+    tombstone_count = add_tombstones(db_faiss_path, vector_ids)
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+        # A shard holds the vectors of many users, the ratio is taken over all of them.
+        vector_count = shard_vector_count(db_faiss_path)
+    else:
+        live_count = sum(len(user_file.vector_ids or []) for user_file in await crud.get_user_files(db, user_id)
+                         if user_file.id != db_file.id)
+        vector_count = live_count + tombstone_count
+    if tombstone_count >= settings.VECTOR_STORE_COMPACTION_RATIO * vector_count:
+        ingestion_queue.submit_compaction(db_faiss_path)
+
+
+async def _get_owned_file(db: Session, file_id: int, user_id: int):
+    db_file = await crud.get_file(db, file_id)
+    if db_file is None or db_file.user_id != user_id:
+        raise HTTPException(status_code=404, detail="File not found.")
+    return db_file
+
+
 @files_router.post("/upload/{user_id}/")
 async def upload_file(user_id: str, 
                       file: UploadFile,
@@ -31,27 +89,79 @@ async def upload_file(user_id: str,
     file_path: Path = Path(user_folder + "\\" + file.filename)
     print(f"file_path = {file_path}")
     # Save the file to the user folder
-    try:
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
-    finally:
-        # Determine the file type
-        file_type, _ = mimetypes.guess_type(file.filename)
+    _save_upload(file, file_path)
+
+    # Determine the file type
+    file_type, _ = mimetypes.guess_type(file.filename)
 
-        # Create the file schema object
-        file_create = schemas.FileCreate(filename=file.filename, file_type=file_type, file_path=str(file_path))
+    # Create the file schema object
+    file_create = schemas.FileCreate(filename=file.filename, file_type=file_type, file_path=str(file_path))
 
+    # Uploading a file with the name of an existing one replaces it: its old vectors are removed and the
+    # new content is indexed incrementally.
+    db_file = await crud.get_user_file_by_name(db, int(user_id), file.filename)
+    if db_file is not None:
+        await _remove_file_vectors(db, db_file, int(user_id), user_folder)
+        db_file = await crud.update_file(db, db_file.id, file_create)
+    else:
         # Save the file information to the database
-        await crud.create_file(db, file_create, int(user_id))
-        file.file.close()  # Close the file object to release resources
+        db_file = await crud.create_file(db, file_create, int(user_id))
+
+    job = await _queue_ingestion(db, db_file, int(user_id), user_folder)
+
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                        content={"message": f"File '{file.filename}' uploaded successfully to user {user_id}.",
+                                 "job_id": job.id})
+
+
+@files_router.put("/files/{file_id}")
+async def replace_file(file_id: int,
+                       file: UploadFile,
+                       db: Session = Depends(get_db),
+                       current_user: schemas.User = Depends(get_current_user)):
+    """
+    Replace the content of an uploaded file.
+
+    The vectors of the old content stop showing up in searches right away, and the new content is
+    indexed in the background like a new upload (the response carries its `job_id`).
+    """
+    db_file = await _get_owned_file(db, file_id, current_user.id)
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+    file_path: Path = Path(user_folder + "\\" + file.filename)
+
+    _save_upload(file, file_path)
+    if db_file.file_path != str(file_path) and os.path.exists(db_file.file_path):
+        os.remove(db_file.file_path)
+
+    await _remove_file_vectors(db, db_file, current_user.id, user_folder)
+    file_type, _ = mimetypes.guess_type(file.filename)
+    file_update = schemas.FileCreate(filename=file.filename, file_type=file_type, file_path=str(file_path))
+    db_file = await crud.update_file(db, file_id, file_update)
+
+    job = await _queue_ingestion(db, db_file, current_user.id, user_folder)
+
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                        content={"message": f"File {file_id} replaced with '{file.filename}'.",
+                                 "job_id": job.id})
+
+
+@files_router.delete("/files/{file_id}")
+async def delete_file(file_id: int,
+                      db: Session = Depends(get_db),
+                      current_user: schemas.User = Depends(get_current_user)):
+    """
+    Delete an uploaded file and remove its vectors from the user's index without a full rebuild.
+    """
+    db_file = await _get_owned_file(db, file_id, current_user.id)
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
 
+    await _remove_file_vectors(db, db_file, current_user.id, user_folder)
+    # Remove it from disk too, so a full rebuild of the index doesn't bring it back.
+    if os.path.exists(db_file.file_path):
+        os.remove(db_file.file_path)
+    await crud.delete_file(db, file_id)
 
-        # Create the vector database
-        await create_vector_db(user_folder, user_folder + "\\vector_store\\db_faiss")
-        
-    return JSONResponse(content={"message": f"File '{file.filename}' uploaded successfully to user {user_id}."})
+    return {"message": f"File '{db_file.filename}' deleted."}
 
 
 @files_router.get("/files/{user_id}/", response_model=List[schemas.File])
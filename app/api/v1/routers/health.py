@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Response, status
+from app.services.model_loader import COMPONENT_READY, model_loader
+
+health_router = APIRouter(prefix="/health", tags=["Health"])
+
+
+@health_router.get("/live")
+async def liveness():
+    """
+    Endpoint for liveness probes: the server is up and accepts requests.
+
+    It doesn't depend on the models, so a long model load never gets the server restarted.
+
+    Returns:
+        dict: {"status": "alive"}.
+    """
+    return {"status": "alive"}
+
+
+@health_router.get("/ready")
+async def readiness(response: Response):
+    """
+    Endpoint for readiness probes: 200 once every model is loaded, 503 before that or if a model failed to load.
+
+    Returns:
+        dict: The overall "status" ("loading", "ready" or "failed"), the seconds spent loading, and the
+              status, load time and error of every component ("embeddings", "llm").
+    """
+    report = model_loader.stats()
+    if report["status"] != COMPONENT_READY:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return report
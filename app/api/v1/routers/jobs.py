@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from app.db import schemas, crud
+from app.api.v1.dependencies.deps import get_current_user, get_db
+
+jobs_router = APIRouter(prefix="", tags=["Jobs"])
+
+
+@jobs_router.get("/jobs/{job_id}", response_model=schemas.IngestionJob)
+async def get_job_status(job_id: str,
+                         db: Session = Depends(get_db),
+                         current_user: schemas.User = Depends(get_current_user)):
+    """
+    Endpoint to get the status and progress of a background ingestion job.
+
+    Args:
+        job_id (str): The job id returned by the upload endpoint.
+        db (Session): Database session dependency.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        schemas.IngestionJob: The job status (queued, running, succeeded or failed) and its progress.
+
+    Raises:
+        HTTPException: If the job doesn't exist or belongs to another user, a 404 status code is returned.
+    """
+    job = await crud.get_ingestion_job(db, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -0,0 +1,80 @@
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query
+from app.db import schemas
+from app.api.v1.dependencies.deps import get_current_user
+from app.core.config import settings
+from app.services.LLM_handling.vector_store_cache import vector_store_cache
+from app.services.LLM_handling.inference_executor import inference_executor
+from app.services.LLM_handling.generation_control import generation_stats
+from app.services.ingestion_queue import ingestion_queue
+from app.services.model_loader import model_loader
+
+metrics_router = APIRouter(prefix="", tags=["Metrics"])
+
+
+@metrics_router.get("/metrics")
+def get_metrics():
+    """
+    Endpoint to report runtime metrics of the loaded models and caches.
+
+    Returns:
+        dict: Load time and resident memory of every loaded embedding model,
+              the hit/miss/eviction counters of the vector store and query embedding caches,
+              the ingestion queue size, the LLM inference queue depth and wait times,
+              the load and utilisation of every LLM replica process,
+              the hit rate of the answer cache with the generation time it saved,
+              and the load status of the models.
+    """
+    # Lazy imports of modules that pull in the ML libraries. This is a sync endpoint, so if the models are
+    # still loading in the background, waiting for those imports doesn't block the event loop.
+    from app.services.LLM_handling.answer_cache import answer_cache
+    from app.services.LLM_handling.embedding_registry import embedding_registry
+    from app.services.LLM_handling.llm_pool import llm_replica_pool
+    from app.services.LLM_handling.query_embedding_cache import query_embedding_cache
+    from app.services.LLM_handling.remote_llm import remote_llm_client
+    return {
+        "models": model_loader.stats(),
+        "embedding_models": embedding_registry.stats(),
+        "vector_store_cache": vector_store_cache.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "ingestion_queue": ingestion_queue.stats(),
+        "inference": inference_executor.stats(),
+        "generation": generation_stats.stats(),
+        "llm_replicas": llm_replica_pool.stats(),
+        "remote_llm": remote_llm_client.stats(),
+        "answer_cache": answer_cache.stats(),
+    }
+
+
+@metrics_router.get("/metrics/vector-store")
+async def get_vector_store_report(k: int = Query(10, ge=1, le=100),
+                                  sample_size: int = Query(100, ge=1, le=1000),
+                                  current_user: schemas.User = Depends(get_current_user)):
+    """
+    Endpoint to report the recall@k and latency of the current user's vector index.
+
+    Args:
+        k (int): Number of neighbours compared with exact search.
+        sample_size (int): Number of stored chunks used as queries.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        dict: The index type and size of the store, the exact (flat) search latency, and the recall@k
+              and latency of the approximate index at several efSearch/nprobe values.
+
+    Raises:
+        HTTPException: If the user has no vector store of their own yet (or the sharded backend is used),
+                       a 404 status code is returned.
+    """
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+
+    def _report():
+        # Lazy imports: the vector store modules pull in FAISS, they are loaded in the background after startup.
+        from app.services.LLM_handling.querying import vector_store_report
+        from app.services.LLM_handling.sharded_store import user_store_path
+        return vector_store_report(user_store_path(user_folder, current_user.id), k, sample_size)
+
+    report = await asyncio.to_thread(_report)
+    if report is None:
+        raise HTTPException(status_code=404, detail="No vector store found, upload a file first.")
+    return report
@@ -1,25 +1,286 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
 import app
+import asyncio
+import json
 import os
+import time
+from typing import List, Optional
 from app.core.config import settings
 from app.db import schemas
-from app.services.LLM_handling import querying
+from app.services.LLM_handling.inference_executor import inference_executor, InferenceQueueFull
+from app.services.LLM_handling.generation_control import FINISH_DEADLINE, cancel_generation, request_control
 from sqlalchemy.orm import Session
-from app.api.v1.dependencies.deps import get_db, get_current_user
+from app.api.v1.dependencies.deps import (await_generation, get_db, get_current_user, get_llm_model,
+                                          require_embeddings)
 
 queries_router = APIRouter(prefix="", tags=["Queries"],)
 
+
 @queries_router.get("/query", response_model=schemas.LLMAnswer)
 async def answer_user_query(query: schemas.UserQuery,
+                            request: Request,
                             db: Session = Depends(get_db),
-                            current_user: schemas.User = Depends(get_current_user)):
+                            current_user: schemas.User = Depends(get_current_user),
+                            llm_model=Depends(get_llm_model)):
+    """
+    Endpoint to answer a user query against the user's files.
+
+    The answer has at most `query.max_tokens` tokens (QUERY_MAX_TOKENS by default and at most). Generation
+    stops when the client disconnects, and when `query.timeout_seconds` (QUERY_DEADLINE_SECONDS by default
+    and at most) have passed since the request arrived, waiting in the inference queue included. Past the
+    deadline the text generated so far is returned with finish_reason "deadline": a partial answer, cut
+    anywhere, even mid-sentence. Partial answers and answers with a custom max_tokens are never cached.
+
+    Args:
+        query (schemas.UserQuery): The user question and the limits of its answer.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        schemas.LLMAnswer: The answer and its finish_reason ("stop" or "deadline").
+
+    Raises:
+        HTTPException: 503 with a Retry-After header if the inference queue is full or the models are loading,
+                       504 if the deadline passed before the first token of the answer.
+    """
+    # Lazy imports: the ML libraries are loaded in the background with the models (see model_loader.py),
+    # the model dependency guarantees they are imported by now.
+    from app.services.LLM_handling import querying
+    from app.services.LLM_handling.answer_cache import answer_cache
+    from app.services.LLM_handling.sharded_store import user_store_path
     user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
-    db_faiss_path_for_current_user = user_folder + "\\vector_store\\db_faiss"
+    db_faiss_path_for_current_user = user_store_path(user_folder, current_user.id)
     print(f"db_faiss_path_for_current_user = {db_faiss_path_for_current_user}")
-    # This is called lazy import to avoid circular import issue between this file "queries.py" and "main.py"
-    from app.main import llm_model
     print(f"llm_model = {llm_model}")
-    qa_result = querying.qa_bot(db_faiss_path_for_current_user, llm_model)
-    answer = qa_result.run(query.query)  
+    started_at = time.perf_counter()
+    control = request_control(query.max_tokens, query.timeout_seconds)
+    # A custom max_tokens may cut the answer, don't share it with questions asked without one.
+    use_cache = query.max_tokens is None
+    # Loading the store (on a cache miss) and the generation itself are blocking, keep them off the event loop.
+    embedding, store_version = await asyncio.to_thread(querying.answer_cache_key, db_faiss_path_for_current_user,
+                                                       query.query, current_user.id)
+    # A near-identical question asked since the user's files last changed is answered without the model.
+    answer = answer_cache.get(current_user.id, store_version, embedding) if use_cache else None
+    if answer is not None:
+        print(f"answer (cached) = {answer}")
+        return {"answer": answer}
+    qa_result = await asyncio.to_thread(querying.qa_bot, db_faiss_path_for_current_user, llm_model,
+                                        owner_id=current_user.id)
+    try:
+        generation = inference_executor.submit(qa_result.invoke, query.query, control)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The model is busy answering other questions, please retry later.",
+                            headers={"Retry-After": str(e.retry_after)})
+    result = await await_generation(request, control, generation)
+    answer = result["result"]
+    if result["finish_reason"] == FINISH_DEADLINE:
+        print(f"answer (partial, deadline passed) = {answer}")
+        if not answer:
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                                detail="The deadline passed before the answer started, please retry later.")
+        return {"answer": answer, "finish_reason": FINISH_DEADLINE}
+    if use_cache:
+        answer_cache.put(current_user.id, store_version, embedding, answer, time.perf_counter() - started_at)
     print(f"answer = {answer}")
-    return {"answer": answer}
\ No newline at end of file
+    return {"answer": answer, "finish_reason": result["finish_reason"]}
+
+
+@queries_router.get("/search", response_model=schemas.SearchResults, dependencies=[Depends(require_embeddings)])
+async def search_user_chunks(query: str = Query(..., min_length=1),
+                             k: int = Query(4, ge=1, le=100),
+                             score_threshold: Optional[float] = Query(None, ge=-1, le=1),
+                             file_name: Optional[List[str]] = Query(None),
+                             current_user: schemas.User = Depends(get_current_user)):
+    """
+    Endpoint to retrieve the chunks of the user's files that are most relevant to a query, without
+    generating an answer (the LLM is not used).
+
+    Args:
+        query (str): The text to search for.
+        k (int): Number of chunks to return at most.
+        score_threshold (float, optional): Only return chunks with at least this similarity score.
+        file_name (List[str], optional): Only search these files (repeat the parameter for several files).
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        schemas.SearchResults: The chunks, most similar first, with their similarity score
+                               (cosine similarity, between -1 and 1), file name and page.
+
+    Raises:
+        HTTPException: If the user has no vector store yet, a 404 status code is returned,
+                       and 503 while the embedding model is loading.
+    """
+    from app.services.LLM_handling import querying
+    from app.services.LLM_handling.sharded_store import user_store_path
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+    db_faiss_path: str = user_store_path(user_folder, current_user.id)
+    # Embedding the query and searching are blocking, keep them off the event loop.
+    results = await asyncio.to_thread(querying.search_chunks, db_faiss_path, query, k, score_threshold, file_name,
+                                      current_user.id)
+    if results is None:
+        raise HTTPException(status_code=404, detail="No vector store found, upload a file first.")
+    return {"results": results}
+
+
+@queries_router.post("/query/batch")
+async def answer_user_queries(batch: schemas.BatchQuery,
+                              current_user: schemas.User = Depends(get_current_user),
+                              llm_model=Depends(get_llm_model)):
+    """
+    Endpoint to answer many questions against the user's files in one request.
+
+    All questions are embedded and searched at once, then their answers are generated one model slot at
+    a time and streamed back as newline-delimited JSON as soon as each one is ready (not in request order):
+    `{"index", "query", "answer", "sources", "finish_reason"}`, or `{"index", "query", "error"}` if that question
+    failed. A failed question doesn't stop the others. If the client disconnects, the remaining questions are
+    dropped. Every answer has the default limits of /query, its deadline counted from when it was queued.
+
+    Args:
+        batch (schemas.BatchQuery): The questions, at most QUERY_BATCH_MAX_SIZE.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        StreamingResponse: An `application/x-ndjson` response with one line per question.
+
+    Raises:
+        HTTPException: 422 if the batch is empty or too large, 404 if the user has no vector store yet,
+                       503 while the models are loading.
+    """
+    from app.services.LLM_handling import querying
+    from app.services.LLM_handling.sharded_store import user_store_path
+    if not 1 <= len(batch.queries) <= settings.QUERY_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"A batch needs between 1 and {settings.QUERY_BATCH_MAX_SIZE} queries.")
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+    db_faiss_path: str = user_store_path(user_folder, current_user.id)
+    contexts = await asyncio.to_thread(querying.retrieve_batch, db_faiss_path, batch.queries,
+                                       owner_id=current_user.id)
+    if contexts is None:
+        raise HTTPException(status_code=404, detail="No vector store found, upload a file first.")
+
+    def _line(index: int, **data) -> str:
+        return json.dumps({"index": index, "query": batch.queries[index], **data}) + "\n"
+
+    async def _answer_stream():
+        # Only one generation per model slot is queued at a time, so a batch keeps the model busy without
+        # filling the shared wait queue and turning the interactive /query requests away with 503s.
+        pending = {}
+        controls = {}
+        next_index = 0
+        try:
+            while next_index < len(batch.queries) or pending:
+                while next_index < len(batch.queries) and len(pending) < inference_executor.max_concurrency:
+                    control = request_control()
+                    try:
+                        generation = inference_executor.submit(querying.answer_from_documents, llm_model,
+                                                               batch.queries[next_index], contexts[next_index],
+                                                               control)
+                    except InferenceQueueFull as e:
+                        if pending:
+                            break
+                        await asyncio.sleep(min(e.retry_after, 5))
+                        continue
+                    pending[generation] = next_index
+                    controls[generation] = control
+                    next_index += 1
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for generation in done:
+                    index = pending.pop(generation)
+                    controls.pop(generation)
+                    try:
+                        result = generation.result()
+                    except Exception as e:
+                        yield _line(index, error=str(e) or type(e).__name__)
+                        continue
+                    yield _line(index, answer=result["result"],
+                                sources=[doc.metadata for doc in result["source_documents"]],
+                                finish_reason=result["finish_reason"])
+        finally:
+            # Runs when the stream ends and when the client disconnects: drop the queued questions and stop
+            # the running generation at its next token.
+            for generation in pending:
+                cancel_generation(controls[generation], generation)
+
+    return StreamingResponse(_answer_stream(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache"})
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@queries_router.get("/query/stream")
+async def stream_user_query(query: schemas.UserQuery,
+                            current_user: schemas.User = Depends(get_current_user),
+                            llm_model=Depends(get_llm_model)):
+    """
+    Endpoint to answer a user query as a stream of server-sent events.
+
+    Every generated token is sent as a `token` event as soon as the model produces it, and the final
+    `sources` event carries the metadata of the retrieved chunks and the `finish_reason`. If the client
+    disconnects, generation stops at the next token so the model is free for the next request.
+
+    The answer has the same limits as with /query: past the deadline the stream ends with the tokens sent so
+    far and finish_reason "deadline".
+
+    Args:
+        query (schemas.UserQuery): The user question and the limits of its answer.
+        current_user (schemas.User): The current authenticated user.
+
+    Returns:
+        StreamingResponse: A `text/event-stream` response.
+
+    Raises:
+        HTTPException: 503 with a Retry-After header if the inference queue is full or the models are loading.
+    """
+    from app.services.LLM_handling import querying
+    from app.services.LLM_handling.sharded_store import user_store_path
+    user_folder: str = settings.BASE_DIR + "\\" + current_user.user_folder_name
+    db_faiss_path_for_current_user = user_store_path(user_folder, current_user.id)
+    qa_result = await asyncio.to_thread(querying.qa_bot, db_faiss_path_for_current_user, llm_model,
+                                        owner_id=current_user.id)
+
+    loop = asyncio.get_running_loop()
+    tokens: asyncio.Queue = asyncio.Queue()
+    end_of_stream = object()
+    control = request_control(query.max_tokens, query.timeout_seconds)
+
+    def _on_token(token: str):
+        loop.call_soon_threadsafe(tokens.put_nowait, token)
+
+    def _generate():
+        try:
+            return querying.stream_answer(qa_result, query.query, _on_token, control)
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, end_of_stream)
+
+    try:
+        generation = inference_executor.submit(_generate)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The model is busy answering other questions, please retry later.",
+                            headers={"Retry-After": str(e.retry_after)})
+
+    async def _event_stream():
+        try:
+            while True:
+                token = await tokens.get()
+                if token is end_of_stream:
+                    break
+                yield _sse_event("token", {"token": token})
+            try:
+                result = await generation
+            except Exception as e:
+                yield _sse_event("error", {"detail": str(e)})
+                return
+            sources = [doc.metadata for doc in result.get("source_documents", [])]
+            yield _sse_event("sources", {"sources": sources, "finish_reason": result["finish_reason"]})
+        finally:
+            # Runs when the stream ends and when the client disconnects (the response task is cancelled):
+            # drop the request if it is still queued, or stop generation at the next token.
+            if not generation.done():
+                cancel_generation(control, generation)
+
+    return StreamingResponse(_event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
@@ -12,6 +12,120 @@ class Settings(BaseSettings):
     ALGORITHM: str
     ACCESS_TOKEN_EXPIRE_MINUTES: str
     BASE_DIR: str
+    # Embedding model shared by ingestion and querying (loaded once at startup)
+    EMBEDDING_MODEL_NAME: str = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_DEVICE: str = "cpu"
+    # Memory budget of the in-process cache of loaded per-user vector stores (LRU eviction)
+    VECTOR_STORE_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    # Share of deleted (tombstoned) vectors in a user store that triggers a background compaction of the index
+    VECTOR_STORE_COMPACTION_RATIO: float = 0.2
+    # Index type of a user store: "auto" picks flat (exact) below VECTOR_INDEX_HNSW_MIN_VECTORS, HNSW below
+    # VECTOR_INDEX_IVF_MIN_VECTORS and IVF above, or force "flat", "hnsw" or "ivf". HNSW/IVF indexes are
+    # built in the background, EF_SEARCH and NPROBE trade recall for query latency.
+    VECTOR_INDEX_TYPE: str = "auto"
+    VECTOR_INDEX_HNSW_MIN_VECTORS: int = 50000
+    VECTOR_INDEX_IVF_MIN_VECTORS: int = 500000
+    VECTOR_INDEX_HNSW_M: int = 32
+    VECTOR_INDEX_HNSW_EF_CONSTRUCTION: int = 80
+    VECTOR_INDEX_HNSW_EF_SEARCH: int = 64
+    VECTOR_INDEX_IVF_NPROBE: int = 16
+    # Precision of the stored vectors: "float32", "float16" (half the size) or "int8" (a quarter). With
+    # reduced precision the best RESCORE_FACTOR * k candidates are re-ranked with exact float32 distances,
+    # which keeps the float32 vectors on disk too; set it to 1 to store the reduced vectors only.
+    VECTOR_STORE_PRECISION: str = "float32"
+    VECTOR_STORE_RESCORE_FACTOR: int = 4
+    # Vector store layout: "per_user" keeps a store in every user folder, "sharded" keeps all users in
+    # VECTOR_STORE_SHARDS shared stores under VECTOR_STORE_SHARDS_DIR (defaults to BASE_DIR/vector_shards),
+    # picked by a hash of the user id (changing the shard count needs a new migration). A shard merges its
+    # segments, one per ingested file, once it has more than VECTOR_STORE_SHARD_MAX_SEGMENTS.
+    VECTOR_STORE_BACKEND: str = "per_user"
+    VECTOR_STORE_SHARDS: int = 64
+    VECTOR_STORE_SHARDS_DIR: str = ""
+    VECTOR_STORE_SHARD_MAX_SEGMENTS: int = 16
+    # On-disk cache of chunk embeddings (defaults to BASE_DIR/embedding_cache) and its size limit
+    EMBEDDING_CACHE_DIR: str = ""
+    EMBEDDING_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+    # Number of worker processes indexing uploaded files in the background
+    INGESTION_WORKERS: int = 2
+    # Chunks embedded and added to the index at a time, this bounds the peak memory of an ingestion
+    INGESTION_BATCH_SIZE: int = 64
+    # PDF text extraction: size of the process pool per ingestion worker, PDFs smaller than
+    # PDF_PARSING_MIN_PAGES are extracted serially, and pages extracted by one pool task
+    PDF_PARSING_WORKERS: int = 4
+    PDF_PARSING_MIN_PAGES: int = 50
+    PDF_PARSING_PAGES_PER_TASK: int = 16
+    # Concurrent LLM generations and how many more requests may wait for a slot before getting a 503.
+    # A single CTransformers model can't run two generations at once, so keep LLM_MAX_CONCURRENCY at 1 for it.
+    LLM_MAX_CONCURRENCY: int = 1
+    LLM_MAX_QUEUE_SIZE: int = 8
+    # Context window of the local LLM in tokens (prompt plus generated answer)
+    LLM_CONTEXT_LENGTH: int = 4096
+    # GGUF file of the local LLM, or "stub" for a tiny fake model that needs no file (tests and benchmarks)
+    LLM_MODEL_PATH: str = "app/LLM/capybarahermes-2.5-mistral-7b.Q3_K_M.gguf"
+    # Pool of LLM worker processes, each with its own copy of the model: 0 keeps the single model in the API
+    # process. Every replica generates with LLM_REPLICA_THREADS threads (0 splits the CPU cores evenly between
+    # replicas) and, with LLM_REPLICA_PIN_CPUS, is pinned to cores of its own where the OS supports it.
+    # One generation runs per replica at a time, so LLM_REPLICAS replaces LLM_MAX_CONCURRENCY when set.
+    LLM_REPLICAS: int = 0
+    LLM_REPLICA_THREADS: int = 0
+    LLM_REPLICA_PIN_CPUS: bool = True
+    # Where answers are generated: "local" (the GGUF model above) or "remote", an OpenAI-compatible inference
+    # server (vLLM, llama.cpp server, OpenAI...) at REMOTE_LLM_BASE_URL, through its /completions endpoint,
+    # or /chat/completions with REMOTE_LLM_CHAT.
+    LLM_BACKEND: str = "local"
+    REMOTE_LLM_BASE_URL: str = "http://localhost:8001/v1"
+    REMOTE_LLM_API_KEY: str = ""
+    REMOTE_LLM_MODEL: str = "capybarahermes-2.5-mistral-7b"
+    REMOTE_LLM_CHAT: bool = False
+    # Tokenizer of the prompts sent to the server, to fit them in their token budgets: "server" (its /tokenize
+    # endpoint, served by the llama.cpp server and vLLM), the name or folder of the model's Hugging Face
+    # tokenizer, or "estimate" (4 characters per token, approximate). Context window of the served model in
+    # tokens, 0 if unknown.
+    REMOTE_LLM_TOKENIZER: str = "server"
+    REMOTE_LLM_CONTEXT_LENGTH: int = 4096
+    # Requests sent to the server at once (the size of the connection pool too, replaces LLM_MAX_CONCURRENCY
+    # with the remote backend), seconds to connect and to wait for the next piece of a streamed answer, and
+    # retries of connection errors, timeouts and 429/5xx responses after a random wait of up to
+    # REMOTE_LLM_RETRY_BACKOFF_SECONDS * 2^attempt, at most REMOTE_LLM_RETRY_MAX_BACKOFF_SECONDS.
+    REMOTE_LLM_MAX_CONCURRENCY: int = 8
+    REMOTE_LLM_CONNECT_TIMEOUT_SECONDS: float = 5
+    REMOTE_LLM_READ_TIMEOUT_SECONDS: float = 60
+    REMOTE_LLM_MAX_RETRIES: int = 3
+    REMOTE_LLM_RETRY_BACKOFF_SECONDS: float = 0.5
+    REMOTE_LLM_RETRY_MAX_BACKOFF_SECONDS: float = 8
+    # Prompt assembly: the PROMPT_MAX_CHUNKS most similar chunks go into the prompt as long as they fit in
+    # PROMPT_CONTEXT_TOKENS tokens (the last one is trimmed to fit). Chunks sharing at least
+    # PROMPT_DUPLICATE_SIMILARITY of their word 3-grams with a chunk already in the prompt are skipped.
+    PROMPT_MAX_CHUNKS: int = 2
+    PROMPT_CONTEXT_TOKENS: int = 512
+    PROMPT_DUPLICATE_SIMILARITY: float = 0.8
+    # Most questions accepted by one /query/batch request
+    QUERY_BATCH_MAX_SIZE: int = 256
+    # Most tokens an answer is generated with, the default and the upper bound of a request's max_tokens
+    QUERY_MAX_TOKENS: int = 1024
+    # Seconds an answer may take from the arrival of the request (queue wait included) before generation
+    # stops and the partial answer is returned, the default and upper bound of a request's timeout_seconds.
+    # 0 disables the deadline. While waiting for the answer, /query checks every
+    # QUERY_DISCONNECT_POLL_SECONDS whether the client went away and stops the generation if so.
+    QUERY_DEADLINE_SECONDS: float = 120
+    QUERY_DISCONNECT_POLL_SECONDS: float = 0.5
+    # Chat sessions memory: the last CHAT_WINDOW_TURNS turns (question and answer cut to CHAT_TURN_MAX_TOKENS
+    # tokens each) plus a summary of the older ones, at most CHAT_SUMMARY_MAX_TOKENS tokens, updated in the
+    # background once CHAT_SUMMARIZE_EVERY_TURNS turns have left the window. At most CHAT_HISTORY_TOKENS tokens
+    # of it go into a prompt, the oldest turns of the window are left out first.
+    CHAT_WINDOW_TURNS: int = 4
+    CHAT_TURN_MAX_TOKENS: int = 256
+    CHAT_SUMMARY_MAX_TOKENS: int = 256
+    CHAT_SUMMARIZE_EVERY_TURNS: int = 2
+    CHAT_HISTORY_TOKENS: int = 1024
+    # In-process LRU of query embeddings (by model and normalized query text), 0 disables it
+    QUERY_EMBEDDING_CACHE_MAX_ENTRIES: int = 10000
+    # In-process cache of /query answers: a question reuses the answer to a previous question of the same user
+    # whose embedding has at least ANSWER_CACHE_MIN_SIMILARITY cosine similarity. Answers expire after
+    # ANSWER_CACHE_TTL_SECONDS and with any change of the user's files; 0 entries disables the cache.
+    ANSWER_CACHE_MAX_ENTRIES: int = 10000
+    ANSWER_CACHE_TTL_SECONDS: float = 3600
+    ANSWER_CACHE_MIN_SIMILARITY: float = 0.95
     class Config:
         env_file = ".env"
 
@@ -4,6 +4,7 @@ from app.db.schemas import UserCreate, FileCreate, User, File
 from app.core import security
 from fastapi import HTTPException, status
 import uuid
+from datetime import datetime, timezone
 import os
 from pathlib import Path
 from app.core.config import settings  # Import settings from the configuration module
@@ -118,6 +119,9 @@ async def update_file(db: Session, file_id: int, file: FileCreate):
     if db_file:
         db_file.filename = file.filename
         db_file.file_type = file.file_type
+        db_file.file_path = file.file_path
+        # The old vectors are tombstoned by the caller, the ingestion of the new content records the new ones.
+        db_file.vector_ids = None
         db.commit()
         db.refresh(db_file)
         return db_file
@@ -127,5 +131,118 @@ async def update_file(db: Session, file_id: int, file: FileCreate):
 async def get_user_files(db: Session, user_id: int):
     return db.query(models.File).filter(models.File.user_id == user_id).all()
 
+
+async def get_user_file_by_name(db: Session, user_id: int, filename: str):
+    return db.query(models.File).filter(models.File.user_id == user_id, models.File.filename == filename) \
+        .order_by(models.File.id.desc()).first()
+
 async def get_user_folder_name(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first().user_folder_name
\ No newline at end of file
+    return db.query(models.User).filter(models.User.id == user_id).first().user_folder_name
+
+
+async def create_ingestion_job(db: Session, file_id: int, user_id: int, file_path: str,
+                               user_folder: str, db_faiss_path: str):
+    db_job = models.IngestionJob(id=str(uuid.uuid4()), file_id=file_id, user_id=user_id, file_path=file_path,
+                                 user_folder=user_folder, db_faiss_path=db_faiss_path, status="queued", progress=0.0)
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+
+async def get_ingestion_job(db: Session, job_id: str):
+    return db.query(models.IngestionJob).filter(models.IngestionJob.id == job_id).first()
+
+
+async def get_unfinished_ingestion_jobs(db: Session):
+    return db.query(models.IngestionJob).filter(models.IngestionJob.status.in_(["queued", "running"])) \
+        .order_by(models.IngestionJob.created_at).all()
+
+
+async def create_chat_session(db: Session, user_id: int):
+    db_session = models.ChatSession(id=str(uuid.uuid4()), user_id=user_id, summary="", recent_turns=[], turn_count=0)
+    db.add(db_session)
+    db.commit()
+    db.refresh(db_session)
+    return db_session
+
+
+async def get_chat_session(db: Session, session_id: str):
+    # Its whole memory is on the row: one primary key lookup, however long the conversation.
+    return db.query(models.ChatSession).filter(models.ChatSession.id == session_id).first()
+
+
+async def save_chat_turn(db: Session, chat_session: models.ChatSession, question: str, answer: str,
+                         finish_reason: str, turn: dict):
+    """
+    Save a turn of a chat session: its window of recent turns and the turn in the transcript, in one transaction.
+
+    Args:
+        db (Session): The database session to use for the operation.
+        chat_session (models.ChatSession): The session as it was loaded before answering.
+        question (str): The user message.
+        answer (str): The answer.
+        finish_reason (str): "stop", or "deadline" for a partial answer.
+        turn (dict): The turn to add to the window, {"question", "answer"} cut to CHAT_TURN_MAX_TOKENS.
+
+    Returns:
+        list: The updated window, or None if another turn of the session was saved since it was loaded
+              (nothing is saved then).
+    """
+    position = chat_session.turn_count
+    while True:
+        # Reload the memory: the summary may have been updated in the background while answering.
+        db.refresh(chat_session)
+        if chat_session.turn_count != position:
+            db.rollback()
+            return None
+        recent_turns = list(chat_session.recent_turns) + [turn]
+        # Only update the session if no other turn was saved, and no summary update committed since the reload.
+        updated = db.query(models.ChatSession) \
+            .filter(models.ChatSession.id == chat_session.id, models.ChatSession.turn_count == position,
+                    models.ChatSession.summary == chat_session.summary) \
+            .update({"recent_turns": recent_turns, "turn_count": position + 1,
+                     "updated_at": datetime.now(timezone.utc)}, synchronize_session=False)
+        if updated:
+            break
+        db.rollback()
+    db.add(models.ChatTurn(session_id=chat_session.id, position=position, question=question, answer=answer,
+                           finish_reason=finish_reason))
+    db.commit()
+    return recent_turns
+
+
+async def fold_chat_summary(db: Session, session_id: str, previous_summary: str, folded_count: int,
+                            summary: str) -> bool:
+    """
+    Replace the oldest turns of a chat session window with the updated summary of the session.
+
+    Turns saved while the summary was generated stay in the window.
+
+    Args:
+        db (Session): The database session to use for the operation.
+        session_id (str): The id of the chat session.
+        previous_summary (str): The summary the update was generated from.
+        folded_count (int): How many of the oldest turns of the window the update covers.
+        summary (str): The updated summary.
+
+    Returns:
+        bool: False if the session was deleted, or its summary updated by someone else, since the update was
+              started (nothing is saved then).
+    """
+    while True:
+        chat_session = await get_chat_session(db, session_id)
+        if chat_session is None or chat_session.summary != previous_summary:
+            db.rollback()
+            return False
+        turn_count = chat_session.turn_count
+        # Only update the session if no turn was saved since it was read, else read it again.
+        updated = db.query(models.ChatSession) \
+            .filter(models.ChatSession.id == session_id, models.ChatSession.turn_count == turn_count,
+                    models.ChatSession.summary == previous_summary) \
+            .update({"summary": summary, "recent_turns": list(chat_session.recent_turns)[folded_count:],
+                     "updated_at": datetime.now(timezone.utc)}, synchronize_session=False)
+        if updated:
+            db.commit()
+            return True
+        db.rollback()
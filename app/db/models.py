@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, JSON, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
@@ -29,3 +29,72 @@ class File(Base):
     file_path = Column(String)  # Path to the file on the server
     uploaded_at = Column(DateTime, default=datetime.now(timezone.utc))
     owner = relationship("User", back_populates="files")  # Relationship to the User table
+    vectors = relationship("FileVectors", uselist=False, lazy="joined", cascade="all, delete-orphan")
+
+    # Ids of the file's vectors in the user's FAISS store, set by ingestion. None if the file was indexed
+    # before they were recorded, or isn't indexed yet.
+    @property
+    def vector_ids(self):
+        return self.vectors.vector_ids if self.vectors is not None else None
+
+    @vector_ids.setter
+    def vector_ids(self, ids):
+        if ids is None:
+            self.vectors = None
+        elif self.vectors is not None:
+            self.vectors.vector_ids = ids
+        else:
+            self.vectors = FileVectors(vector_ids=ids)
+
+
+# Vector ids of a File, in a table of their own so that `create_all` adds it to existing databases
+class FileVectors(Base):
+    __tablename__ = 'file_vectors'
+
+    file_id = Column(Integer, ForeignKey('files.id', ondelete='CASCADE'), primary_key=True)
+    vector_ids = Column(JSON, nullable=False)
+
+
+# Ingestion Job Model (background indexing of an uploaded file into the user's vector store)
+class IngestionJob(Base):
+    __tablename__ = 'ingestion_jobs'
+
+    id = Column(String, primary_key=True, index=True)  # uuid4 returned to the client on upload
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    file_id = Column(Integer, ForeignKey('files.id', ondelete='SET NULL'), nullable=True)
+    file_path = Column(String)  # Path of the uploaded file to index
+    user_folder = Column(String)  # Folder holding all of the user's files (used for a full rebuild)
+    db_faiss_path = Column(String)  # Folder of the user's FAISS store
+    status = Column(String, default="queued", index=True)  # queued, running, succeeded or failed
+    progress = Column(Float, default=0.0)  # Between 0 and 1
+    error = Column(String, nullable=True)
+    embedding_cache_hit_ratio = Column(Float, nullable=True)  # Share of chunks whose embedding was already cached
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# Chat Session Model (a conversation about the user's files, answered by POST /chat/{session_id})
+class ChatSession(Base):
+    __tablename__ = 'chat_sessions'
+
+    id = Column(String, primary_key=True, index=True)  # uuid4 returned to the client on creation
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # The memory of the conversation is kept on this row, so a message loads it with one primary key lookup
+    summary = Column(Text, default="")  # Summary of the turns that left the window
+    recent_turns = Column(JSON, default=list)  # Last turns, oldest first: [{"question", "answer"}]
+    turn_count = Column(Integer, default=0)  # Turns so far, also checked to detect concurrent messages
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# Chat Turn Model (full transcript of a chat session, never read to answer)
+class ChatTurn(Base):
+    __tablename__ = 'chat_turns'
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String, ForeignKey('chat_sessions.id', ondelete='CASCADE'), index=True)
+    position = Column(Integer)  # 0-based number of the turn in its session
+    question = Column(Text)
+    answer = Column(Text)
+    finish_reason = Column(String)  # "stop", or "deadline" for a partial answer
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
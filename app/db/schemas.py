@@ -1,4 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
+from datetime import datetime
+from typing import List, Optional
 
 class User(BaseModel):
     username: str
@@ -52,6 +54,66 @@ class ResetTokenAndPassword(BaseModel):
     
 class UserQuery(BaseModel):
     query: str
+    # Most tokens of the answer, at most QUERY_MAX_TOKENS
+    max_tokens: Optional[int] = Field(None, ge=1)
+    # Seconds before generation stops and the answer so far is returned, at most QUERY_DEADLINE_SECONDS
+    timeout_seconds: Optional[float] = Field(None, gt=0)
     
 class LLMAnswer(BaseModel):
-    answer: str
\ No newline at end of file
+    answer: str
+    # "stop" for a complete answer (or one cut at max_tokens), "deadline" for a partial answer
+    finish_reason: str = "stop"
+
+
+class BatchQuery(BaseModel):
+    queries: List[str]
+
+
+class SearchResult(BaseModel):
+    content: str
+    score: float  # Similarity to the query, higher is more similar (cosine for normalized embeddings)
+    file_name: Optional[str] = None
+    page: Optional[int] = None  # 0-based, as recorded by the PDF loader
+
+
+class SearchResults(BaseModel):
+    results: List[SearchResult]
+
+
+class IngestionJob(BaseModel):
+    id: str
+    file_id: Optional[int] = None
+    status: str
+    progress: float
+    error: Optional[str] = None
+    embedding_cache_hit_ratio: Optional[float] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ChatTurn(BaseModel):
+    question: str
+    answer: str
+
+
+class ChatSession(BaseModel):
+    id: str
+    summary: str
+    recent_turns: List[ChatTurn]
+    turn_count: int
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ChatAnswer(BaseModel):
+    session_id: str
+    turn: int  # 0-based number of the turn in the session
+    answer: str
+    # "stop" for a complete answer (or one cut at max_tokens), "deadline" for a partial answer
+    finish_reason: str = "stop"
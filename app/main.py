@@ -2,17 +2,16 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.db.database import engine
 from app.db import models
-from app.api.v1.routers import auth, users, files, queries
-from app.services.LLM_handling.llm_loader import load_llm
+from app.api.v1.routers import auth, users, files, queries, chat, metrics, jobs, health
+from app.services.LLM_handling.inference_executor import inference_executor
+from app.services.ingestion_queue import ingestion_queue
+from app.services.model_loader import model_loader
 from contextlib import asynccontextmanager
-import gc
 
 #this line tells sqlalchemy to run the create statement to generate all of the tables in the beginning
 #This line won't be needed if we are going to use Alembic for tables creation and architecture changes over time.
 models.Base.metadata.create_all(bind=engine)
 
-llm_model = None
-
 # This is an instance of the FASTAPI class (which is our app which will be used to create all of our endpoints "APIs")
 app = FastAPI()
 
@@ -31,6 +30,10 @@ app.include_router(auth.auth_router)
 app.include_router(users.users_router)
 app.include_router(files.files_router)
 app.include_router(queries.queries_router)
+app.include_router(chat.chat_router)
+app.include_router(jobs.jobs_router)
+app.include_router(metrics.metrics_router)
+app.include_router(health.health_router)
 
 # Lifespan context manager
 @asynccontextmanager
@@ -38,40 +41,39 @@ async def lifespan(app: FastAPI):
     """
     Lifespan context manager for the FastAPI application.
     This context manager handles the initialization and cleanup processes
-    for the FastAPI application. It loads a Large Language Model (LLM) at 
-    the startup of the application and makes it available throughout the 
-    app's lifecycle. Additionally, it provides a place to include any 
-    necessary cleanup code when the application shuts down.
+    for the FastAPI application. It starts loading the embedding model and the
+    Large Language Model (LLM) in the background, so the server accepts requests
+    right away, and provides a place to include any necessary cleanup code when
+    the application shuts down.
     Args:
       app (FastAPI): The FastAPI application instance.
     Yields:
       None: Control is yielded back to the application after initialization.
     Initialization:
-      - Loads the LLM model and assigns it to `app.state.llm_model`.
-      - Prints a message indicating that the LLM model has been loaded.
+      - Starts the ingestion worker pool and resumes unfinished ingestion jobs.
+      - Starts loading the embedding model shared by ingestion and querying, then the LLM model
+        (or the pool of LLM worker processes when LLM_REPLICAS is set), on a background thread.
+        `/health/ready` reports when they are loaded, the query routes answer 503 until then.
     Cleanup:
       - Prints a message indicating that resources are being cleaned up.
+      - Stops the ingestion worker pool, the inference threads and the LLM replicas, and unloads the models.
       - (Optional) Add any additional cleanup code as needed.
     """
-    global llm_model
-    # Initialization: Load LLM model at app startup
-    llm_model = load_llm(local=True)
-    print("LLM model loaded")
+    # Initialization: Start the background ingestion workers (queued jobs survive a restart)
+    await ingestion_queue.start()
 
-    # Make the llm_model available throughout the app
-    app.state.llm_model = llm_model
+    # Initialization: Load the models in the background, routes get them through `model_loader`
+    model_loader.start()
+    app.state.model_loader = model_loader
 
     # Yield control back to the app
     yield
 
     # Cleanup code can go here if needed (e.g., closing connections)
     print("Cleaning up resources")
-    
-    if llm_model:
-        print("Unloading the LLM...")
-        del llm_model  # Dereference the LLM
-        gc.collect()  # Force garbage collection to free memory
-        print("LLM unloaded successfully")
+    ingestion_queue.shutdown()
+    inference_executor.shutdown()
+    model_loader.shutdown()
 
 
 # Use lifespan in the app
@@ -0,0 +1,175 @@
+import math
+import time
+import faiss
+import numpy as np
+from app.services.LLM_handling.quantization import PRECISION_FLOAT32, scalar_quantizer_type
+
+INDEX_FLAT = "flat"
+INDEX_HNSW = "hnsw"
+INDEX_IVF = "ivf"
+
+# Below this size an exact scan takes well under a millisecond, an approximate index can't pay off.
+MIN_APPROXIMATE_VECTORS = 1000
+
+
+def choose_index_type(count: int, hnsw_min_vectors: int, ivf_min_vectors: int, forced_type: str = "auto") -> str:
+    """
+    Pick the index type of a store from its size: exact flat search while a scan is cheap, HNSW for
+    medium corpora and IVF (smaller and faster to build than HNSW) for the largest ones.
+
+    Args:
+        count (int): Number of vectors in the store.
+        hnsw_min_vectors (int): Smallest store that gets an HNSW index.
+        ivf_min_vectors (int): Smallest store that gets an IVF index.
+        forced_type (str): "auto", or an index type to use whatever the size (tiny stores stay flat).
+
+    Returns:
+        str: INDEX_FLAT, INDEX_HNSW or INDEX_IVF.
+    """
+    if count < MIN_APPROXIMATE_VECTORS:
+        return INDEX_FLAT
+    if forced_type != "auto":
+        if forced_type not in (INDEX_FLAT, INDEX_HNSW, INDEX_IVF):
+            raise ValueError(f"Unknown index type {forced_type}")
+        return forced_type
+    if count >= ivf_min_vectors:
+        return INDEX_IVF
+    if count >= hnsw_min_vectors:
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def ivf_nlist(count: int) -> int:
+    return max(1, int(4 * math.sqrt(count)))
+
+
+def build_index(index_type: str, vectors: np.ndarray, metric: int, hnsw_m: int = 32,
+                hnsw_ef_construction: int = 80, precision: str = PRECISION_FLOAT32) -> faiss.Index:
+    """
+    Build an approximate index over the vectors of a store, rows keep the order of `vectors`.
+
+    Args:
+        index_type (str): INDEX_HNSW or INDEX_IVF.
+        vectors (np.ndarray): float32 vectors, shape (count, dim).
+        metric (int): faiss.METRIC_L2 or faiss.METRIC_INNER_PRODUCT, same as the store.
+        hnsw_m (int): Neighbours per HNSW node.
+        hnsw_ef_construction (int): HNSW build-time search depth.
+        precision (str): Precision of the vectors stored in the index (see quantization.py).
+
+    Returns:
+        faiss.Index: The trained and filled index.
+    """
+    count, dim = vectors.shape
+    if index_type == INDEX_HNSW:
+        if precision == PRECISION_FLOAT32:
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, metric)
+        else:
+            index = faiss.IndexHNSWSQ(dim, scalar_quantizer_type(precision), hnsw_m, metric)
+        index.hnsw.efConstruction = hnsw_ef_construction
+        training_size = min(count, 100000)
+    elif index_type == INDEX_IVF:
+        nlist = ivf_nlist(count)
+        quantizer = faiss.IndexFlatIP(dim) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(dim)
+        if precision == PRECISION_FLOAT32:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, scalar_quantizer_type(precision), metric)
+        # k-means wants ~40-256 points per centroid, more only slows training down.
+        training_size = min(count, 64 * nlist)
+    else:
+        raise ValueError(f"Unknown index type {index_type}")
+    if not index.is_trained:
+        sample = np.random.default_rng(0).choice(count, size=training_size, replace=False)
+        index.train(np.ascontiguousarray(vectors[np.sort(sample)], dtype=np.float32))
+    batch_size = 65536
+    for start in range(0, count, batch_size):
+        index.add(np.ascontiguousarray(vectors[start:start + batch_size]))
+    return index
+
+
+def set_search_params(index: faiss.Index, ef_search: int = None, nprobe: int = None):
+    """Set the query-time accuracy/speed knobs of an approximate index (efSearch for HNSW, nprobe for IVF)."""
+    if isinstance(index, faiss.IndexHNSW):
+        if ef_search is not None:
+            index.hnsw.efSearch = ef_search
+    else:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and nprobe is not None:
+            ivf.nprobe = nprobe
+
+
+def evaluate_recall(search, k: int, queries: np.ndarray, exact_rows: np.ndarray) -> dict:
+    """
+    Measure recall@k and latency of a search function against the exact neighbours.
+
+    Args:
+        search (Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]): Returns (scores, rows) like faiss.
+        k (int): Number of neighbours (at most the store size).
+        queries (np.ndarray): float32 query vectors, shape (n, dim).
+        exact_rows (np.ndarray): Exact top-k rows of every query.
+
+    Returns:
+        dict: "recall_at_k" and "latency_ms" (average per query, searched one query at a time like the API does).
+    """
+    hits = 0
+    started_at = time.perf_counter()
+    for query, exact in zip(queries, exact_rows):
+        _, rows = search(query[None, :], k)
+        hits += len(set(rows[0].tolist()) & set(exact.tolist()))
+    elapsed = time.perf_counter() - started_at
+    return {"recall_at_k": round(hits / (len(queries) * k), 4),
+            "latency_ms": round(1000 * elapsed / len(queries), 3)}
+
+
+def recall_latency_report(vectors: np.ndarray, ann: faiss.Index, index_type: str, metric: int, k: int = 10,
+                          sample_size: int = 100, ef_search_values=(16, 32, 64, 128, 256),
+                          nprobe_values=(1, 4, 8, 16, 32, 64), store_search=None) -> dict:
+    """
+    Recall@k and latency of a store's approximate index at several search settings, against exact flat search.
+
+    Stored vectors are used as queries, so no embedding model is needed.
+
+    Args:
+        vectors (np.ndarray): The store vectors, shape (count, dim).
+        ann (faiss.Index): The approximate index of the store, or None for a flat store.
+        index_type (str): The type of `ann`.
+        metric (int): faiss.METRIC_L2 or faiss.METRIC_INNER_PRODUCT.
+        k (int): Number of neighbours.
+        sample_size (int): Number of queries.
+        ef_search_values (Iterable[int]): efSearch values to try on an HNSW index.
+        nprobe_values (Iterable[int]): nprobe values to try on an IVF index.
+        store_search (Callable, optional): The search the store actually runs (configured index parameters,
+            precision and re-scoring), reported as "configured".
+
+    Returns:
+        dict: Store size and index type, the flat baseline, the configured search and one entry per search
+        setting of the approximate index.
+    """
+    count = len(vectors)
+    k = min(k, count)
+    report = {"vectors": count, "index_type": index_type, "k": k, "flat": None, "configured": None,
+              "approximate": []}
+    if count == 0:
+        return report
+    rows = np.random.default_rng(0).choice(count, size=min(count, sample_size), replace=False)
+    queries = np.ascontiguousarray(vectors[np.sort(rows)], dtype=np.float32)
+    _, exact_rows = faiss.knn(queries, vectors, k, metric=metric)
+
+    report["flat"] = evaluate_recall(lambda query, top_k: faiss.knn(query, vectors, top_k, metric=metric),
+                                     k, queries, exact_rows)
+    if store_search is not None:
+        report["configured"] = evaluate_recall(store_search, k, queries, exact_rows)
+    if ann is None:
+        return report
+
+    if index_type == INDEX_HNSW:
+        previous, parameter, values = ann.hnsw.efSearch, "ef_search", ef_search_values
+    else:
+        previous, parameter, values = faiss.extract_index_ivf(ann).nprobe, "nprobe", nprobe_values
+    try:
+        for value in values:
+            set_search_params(ann, **{parameter: value})
+            report["approximate"].append({parameter: value, **evaluate_recall(ann.search, k, queries, exact_rows)})
+    finally:
+        set_search_params(ann, **{parameter: previous})
+    return report
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from app.core.config import settings
+
+
+class _CachedAnswer:
+    __slots__ = ("user_id", "embedding", "answer", "created_at", "generation_seconds")
+
+    def __init__(self, user_id, embedding, answer, generation_seconds):
+        self.user_id = user_id
+        self.embedding = embedding
+        self.answer = answer
+        self.created_at = time.monotonic()
+        self.generation_seconds = generation_seconds
+
+
+class AnswerCache:
+    """
+    In-process cache of generated answers, looked up by the similarity of the question embeddings.
+
+    A question gets the cached answer of the most similar previous question of the same user if their
+    cosine similarity is at least `min_similarity`, so "what is the refund policy" and "refund policy?"
+    share one generation. Every user's entries belong to one version of their vector store (see
+    `index_version` of the stores): a lookup with another version drops them, so any upload, delete or
+    compaction invalidates the answers given before it.
+
+    Entries expire `ttl_seconds` after they were generated, and the least recently used ones are evicted
+    once there are more than `max_entries`. A `max_entries` of 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, min_similarity: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.min_similarity = min_similarity
+        self._entries = OrderedDict()  # entry -> None, least recently used first
+        self._users = {}  # user id -> (store version, list of entries)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._saved_seconds = 0.0
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, user_id, version, embedding):
+        """
+        Return the cached answer to the question most similar to `embedding`, or None.
+
+        Args:
+            user_id (int): Id of the user asking.
+            version (Hashable): Current version of the user's vector store.
+            embedding (List[float]): Embedding of the question.
+        """
+        if self.max_entries <= 0:
+            return None
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            user_version, entries = self._users.get(user_id, (version, []))
+            if user_version != version:
+                self.invalidations += len(entries)
+                self._remove(user_id, list(entries))
+                entries = []
+            expired = [entry for entry in entries if now - entry.created_at > self.ttl_seconds]
+            if expired:
+                self.expirations += len(expired)
+                self._remove(user_id, expired)
+                entries = self._users.get(user_id, (version, []))[1]
+            if entries:
+                similarities = np.stack([entry.embedding for entry in entries]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.min_similarity:
+                    entry = entries[best]
+                    self._entries.move_to_end(entry)
+                    self.hits += 1
+                    self._saved_seconds += entry.generation_seconds
+                    return entry.answer
+            self.misses += 1
+            return None
+
+    def put(self, user_id, version, embedding, answer: str, generation_seconds: float):
+        """
+        Cache an answer generated with version `version` of the user's store.
+
+        Args:
+            user_id (int): Id of the user who asked.
+            version (Hashable): Version of the user's vector store the answer was generated from.
+            embedding (List[float]): Embedding of the question.
+            answer (str): The generated answer.
+            generation_seconds (float): How long the answer took, reported as saved time on every hit.
+        """
+        if self.max_entries <= 0:
+            return
+        entry = _CachedAnswer(user_id, self._normalize(embedding), answer, generation_seconds)
+        with self._lock:
+            user_version, entries = self._users.get(user_id, (version, []))
+            if user_version != version:
+                # The store changed while the answer was being generated, it may already be stale.
+                return
+            entries.append(entry)
+            self._users[user_id] = (version, entries)
+            self._entries[entry] = None
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._users[evicted.user_id][1].remove(evicted)
+                if not self._users[evicted.user_id][1]:
+                    del self._users[evicted.user_id]
+                self.evictions += 1
+
+    def _remove(self, user_id, entries):
+        for entry in entries:
+            self._entries.pop(entry, None)
+        remaining = [entry for entry in self._users.get(user_id, (None, []))[1] if entry not in entries]
+        if remaining:
+            self._users[user_id] = (self._users[user_id][0], remaining)
+        else:
+            self._users.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "users": len(self._users),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "saved_generation_seconds": round(self._saved_seconds, 3),
+            }
+
+
+answer_cache = AnswerCache(max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+                           ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+                           min_similarity=settings.ANSWER_CACHE_MIN_SIMILARITY)
@@ -0,0 +1,105 @@
+from app.core.config import settings
+from app.services.LLM_handling.generation_control import GenerationControl
+from app.services.LLM_handling.prompt_builder import PromptTokenizer
+from app.services.LLM_handling.querying import QABot, get_prompt_builder
+
+# Prompt of the summary update, fed the previous summary and the turns leaving the window
+SUMMARY_PROMPT = """Summarize the conversation between a user and an assistant about the user's documents.
+Keep the facts, names and numbers the user may refer to later, in a few sentences.
+
+Summary so far: {summary}
+
+New messages:
+{turns}
+
+Updated summary:
+"""
+
+
+def _format_turns(turns) -> str:
+    return "".join(f"User: {turn['question']}\nAssistant: {turn['answer']}\n" for turn in turns)
+
+
+def render_history(tokenizer: PromptTokenizer, summary: str, turns, max_tokens: int) -> str:
+    """
+    The conversation block of a chat prompt: the summary of the older turns, then as many of the most
+    recent turns as fit in `max_tokens` (the oldest are left out first).
+
+    Args:
+        tokenizer (PromptTokenizer): Tokenizer of the loaded model.
+        summary (str): Summary of the turns that left the window, empty at first.
+        turns (List[dict]): The recent turns, oldest first, {"question", "answer"} each.
+        max_tokens (int): Most tokens of the block.
+
+    Returns:
+        str: The block, empty if the conversation hasn't started.
+    """
+    if not summary and not turns:
+        return ""
+    header = "Conversation so far:\n"
+    if summary:
+        header += f"Summary of the earlier messages: {summary}\n"
+    remaining = max_tokens - tokenizer.count(header)
+    kept = []
+    for turn in reversed(turns):
+        text = _format_turns([turn])
+        tokens = tokenizer.count(text)
+        if tokens > remaining:
+            break
+        kept.append(text)
+        remaining -= tokens
+    return header + "".join(reversed(kept)) + "\n"
+
+
+def turns_to_fold(turns) -> int:
+    """How many of the oldest turns of a session window are due to be folded into its summary, 0 if none."""
+    if len(turns) < settings.CHAT_WINDOW_TURNS + settings.CHAT_SUMMARIZE_EVERY_TURNS:
+        return 0
+    return len(turns) - settings.CHAT_WINDOW_TURNS
+
+
+def summarize(llm, summary: str, turns) -> str:
+    """
+    Fold turns into the summary of the conversation, at most CHAT_SUMMARY_MAX_TOKENS long.
+
+    This is a generation of its own, queued on the inference executor after the answer of the turn that
+    filled the window was saved, so the answer never waits for it. The summary prompt doesn't start with the
+    static prefix kept evaluated in the local model, so the next answer pays the prefill of that prefix again.
+    """
+    tokenizer = get_prompt_builder(llm, chat=True).tokenizer
+    prompt = SUMMARY_PROMPT.format(summary=summary or "(none)", turns=_format_turns(turns))
+    text = llm.invoke(prompt, max_new_tokens=settings.CHAT_SUMMARY_MAX_TOKENS).strip()
+    return tokenizer.truncate(text, settings.CHAT_SUMMARY_MAX_TOKENS)
+
+
+def answer_chat_turn(qa: QABot, question: str, summary: str, turns, control: GenerationControl) -> dict:
+    """
+    Answer the next message of a chat session.
+
+    The memory of a session is a rolling window of its last turns, each cut to CHAT_TURN_MAX_TOKENS, and a
+    summary of the older ones. Once CHAT_SUMMARIZE_EVERY_TURNS turns have piled up past the last
+    CHAT_WINDOW_TURNS, they are folded into the summary (see `summarize`), so the summary costs one generation
+    every CHAT_SUMMARIZE_EVERY_TURNS turns, and the prompt never grows past CHAT_HISTORY_TOKENS of
+    conversation however long the session gets.
+
+    This call blocks until generation is finished, so run it on the inference executor.
+
+    Args:
+        qa (QABot): Built by `qa_bot`.
+        question (str): The user message.
+        summary (str): The session summary.
+        turns (List[dict]): The session window, oldest first.
+        control (GenerationControl): Token limit, deadline and cancellation of the answer.
+
+    Returns:
+        dict: Same as `QABot.invoke`, plus the "turn" to add to the session window.
+
+    Raises:
+        GenerationCancelled: If `control` was cancelled before the answer was finished.
+    """
+    tokenizer = get_prompt_builder(qa.llm, chat=True).tokenizer
+    history = render_history(tokenizer, summary, turns, settings.CHAT_HISTORY_TOKENS)
+    result = qa.invoke(question, control=control, history=history)
+    result["turn"] = {"question": tokenizer.truncate(question, settings.CHAT_TURN_MAX_TOKENS),
+                      "answer": tokenizer.truncate(result["result"], settings.CHAT_TURN_MAX_TOKENS)}
+    return result
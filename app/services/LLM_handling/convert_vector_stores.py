@@ -0,0 +1,70 @@
+"""
+One-shot conversion of pickled FAISS user stores (index.faiss + index.pkl) to the memory-mapped format.
+
+Usage (from the repository root):
+    python -m app.services.LLM_handling.convert_vector_stores [--keep-legacy] [store folder ...]
+
+Without folders, every legacy store found under settings.BASE_DIR is converted. Stores keep their
+vector ids, so tombstones and the vector ids recorded on the `files` rows stay valid.
+"""
+import argparse
+import os
+import time
+from langchain_core.embeddings import Embeddings
+from app.services.LLM_handling.embedding import save_vector_db, vector_store_lock
+from app.services.LLM_handling.mapped_store import has_legacy_store, has_mapped_store
+from app.services.LLM_handling.vector_store import UserVectorStore
+
+
+class NoEmbeddings(Embeddings):
+    # Conversion copies the stored vectors, so the embedding model is never loaded.
+    def embed_documents(self, texts):
+        raise RuntimeError("Converting a vector store doesn't embed anything")
+
+    def embed_query(self, text):
+        raise RuntimeError("Converting a vector store doesn't embed anything")
+
+
+def find_legacy_stores(base_dir: str) -> list:
+    return sorted(folder for folder, _, _ in os.walk(base_dir) if has_legacy_store(folder))
+
+
+def convert_store(db_faiss_path: str, keep_legacy: bool = False) -> int:
+    """
+    Convert one store in place, holding the same lock as ingestion.
+
+    Returns:
+        int: The number of converted vectors (0 if the folder was already converted).
+    """
+    with vector_store_lock(db_faiss_path):
+        if has_mapped_store(db_faiss_path) or not has_legacy_store(db_faiss_path):
+            return 0
+        db = UserVectorStore.load_local(db_faiss_path, NoEmbeddings(), allow_dangerous_deserialization=True)
+        save_vector_db(db, db_faiss_path, remove_legacy=not keep_legacy)
+        return db.index.ntotal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folders", nargs="*", help="Store folders to convert (default: all under BASE_DIR)")
+    parser.add_argument("--keep-legacy", action="store_true", help="Keep index.faiss and index.pkl")
+    args = parser.parse_args()
+
+    if args.folders:
+        folders = args.folders
+    else:
+        from app.core.config import settings
+        folders = find_legacy_stores(settings.BASE_DIR)
+
+    for folder in folders:
+        started_at = time.perf_counter()
+        try:
+            count = convert_store(folder, keep_legacy=args.keep_legacy)
+        except Exception as e:
+            print(f"Failed to convert {folder}: {e}")
+            continue
+        print(f"Converted {folder}: {count} vectors in {time.perf_counter() - started_at:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
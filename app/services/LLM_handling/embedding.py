@@ -1,30 +1,333 @@
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter 
+import os
+import time
+import uuid
+from pathlib import Path
+from filelock import FileLock
+from pypdf import PdfReader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from app.core.config import settings
+from app.services.LLM_handling.embedding_registry import get_embeddings
+from app.services.LLM_handling.embedding_cache import CachedEmbeddings, get_embedding_cache
+from app.services.LLM_handling.pdf_parsing import iter_pdf_pages
+from app.services.LLM_handling.vector_store import (UserVectorStore, add_tombstones, apply_tombstones,
+                                                   forget_tombstones, read_tombstones)
+from app.services.LLM_handling.mapped_store import (attach_ann_index, distance_metric, has_legacy_store, has_mapped_store,
+                                                   load_store_for_update, read_manifest, read_vectors,
+                                                   save_store)
+from app.services.LLM_handling.ann_index import INDEX_FLAT, build_index, choose_index_type
+from app.services.LLM_handling.sharded_store import (iter_owner_records, load_shard_for_update, read_segments,
+                                                    write_segment)
 
-async def create_vector_db(data_path, db_faiss_path):
-    print(f"Creating vector database from {data_path} to {db_faiss_path}")
-    loader = DirectoryLoader(
-        data_path,
-        glob='*.pdf',
-        loader_cls=PyPDFLoader
-    )
-    
-    documents = loader.load()
-
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50
-    )
-    
+
+def _file_name(metadata: dict) -> str:
+    # Stores built before "file_name" was recorded only carry the full "source" path.
+    return metadata.get("file_name") or os.path.basename(metadata.get("source", ""))
+
+
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=500,
+    chunk_overlap=50
+)
+
+
+def _split_documents(documents):
     texts = text_splitter.split_documents(documents)
-    
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
-    )
-    
-    db = FAISS.from_documents(texts, embeddings)
-    
-    db.save_local(db_faiss_path)
\ No newline at end of file
+
+    # Record which source file every chunk (and therefore every vector) came from.
+    for text in texts:
+        text.metadata["file_name"] = _file_name(text.metadata)
+
+    return texts
+
+
+def _iter_pdf_pages(file_path):
+    # PyPDFLoader.lazy_load() still extracts every page up front, so pages are read one (range) at a time.
+    return iter_pdf_pages(file_path,
+                          max_workers=settings.PDF_PARSING_WORKERS,
+                          min_pages_for_parallel=settings.PDF_PARSING_MIN_PAGES,
+                          pages_per_task=settings.PDF_PARSING_PAGES_PER_TASK)
+
+
+def _iter_chunks(pages):
+    for page in pages:
+        yield from _split_documents([page])
+
+
+def _batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _index_pdfs(db, file_paths, embeddings, progress_callback=None):
+    """
+    Stream PDFs into a FAISS store: page -> chunks -> fixed-size embedding batch -> index add.
+
+    Only one page and one batch of chunks and embeddings are held in memory at a time, so peak memory is
+    bounded by `settings.INGESTION_BATCH_SIZE` instead of the size of the corpus.
+
+    Args:
+        db (FAISS): The store to add to, or None to create a new one from the first batch.
+        file_paths (List[str]): The PDFs to index.
+        embeddings (Embeddings): The embedding model.
+        progress_callback (Callable[[float], None], optional): Called after every batch with the share of pages done.
+
+    Returns:
+        Tuple[FAISS, dict]: The updated store (None if the PDFs contained no text at all), and the ids of the
+        new vectors by file name.
+    """
+    total_pages = sum(len(PdfReader(file_path).pages) for file_path in file_paths)
+    pages_done = 0
+    vector_ids = {}
+
+    def _pages():
+        nonlocal pages_done
+        for file_path in file_paths:
+            for page in _iter_pdf_pages(file_path):
+                yield page
+                pages_done += 1
+
+    for batch in _batched(_iter_chunks(_pages()), settings.INGESTION_BATCH_SIZE):
+        texts = [chunk.page_content for chunk in batch]
+        metadatas = [chunk.metadata for chunk in batch]
+        ids = [str(uuid.uuid4()) for _ in batch]
+        text_embeddings = list(zip(texts, embeddings.embed_documents(texts)))
+        if db is None:
+            db = UserVectorStore.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            db.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        for chunk, vector_id in zip(batch, ids):
+            vector_ids.setdefault(chunk.metadata["file_name"], []).append(vector_id)
+        if progress_callback and total_pages:
+            # Keep the last few percent for saving the index.
+            progress_callback(0.95 * pages_done / total_pages)
+    return db, vector_ids
+
+
+def _get_ingestion_embeddings() -> CachedEmbeddings:
+    # Chunks that were embedded before (re-uploads, mostly unchanged revisions) are read from the cache.
+    embeddings = get_embeddings()
+    return CachedEmbeddings(embeddings, get_embedding_cache(embeddings.model_name))
+
+
+def _ingestion_result(embeddings: CachedEmbeddings, vector_ids: dict) -> dict:
+    return {"embedding_cache_hits": embeddings.hits,
+            "embedding_cache_misses": embeddings.misses,
+            "embedding_cache_hit_ratio": embeddings.hit_ratio,
+            "vector_ids": vector_ids}
+
+
+def _precision_options() -> dict:
+    # Reduced-precision stores keep their float32 vectors only when candidates are re-scored with them.
+    return {"precision": settings.VECTOR_STORE_PRECISION, "keep_float32": settings.VECTOR_STORE_RESCORE_FACTOR > 1}
+
+
+def save_vector_db(db, db_faiss_path, remove_legacy: bool = True) -> int:
+    return save_store(db, db_faiss_path, remove_legacy=remove_legacy, **_precision_options())
+
+
+def vector_store_lock(db_faiss_path) -> FileLock:
+    # Ingestion runs in several worker processes, so writes to the same user store are serialized with a lock file.
+    return FileLock(str(db_faiss_path) + ".lock")
+
+
+def create_vector_db(data_path, db_faiss_path, progress_callback=None) -> dict:
+    print(f"Creating vector database from {data_path} to {db_faiss_path}")
+    file_paths = [str(file_path) for file_path in sorted(Path(data_path).glob('*.pdf'))]
+
+    embeddings = _get_ingestion_embeddings()
+
+    db, vector_ids = _index_pdfs(None, file_paths, embeddings, progress_callback)
+    if db is None:
+        print(f"No text found in the PDFs of {data_path}, nothing to index")
+        return _ingestion_result(embeddings, vector_ids)
+
+    save_vector_db(db, db_faiss_path)
+    # Every vector got a new id, so tombstones of the previous index don't match anything anymore.
+    forget_tombstones(db_faiss_path)
+    return _ingestion_result(embeddings, vector_ids)
+
+
+def _load_vector_db(db_faiss_path, embeddings):
+    """
+    Load an existing store from disk into memory, to update it. Stores still in the pickled FAISS format
+    are read too, the next save writes them in the memory-mapped format.
+
+    Returns:
+        UserVectorStore: The loaded store, or None if the index is missing or can't be read (e.g. a corrupt file).
+    """
+    try:
+        if has_mapped_store(db_faiss_path):
+            return load_store_for_update(db_faiss_path, embeddings)
+        if not has_legacy_store(db_faiss_path):
+            return None
+        return UserVectorStore.load_local(db_faiss_path, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"Failed to load vector database at {db_faiss_path}: {e}")
+        return None
+
+
+def add_file_to_vector_db(file_path, data_path, db_faiss_path, progress_callback=None) -> dict:
+    """
+    Add a single uploaded PDF to the user's vector store without re-embedding the rest of the corpus.
+
+    Only the new file is parsed, split and embedded, and its vectors are appended to the existing index.
+    If a file with the same name was indexed before, its old vectors are replaced. When the index is
+    missing or corrupt, the whole user folder is re-indexed with `create_vector_db` instead.
+
+    Args:
+        file_path (str): Path of the uploaded PDF.
+        data_path (str): The user folder holding all of the user's PDFs (used for a full rebuild).
+        db_faiss_path (str): Folder of the user's FAISS store.
+        progress_callback (Callable[[float], None], optional): Called with the progress between 0 and 1.
+
+    Returns:
+        dict: Embedding cache hits, misses and hit ratio of this ingestion, and the new vector ids by file name
+        ("vector_ids", covers every file of the user folder after a full rebuild).
+    """
+    print(f"Adding {file_path} to vector database at {db_faiss_path}")
+    with vector_store_lock(db_faiss_path):
+        embeddings = _get_ingestion_embeddings()
+        db = _load_vector_db(db_faiss_path, embeddings)
+        if db is None:
+            print(f"No usable vector database at {db_faiss_path}, rebuilding it from {data_path}")
+            return create_vector_db(data_path, db_faiss_path, progress_callback)
+
+        # The index is rewritten anyway, so drop the vectors of deleted files on the way.
+        handled_tombstones = apply_tombstones(db, db_faiss_path)
+
+        # Stores indexed before vector ids were recorded per file still need a lookup by file name.
+        file_name = os.path.basename(file_path)
+        stale_ids = [doc_id for doc_id, doc in db.docstore._dict.items() if _file_name(doc.metadata) == file_name]
+        if stale_ids:
+            db.delete(stale_ids)
+
+        db, vector_ids = _index_pdfs(db, [file_path], embeddings, progress_callback)
+
+        save_vector_db(db, db_faiss_path)
+        forget_tombstones(db_faiss_path, handled_tombstones)
+        return _ingestion_result(embeddings, vector_ids)
+
+
+def compact_vector_db(db_faiss_path) -> int:
+    """
+    Rewrite a user's store without the vectors of deleted files.
+
+    Args:
+        db_faiss_path (str): Folder of the user's FAISS store.
+
+    Returns:
+        int: The number of vectors left in the index.
+    """
+    print(f"Compacting vector database at {db_faiss_path}")
+    with vector_store_lock(db_faiss_path):
+        db = _load_vector_db(db_faiss_path, get_embeddings())
+        if db is None:
+            return 0
+        handled_tombstones = apply_tombstones(db, db_faiss_path)
+        save_vector_db(db, db_faiss_path)
+        forget_tombstones(db_faiss_path, handled_tombstones)
+        return db.index.ntotal
+
+
+def add_file_to_shard(file_path, owner_id: int, shard_folder, progress_callback=None) -> dict:
+    """
+    Add a single uploaded PDF to the shared shard of its owner (VECTOR_STORE_BACKEND = "sharded").
+
+    The vectors of the file are written as a new segment of the shard, and the vectors of an earlier
+    file with the same name are tombstoned. Once the shard has more than VECTOR_STORE_SHARD_MAX_SEGMENTS
+    segments, they are merged into one.
+
+    Args:
+        file_path (str): Path of the uploaded PDF.
+        owner_id (int): Id of the user who uploaded it.
+        shard_folder (str): Folder of the user's shard.
+        progress_callback (Callable[[float], None], optional): Called with the progress between 0 and 1.
+
+    Returns:
+        dict: Embedding cache hits, misses and hit ratio of this ingestion, and the new vector ids by file name.
+    """
+    print(f"Adding {file_path} of user {owner_id} to vector shard at {shard_folder}")
+    with vector_store_lock(shard_folder):
+        embeddings = _get_ingestion_embeddings()
+        file_name = os.path.basename(file_path)
+        stale_ids = [record["id"] for record in iter_owner_records(shard_folder, owner_id)
+                     if _file_name(record["metadata"]) == file_name]
+        if stale_ids:
+            add_tombstones(shard_folder, stale_ids)
+
+        db, vector_ids = _index_pdfs(None, [file_path], embeddings, progress_callback)
+        if db is not None:
+            write_segment(shard_folder, db, [owner_id] * db.index.ntotal, **_precision_options())
+        if len(read_segments(shard_folder)["segments"]) > settings.VECTOR_STORE_SHARD_MAX_SEGMENTS:
+            _compact_shard(shard_folder, embeddings)
+        return _ingestion_result(embeddings, vector_ids)
+
+
+def compact_shard(shard_folder) -> int:
+    """
+    Merge the segments of a shard into one, without the vectors of deleted files.
+
+    Args:
+        shard_folder (str): Folder of the shard.
+
+    Returns:
+        int: The number of vectors left in the shard.
+    """
+    print(f"Compacting vector shard at {shard_folder}")
+    with vector_store_lock(shard_folder):
+        return _compact_shard(shard_folder, get_embeddings())
+
+
+def _compact_shard(shard_folder, embeddings) -> int:
+    # The caller holds the shard lock.
+    tombstones = read_tombstones(shard_folder)
+    db, owner_ids, segments = load_shard_for_update(shard_folder, embeddings, drop_ids=tombstones)
+    if db is None:
+        return 0
+    write_segment(shard_folder, db, owner_ids, replaces=segments, **_precision_options())
+    forget_tombstones(shard_folder, tombstones)
+    return db.index.ntotal
+
+
+def rebuild_vector_index(db_faiss_path) -> str:
+    """
+    Build the approximate index that fits the size of a user's store (small stores stay flat).
+
+    The index is built from the files of the current generation, which never change, so the store lock
+    is only held to attach it. If an ingestion saved a newer generation meanwhile, the index is dropped
+    and the build queued after that ingestion takes over.
+
+    Args:
+        db_faiss_path (str): Folder of the user's store.
+
+    Returns:
+        str: The index type of the store.
+    """
+    if not has_mapped_store(db_faiss_path):
+        return INDEX_FLAT
+    manifest = read_manifest(db_faiss_path)
+    index_type = choose_index_type(manifest["count"], settings.VECTOR_INDEX_HNSW_MIN_VECTORS,
+                                   settings.VECTOR_INDEX_IVF_MIN_VECTORS, settings.VECTOR_INDEX_TYPE)
+    if index_type == INDEX_FLAT or manifest["files"].get("ann"):
+        return manifest["index_type"]
+
+    print(f"Building a {index_type} index of {manifest['count']} vectors for {db_faiss_path}")
+    started_at = time.perf_counter()
+    vectors = read_vectors(db_faiss_path, manifest)
+    index = build_index(index_type, vectors, distance_metric(manifest["distance_strategy"]),
+                        hnsw_m=settings.VECTOR_INDEX_HNSW_M,
+                        hnsw_ef_construction=settings.VECTOR_INDEX_HNSW_EF_CONSTRUCTION,
+                        precision=manifest.get("precision", "float32"))
+    with vector_store_lock(db_faiss_path):
+        attached = attach_ann_index(db_faiss_path, manifest["generation"], index_type, index)
+    if not attached:
+        print(f"{db_faiss_path} changed while its index was built, skipping it")
+        return INDEX_FLAT
+    print(f"Built the {index_type} index of {db_faiss_path} in {time.perf_counter() - started_at:.1f}s")
+    return index_type
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+from app.core.config import settings
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings of one embedding model, keyed by the SHA-256 of the chunk text.
+
+    Files in the cache directory:
+        vectors.f32: Append-only float32 vectors, one row per cached chunk.
+        index.log: Append-only "<sha256> <row>" lines mapping a chunk hash to its row in vectors.f32.
+        meta.json: Vector dimension and a generation counter that is bumped by every compaction.
+
+    The files are shared by all ingestion worker processes, so every read and write holds a lock file.
+    When the vectors go over `max_bytes`, the cache is rewritten with the most recently used entries only.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._index_path = os.path.join(directory, "index.log")
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._file_lock = FileLock(os.path.join(directory, "cache.lock"))
+        self._lock = threading.Lock()
+        self._rows = OrderedDict()  # chunk hash -> row in vectors.f32, least recently used first
+        self._dim = None
+        self._generation = None
+        self._index_position = 0  # How much of index.log this process has already read
+        self.evictions = 0
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self._meta_path):
+            return {"dim": None, "generation": 0}
+        with open(self._meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self._dim, "generation": self._generation}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _refresh(self):
+        # Pick up the entries other processes appended, or reload everything after another process compacted.
+        meta = self._read_meta()
+        if meta["generation"] != self._generation:
+            self._rows.clear()
+            self._index_position = 0
+            self._generation = meta["generation"]
+        self._dim = meta["dim"]
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, "rb") as f:
+            f.seek(self._index_position)
+            data = f.read()
+        # Ignore a trailing partial line left by a writer that crashed halfway.
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            key, row = line.split()
+            self._rows[key.decode()] = int(row)
+        self._index_position += end
+
+    def _open_vectors(self):
+        return np.memmap(self._vectors_path, dtype=np.float32, mode="r").reshape(-1, self._dim)
+
+    def get_many(self, keys) -> dict:
+        """
+        Look up cached vectors.
+
+        Args:
+            keys (Iterable[str]): Chunk hashes from `text_hash`.
+
+        Returns:
+            dict: Chunk hash -> float32 vector, for the keys that are in the cache.
+        """
+        with self._lock, self._file_lock:
+            self._refresh()
+            found = {key: self._rows[key] for key in keys if key in self._rows}
+            if not found:
+                return {}
+            for key in found:
+                self._rows.move_to_end(key)
+            vectors = self._open_vectors()
+            return {key: np.array(vectors[row]) for key, row in found.items()}
+
+    def put_many(self, items: dict):
+        """
+        Add vectors to the cache.
+
+        Args:
+            items (dict): Chunk hash -> vector.
+        """
+        with self._lock, self._file_lock:
+            self._refresh()
+            items = {key: vector for key, vector in items.items() if key not in self._rows}
+            if not items:
+                return
+            vectors = np.asarray(list(items.values()), dtype=np.float32)
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._write_meta()
+            row_bytes = self._dim * 4
+
+            mode = "r+b" if os.path.exists(self._vectors_path) else "wb"
+            with open(self._vectors_path, mode) as f:
+                # Drop a partial row left by a crashed writer so that rows stay aligned.
+                first_row = f.seek(0, os.SEEK_END) // row_bytes
+                f.seek(first_row * row_bytes)
+                f.write(vectors.tobytes())
+                f.truncate()
+
+            lines = "".join(f"{key} {first_row + i}\n" for i, key in enumerate(items))
+            with open(self._index_path, "ab") as f:
+                f.write(lines.encode())
+                self._index_position = f.tell()
+            for i, key in enumerate(items):
+                self._rows[key] = first_row + i
+
+            if len(self._rows) * row_bytes > self.max_bytes:
+                self._compact()
+
+    def _compact(self):
+        # Rewrite the cache with the most recently used entries that fit in 80% of the budget.
+        keep_count = int(self.max_bytes * 0.8) // (self._dim * 4)
+        keep = list(self._rows.items())[len(self._rows) - keep_count:] if keep_count else []
+        old_vectors = self._open_vectors()
+
+        tmp_vectors_path = self._vectors_path + ".tmp"
+        tmp_index_path = self._index_path + ".tmp"
+        with open(tmp_vectors_path, "wb") as vectors_file, open(tmp_index_path, "w") as index_file:
+            for new_row, (key, old_row) in enumerate(keep):
+                vectors_file.write(old_vectors[old_row].tobytes())
+                index_file.write(f"{key} {new_row}\n")
+        del old_vectors
+        os.replace(tmp_vectors_path, self._vectors_path)
+        os.replace(tmp_index_path, self._index_path)
+
+        self.evictions += len(self._rows) - len(keep)
+        self._rows = OrderedDict((key, new_row) for new_row, (key, _) in enumerate(keep))
+        self._index_position = os.path.getsize(self._index_path)
+        self._generation += 1
+        self._write_meta()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends the chunks missing from an `EmbeddingCache` to the model.
+
+    One instance is created per ingestion run, so `hits` and `misses` describe that run.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self._embeddings = embeddings
+        self._cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [text_hash(text) for text in texts]
+        vectors = self._cache.get_many(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing[key] = text
+        if missing:
+            new_vectors = self._embeddings.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), np.asarray(new_vectors, dtype=np.float32)))
+            self._cache.put_many(new_items)
+            vectors.update(new_items)
+
+        missed = sum(1 for key in keys if key in missing)
+        self.misses += missed
+        self.hits += len(keys) - missed
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self._embeddings.embed_query(text)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str) -> EmbeddingCache:
+    """Return this process's `EmbeddingCache` for a model, opening it on first use."""
+    with _caches_lock:
+        if model_name not in _caches:
+            cache_dir = settings.EMBEDDING_CACHE_DIR or os.path.join(settings.BASE_DIR, "embedding_cache")
+            _caches[model_name] = EmbeddingCache(os.path.join(cache_dir, model_name.replace("/", "__")),
+                                                 max_bytes=settings.EMBEDDING_CACHE_MAX_BYTES)
+        return _caches[model_name]
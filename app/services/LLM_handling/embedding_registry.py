@@ -0,0 +1,122 @@
+import gc
+import threading
+import time
+import psutil
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from app.core.config import settings
+from app.services.LLM_handling.query_embedding_cache import query_embedding_cache
+
+
+class SharedEmbeddings(Embeddings):
+    """
+    Thread-safe wrapper around a loaded embedding model.
+
+    HuggingFace fast tokenizers fail when they are used from several threads at once,
+    so every encode call on the shared model is serialized with a lock.
+    """
+
+    def __init__(self, model_name: str, embeddings: Embeddings):
+        self.model_name = model_name
+        self._embeddings = embeddings
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        # Queries are looked up in the query embedding LRU first, chunk embeddings are never cached here.
+        return query_embedding_cache.get(self.model_name, text, self._embed_queries)
+
+    def embed_queries(self, texts):
+        """Embed several queries, the ones missing from the query embedding LRU in a single forward pass."""
+        return query_embedding_cache.get_many(self.model_name, texts, self._embed_queries)
+
+    def _embed_queries(self, texts):
+        with self._lock:
+            if len(texts) == 1:
+                return [self._embeddings.embed_query(texts[0])]
+            # all-MiniLM-L6-v2 encodes queries and documents the same way, so a batch is one encode call.
+            return self._embeddings.embed_documents(texts)
+
+
+class EmbeddingRegistry:
+    """
+    Process-wide registry of embedding models.
+
+    Each model is loaded from disk once, warmed up with a dummy encode and then the same
+    `SharedEmbeddings` instance is handed to both the ingestion and the querying code paths.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def load(self, model_name: str = None) -> SharedEmbeddings:
+        """
+        Load an embedding model into the registry (no-op if it is already loaded).
+
+        Args:
+            model_name (str, optional): HuggingFace model name. Defaults to `settings.EMBEDDING_MODEL_NAME`.
+
+        Returns:
+            SharedEmbeddings: The shared, thread-safe model instance.
+        """
+        model_name = model_name or settings.EMBEDDING_MODEL_NAME
+        with self._lock:
+            if model_name in self._models:
+                return self._models[model_name]
+
+            process = psutil.Process()
+            rss_before = process.memory_info().rss
+            start = time.perf_counter()
+
+            embeddings = HuggingFaceEmbeddings(
+                model_name=model_name,
+                model_kwargs={'device': settings.EMBEDDING_DEVICE}
+            )
+            # Warm up with a dummy encode so the first real request doesn't pay for lazy initialization.
+            embeddings.embed_query("warm up")
+
+            load_seconds = time.perf_counter() - start
+            rss_after = process.memory_info().rss
+
+            self._models[model_name] = SharedEmbeddings(model_name, embeddings)
+            self._stats[model_name] = {
+                "load_seconds": round(load_seconds, 3),
+                "rss_bytes_after_load": rss_after,
+                "rss_bytes_delta": rss_after - rss_before,
+            }
+            print(f"Embedding model {model_name} loaded in {load_seconds:.2f}s "
+                  f"(+{(rss_after - rss_before) / 2**20:.1f} MiB RSS)")
+            return self._models[model_name]
+
+    def get(self, model_name: str = None) -> SharedEmbeddings:
+        """Return the shared instance of a model, loading it on first use."""
+        model_name = model_name or settings.EMBEDDING_MODEL_NAME
+        embeddings = self._models.get(model_name)
+        if embeddings is None:
+            embeddings = self.load(model_name)
+        return embeddings
+
+    def unload_all(self):
+        with self._lock:
+            self._models.clear()
+            self._stats.clear()
+        gc.collect()
+
+    def stats(self) -> dict:
+        """Load time and resident memory of every loaded model, plus the current process RSS."""
+        return {
+            "models": {name: dict(stats) for name, stats in self._stats.items()},
+            "process_rss_bytes": psutil.Process().memory_info().rss,
+        }
+
+
+embedding_registry = EmbeddingRegistry()
+
+
+def get_embeddings(model_name: str = None) -> SharedEmbeddings:
+    return embedding_registry.get(model_name)
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+from app.core.config import settings
+
+# Why a generation ended
+FINISH_STOP = "stop"  # The model ended its answer, or reached max_tokens
+FINISH_DEADLINE = "deadline"  # The server-side deadline passed, the answer is partial
+CANCEL_DISCONNECTED = "disconnected"  # The client went away, nobody gets the answer
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside the LLM token loop to stop a generation that went over its deadline, or that nobody
+    is waiting for anymore."""
+
+    def __init__(self, reason: str = CANCEL_DISCONNECTED):
+        super().__init__(f"Generation stopped: {reason}")
+        self.reason = reason
+
+
+class GenerationControl:
+    """
+    Limits of one answer's generation, shared by the request handler and the inference thread running it.
+
+    - `max_tokens`: passed to the model as its `max_new_tokens`.
+    - `deadline_seconds`: counted from the creation of the control (when the request arrived), so time spent
+      waiting in the inference queue counts too.
+    - `cancel()`: called by the handler when the client disconnects.
+
+    Both are checked when the generation starts and at every generated token: prompt evaluation (prefill)
+    is never interrupted, so a generation may end a prefill after its deadline.
+
+    Partial answers: past the deadline, generation stops and the text generated so far is the answer,
+    with finish reason FINISH_DEADLINE. A cancelled generation raises `GenerationCancelled` instead, since
+    there is nobody left to answer.
+    """
+
+    def __init__(self, max_tokens: int = None, deadline_seconds: float = None):
+        self.max_tokens = max_tokens
+        self.created_at = time.perf_counter()
+        self.deadline = self.created_at + deadline_seconds if deadline_seconds else None
+        self.cancel_event = threading.Event()
+        self.started_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.tokens = 0
+        self._chunks = []
+        # Set by GenerationStats, so a generation is counted once when both the handler and the thread end it
+        self.recorded = False
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        """
+        Raises:
+            GenerationCancelled: If the generation was cancelled or went over its deadline.
+        """
+        if self.cancel_event.is_set():
+            raise GenerationCancelled(CANCEL_DISCONNECTED)
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise GenerationCancelled(FINISH_DEADLINE)
+
+    def start(self):
+        """Called by the inference thread before retrieval and prompt evaluation."""
+        self.started_at = time.perf_counter()
+        self.check()
+
+    def on_token(self, token: str):
+        """Called with every generated piece of text, before handing it to the client."""
+        self.check()
+        self.last_token_at = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = self.last_token_at
+        self.tokens += 1
+        self._chunks.append(token)
+
+    def text(self) -> str:
+        """The text generated so far."""
+        return "".join(self._chunks)
+
+
+class GenerationStats:
+    """
+    Outcome of the generations: finished, stopped at their deadline, cancelled because the client went away,
+    or dropped from the inference queue before they started, and the generation time saved by stopping early.
+
+    The time a stopped generation would still have taken is estimated: the average length of the finished
+    answers (at most the generation's `max_tokens`), minus the tokens it had already generated, at its own
+    rate of tokens per second (the average rate of the finished answers before its second token). A
+    generation dropped before it started saves the average time of a finished one. Tokens are the pieces of
+    text handed to the callbacks, about one token each.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.finished = 0
+        self.deadline_stops = 0
+        self.cancelled = 0
+        self.dropped_before_start = 0
+        self.tokens_generated = 0
+        self._finished_tokens = 0
+        self._finished_seconds = 0.0
+        self._finished_token_seconds = 0.0
+        self.estimated_tokens_saved = 0.0
+        self.estimated_seconds_saved = 0.0
+
+    def record(self, control: GenerationControl, reason: str):
+        """Count the end of a generation once, `reason` is FINISH_STOP, FINISH_DEADLINE or CANCEL_DISCONNECTED."""
+        now = time.perf_counter()
+        with self._lock:
+            if control.recorded:
+                return
+            control.recorded = True
+            self.tokens_generated += control.tokens
+            if reason == FINISH_STOP:
+                self.finished += 1
+                self._finished_tokens += control.tokens
+                self._finished_seconds += now - (control.started_at or now)
+                if control.tokens > 1:
+                    self._finished_token_seconds += control.last_token_at - control.first_token_at
+                return
+
+            if reason == FINISH_DEADLINE:
+                self.deadline_stops += 1
+            else:
+                self.cancelled += 1
+            if control.started_at is None:
+                self.dropped_before_start += 1
+            if not self.finished:
+                return  # Nothing to estimate the rest of the answer from yet
+            if control.started_at is None:
+                self.estimated_tokens_saved += self._finished_tokens / self.finished
+                self.estimated_seconds_saved += self._finished_seconds / self.finished
+                return
+            expected_tokens = self._finished_tokens / self.finished
+            if control.max_tokens:
+                expected_tokens = min(expected_tokens, control.max_tokens)
+            remaining_tokens = max(expected_tokens - control.tokens, 0)
+            if control.tokens > 1:
+                seconds_per_token = (control.last_token_at - control.first_token_at) / (control.tokens - 1)
+            else:
+                seconds_per_token = self._average_seconds_per_token()
+            self.estimated_tokens_saved += remaining_tokens
+            self.estimated_seconds_saved += remaining_tokens * seconds_per_token
+
+    def _average_seconds_per_token(self) -> float:
+        intervals = self._finished_tokens - self.finished
+        return self._finished_token_seconds / intervals if intervals > 0 else 0.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "finished": self.finished,
+                "deadline_stops": self.deadline_stops,
+                "cancelled": self.cancelled,
+                "dropped_before_start": self.dropped_before_start,
+                "tokens_generated": self.tokens_generated,
+                "average_answer_tokens": round(self._finished_tokens / self.finished, 1) if self.finished else 0.0,
+                "average_answer_seconds": round(self._finished_seconds / self.finished, 3) if self.finished else 0.0,
+                "estimated_tokens_saved": round(self.estimated_tokens_saved),
+                "estimated_seconds_saved": round(self.estimated_seconds_saved, 3),
+            }
+
+
+generation_stats = GenerationStats()
+
+
+def request_control(max_tokens: int = None, timeout_seconds: float = None) -> GenerationControl:
+    """The limits of an answer's generation: the request's own, capped by the server's settings."""
+    max_tokens = min(max_tokens or settings.QUERY_MAX_TOKENS, settings.QUERY_MAX_TOKENS)
+    deadline_seconds = settings.QUERY_DEADLINE_SECONDS
+    if timeout_seconds:
+        deadline_seconds = min(timeout_seconds, deadline_seconds) if deadline_seconds else timeout_seconds
+    return GenerationControl(max_tokens=max_tokens, deadline_seconds=deadline_seconds or None)
+
+
+def cancel_generation(control: GenerationControl, generation: asyncio.Future):
+    """Drop a generation nobody waits for anymore from the inference queue, or stop it at its next token."""
+    control.cancel()
+    generation.cancel()
+    # A cancelled generation is never awaited, don't let asyncio complain about its exception.
+    generation.add_done_callback(lambda future: future.cancelled() or future.exception())
+    if control.started_at is None:
+        # Still queued, the inference thread will never see it
+        generation_stats.record(control, CANCEL_DISCONNECTED)
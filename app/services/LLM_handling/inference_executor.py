@@ -0,0 +1,123 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import settings
+from app.services.LLM_handling.remote_llm import LLM_BACKEND_REMOTE
+
+
+class InferenceQueueFull(Exception):
+    """Raised when every generation slot is busy and the wait queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Runs blocking LLM generations on dedicated threads so they never block the event loop.
+
+    At most `max_concurrency` generations run at once and at most `max_queue_size` more wait for a slot.
+    Any request beyond that fails fast with `InferenceQueueFull` instead of piling up.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue_size: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm-inference")
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._total_run_seconds = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        """
+        Queue `fn(*args, **kwargs)` on an inference thread.
+
+        Cancelling the returned future before the call has started drops it from the queue.
+
+        Returns:
+            asyncio.Future: Future resolved with the result of the call.
+
+        Raises:
+            InferenceQueueFull: If the wait queue is full.
+        """
+        with self._lock:
+            if self._running + self._waiting >= self.max_concurrency + self.max_queue_size:
+                self.rejected += 1
+                raise InferenceQueueFull(self._retry_after())
+            self._waiting += 1
+        submitted_at = time.perf_counter()
+
+        def _task():
+            started_at = time.perf_counter()
+            wait_seconds = started_at - submitted_at
+            with self._lock:
+                self._waiting -= 1
+                self._running += 1
+                self._total_wait_seconds += wait_seconds
+                self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.completed += 1
+                    self._total_run_seconds += time.perf_counter() - started_at
+
+        def _on_done(done_future):
+            # The request went away while it was still queued, so it never took a slot.
+            if done_future.cancelled():
+                with self._lock:
+                    self._waiting -= 1
+
+        future = self._executor.submit(_task)
+        future.add_done_callback(_on_done)
+        return asyncio.wrap_future(future)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` on an inference thread and await its result.
+
+        Raises:
+            InferenceQueueFull: If the wait queue is full.
+        """
+        return await self.submit(fn, *args, **kwargs)
+
+    def _retry_after(self) -> int:
+        # Seconds until the queue has likely drained, based on the average generation time so far.
+        average_run_seconds = self._total_run_seconds / self.completed if self.completed else 30.0
+        return max(1, math.ceil(average_run_seconds * (self._running + self._waiting) / self.max_concurrency))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self.completed + self._running
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue_size": self.max_queue_size,
+                "running": self._running,
+                "queue_depth": self._waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "average_wait_seconds": round(self._total_wait_seconds / started, 3) if started else 0.0,
+                "max_wait_seconds": round(self._max_wait_seconds, 3),
+                "average_run_seconds": round(self._total_run_seconds / self.completed, 3) if self.completed else 0.0,
+            }
+
+
+# With the LLM replica pool every replica runs one generation at a time. With the remote backend the
+# threads only wait for the inference server, as many as it is sent requests at once.
+if settings.LLM_BACKEND == LLM_BACKEND_REMOTE:
+    _max_concurrency = settings.REMOTE_LLM_MAX_CONCURRENCY
+else:
+    _max_concurrency = settings.LLM_REPLICAS or settings.LLM_MAX_CONCURRENCY
+inference_executor = InferenceExecutor(max_concurrency=_max_concurrency, max_queue_size=settings.LLM_MAX_QUEUE_SIZE)
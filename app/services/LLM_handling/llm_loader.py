@@ -1,26 +1,177 @@
+import re
+import time
+from typing import Any, List, Optional
 from langchain_community.llms import CTransformers
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from app.core.config import settings
+from app.services.LLM_handling.remote_llm import remote_llm_client
+from app.services.LLM_handling.stub_llm import STUB_MODEL, StubModel
 import gc
 
+
+class PrefixCachedCTransformers(CTransformers):
+    """
+    CTransformers model that keeps the evaluated KV cache of a static prompt prefix between requests.
+
+    The model only evaluates the tokens of a prompt after the longest token prefix it shares with what
+    is already in its context, so a prompt starting with the same instructions as the previous one only
+    pays prefill for its own context and question. To make that hold for every request:
+    - `static_prefix` is tokenized once and the rest of each prompt is tokenized on its own, so the
+      prefix tokens never change with what follows them,
+    - `warm_prefix` evaluates the prefix at startup, so the first request already reuses it.
+
+    One instance must only run one generation at a time (LLM_MAX_CONCURRENCY = 1).
+    """
+
+    static_prefix: str = ""
+    prefix_tokens: Optional[List[int]] = None
+    # Tokens of the last prompt that were evaluated, and reused from the previous context.
+    last_prefill_tokens: int = 0
+    last_reused_tokens: int = 0
+
+    def prompt_tokens(self, prompt: str) -> List[int]:
+        if not self.static_prefix or not prompt.startswith(self.static_prefix):
+            return self.client.tokenize(prompt)
+        if self.prefix_tokens is None:
+            self.prefix_tokens = self.client.tokenize(self.static_prefix)
+        return self.prefix_tokens + self.client.tokenize(prompt[len(self.static_prefix):], add_bos_token=False)
+
+    def warm_prefix(self):
+        """Evaluate the static prefix into the model context, ahead of the first request."""
+        if not self.static_prefix:
+            return
+        started_at = time.perf_counter()
+        tokens = self.client.prepare_inputs_for_generation(self.prompt_tokens(self.static_prefix), reset=True)
+        self.client.eval(tokens)
+        print(f"Evaluated the {len(self.prefix_tokens)} tokens of the static prompt prefix "
+              f"in {time.perf_counter() - started_at:.2f}s")
+
+    def _call(self, prompt: str, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None,
+              max_new_tokens: Optional[int] = None, **kwargs) -> str:
+        # Same generation loop as ctransformers' LLM._stream, except that it starts from prompt_tokens().
+        from ctransformers.utils import utf8_split_incomplete
+
+        client = self.client
+        run_manager = run_manager or CallbackManagerForLLMRun.get_noop_manager()
+        max_new_tokens = max_new_tokens or client.config.max_new_tokens
+        stop = stop or client.config.stop or []
+        if isinstance(stop, str):
+            stop = [stop]
+        stop_regex = re.compile("|".join(map(re.escape, stop)))
+
+        tokens = self.prompt_tokens(prompt)
+        # Drops the tokens already in the context (at least the static prefix) from what is evaluated.
+        new_tokens = client.prepare_inputs_for_generation(tokens, reset=True)
+        self.last_prefill_tokens = len(new_tokens)
+        self.last_reused_tokens = len(tokens) - len(new_tokens)
+
+        chunks, text, incomplete = [], "", b""
+        for count, token in enumerate(client.generate(new_tokens, reset=False), start=1):
+            incomplete += client.detokenize([token], decode=False)
+            complete, incomplete = utf8_split_incomplete(incomplete)
+            text += complete.decode(errors="ignore")
+            if stop:
+                match = stop_regex.search(text)
+                if match:
+                    text = text[:match.start()]
+                    break
+            # Hold back the end of the text while it may still become a stop sequence.
+            longest = 0
+            for sequence in stop:
+                for i in range(len(sequence), 0, -1):
+                    if text.endswith(sequence[:i]):
+                        longest = max(i, longest)
+                        break
+            end = len(text) - longest
+            if end > 0:
+                chunks.append(text[:end])
+                run_manager.on_llm_new_token(text[:end], verbose=self.verbose)
+                text = text[end:]
+            if count >= max_new_tokens:
+                break
+        if text:
+            chunks.append(text)
+            run_manager.on_llm_new_token(text, verbose=self.verbose)
+        return "".join(chunks)
+
+
+class RemoteLLM(LLM):
+    """
+    LangChain LLM that generates on an OpenAI-compatible inference server through a `RemoteLLMClient`.
+
+    Tokens are handed to the callbacks as the server streams them. If a callback raises (e.g. the client
+    of a streamed answer disconnected), the request to the server is cancelled. PromptTokenizer counts
+    prompt tokens with the client too, see REMOTE_LLM_TOKENIZER.
+    """
+
+    client: Any = None
+    # Generation settings, same keys as the `config` of the local model.
+    config: dict = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "openai_compatible"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"base_url": self.client.base_url, "model": self.client.model, "config": self.config}
+
+    def _call(self, prompt: str, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None,
+              max_new_tokens: Optional[int] = None, **kwargs) -> str:
+        run_manager = run_manager or CallbackManagerForLLMRun.get_noop_manager()
+        return self.client.generate(
+            prompt,
+            on_token=lambda token: run_manager.on_llm_new_token(token, verbose=self.verbose),
+            stop=stop,
+            max_tokens=max_new_tokens or self.config["max_new_tokens"],
+            temperature=self.config["temperature"],
+        )
+
+
 # Loading the model
 # If local = True, we use locally downloaded LLM. (Free)
-# If local = False, we use OpenAI's GPT models using an API call. (Paid)
-def load_llm(local: bool):
+# If local = False, we use an OpenAI-compatible inference server (REMOTE_LLM_* settings, see remote_llm.py).
+# static_prefix: start shared by all prompts, kept evaluated in the model between requests (see above).
+# threads: CPU threads used for generation, by default ctransformers picks them itself.
+# settings.LLM_MODEL_PATH = "stub" loads a tiny fake model instead of the GGUF file (see stub_llm.py).
+def load_llm(local: bool, static_prefix: str = "", threads: Optional[int] = None):
     
     if local:
-        # Load the locally downloaded model here
-        llm = CTransformers(
-            # model="TheBloke/Llama-2-7B-Chat-GGML",
-            model="app/LLM/capybarahermes-2.5-mistral-7b.Q3_K_M.gguf",
-            model_type="mistral",
-            max_new_tokens = 1024,
-            temperature = 0.5
-        )
-        
+        # Generation settings are only read from `config`, keyword arguments are silently ignored.
+        config = {
+            "max_new_tokens": 1024,
+            "temperature": 0.5,
+            "context_length": settings.LLM_CONTEXT_LENGTH,
+        }
+        if threads:
+            config["threads"] = threads
+
+        if settings.LLM_MODEL_PATH == STUB_MODEL:
+            # The client is normally created by the CTransformers validator from the model file.
+            llm = PrefixCachedCTransformers.construct(
+                model=STUB_MODEL,
+                config=config,
+                client=StubModel(max_new_tokens=config["max_new_tokens"], context_length=config["context_length"]),
+                static_prefix=static_prefix,
+            )
+        else:
+            # Load the locally downloaded model here
+            llm = PrefixCachedCTransformers(
+                # model="TheBloke/Llama-2-7B-Chat-GGML",
+                model=settings.LLM_MODEL_PATH,
+                model_type="mistral",
+                config=config,
+                static_prefix=static_prefix,
+            )
+        llm.warm_prefix()
+
         return llm
 
     else:
-        # This is using a paid LLM like GPT4o from OpenAI
-        return None 
+        # The server keeps the model loaded, this only points at it (vLLM, llama.cpp server, or a paid API
+        # like OpenAI's)
+        return RemoteLLM(client=remote_llm_client, config={"max_new_tokens": 1024, "temperature": 0.5})
     
 
 # Unloading the LLM
@@ -0,0 +1,456 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Any, List, Optional
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from app.core.config import settings
+
+
+class ReplicaUnavailable(Exception):
+    """Raised when no LLM replica is running, or when the replica generating an answer exits."""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _ReplicaTokenHandler(BaseCallbackHandler):
+    # Without raise_error LangChain only logs exceptions raised by callbacks and generation would go on.
+    raise_error = True
+
+    def __init__(self, request_id: int, cancelled: set, send):
+        self.request_id = request_id
+        self.cancelled = cancelled
+        self.send = send
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self.request_id in self.cancelled:
+            raise _Cancelled()
+        self.send(("token", self.request_id, token))
+
+
+def _replica_main(conn, static_prefix: str, threads: int, cpus):
+    """
+    Entry point of a replica process: load the model, then serve the requests of the API process.
+
+    Messages in both directions are (kind, request id, payload) tuples. Tokenizer requests are answered
+    right away by the receiving thread, generations run one at a time on a thread of their own, so a
+    cancel can reach the generation that is running.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    from app.services.LLM_handling.llm_loader import load_llm
+    try:
+        llm = load_llm(local=True, static_prefix=static_prefix, threads=threads)
+    except Exception as e:
+        conn.send(("failed", None, f"{type(e).__name__}: {e}"))
+        return
+
+    send_lock = threading.Lock()
+    state_lock = threading.Lock()
+    active, cancelled = set(), set()
+    generations = queue.Queue()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def _generate_loop():
+        while True:
+            request_id, (prompt, stop, max_new_tokens) = generations.get()
+            try:
+                if request_id in cancelled:
+                    raise _Cancelled()
+                handler = _ReplicaTokenHandler(request_id, cancelled, send)
+                result = llm.invoke(prompt, stop=stop, config={"callbacks": [handler]},
+                                    max_new_tokens=max_new_tokens)
+                send(("result", request_id, result))
+            except _Cancelled:
+                send(("cancelled", request_id, None))
+            except Exception as e:
+                send(("error", request_id, f"{type(e).__name__}: {e}"))
+            finally:
+                with state_lock:
+                    active.discard(request_id)
+                    cancelled.discard(request_id)
+
+    threading.Thread(target=_generate_loop, name="llm-generation", daemon=True).start()
+    send(("ready", None, {"pid": os.getpid(), "context_length": llm.client.context_length,
+                          "config": dict(llm.config)}))
+    while True:
+        try:
+            kind, request_id, payload = conn.recv()
+        except (EOFError, OSError):
+            return
+        if kind == "stop":
+            return
+        if kind == "generate":
+            with state_lock:
+                active.add(request_id)
+            generations.put((request_id, payload))
+        elif kind == "cancel":
+            with state_lock:
+                if request_id in active:
+                    cancelled.add(request_id)
+        elif kind in ("tokenize", "detokenize"):
+            try:
+                if kind == "tokenize":
+                    text, add_bos_token = payload
+                    result = llm.client.tokenize(text, add_bos_token=add_bos_token)
+                else:
+                    tokens, decode = payload
+                    result = llm.client.detokenize(tokens, decode=decode)
+                send(("result", request_id, result))
+            except Exception as e:
+                send(("error", request_id, f"{type(e).__name__}: {e}"))
+
+
+class _Request:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.events = queue.Queue()  # ("token", text) until one of ("result" | "error" | "cancelled" | "lost", payload)
+        self.started_at = time.perf_counter()
+
+
+class _Replica:
+    """One model process of the pool, with the API-side bookkeeping of its requests."""
+
+    def __init__(self, index: int, threads: int, cpus):
+        self.index = index
+        self.threads = threads
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.pid = None
+        self.alive = False
+        self.requests = {}  # request id -> _Request, generations and tokenizer calls waiting for an answer
+        self.in_flight = 0
+        self.dispatched = 0
+        self.completed = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.restarts = 0
+        self.busy_seconds = 0.0
+        self.busy_since = None
+        self.generation_seconds = 0.0
+        self.started_at = time.perf_counter()
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+        except (OSError, ValueError):
+            # The process is gone, its reader thread fails the waiting requests.
+            pass
+
+
+class LLMReplicaPool:
+    """
+    Pool of worker processes that each load their own copy of the local LLM.
+
+    A single CTransformers model only runs one generation at a time, and its matrix multiplications stop
+    scaling well past a handful of threads, so on a many-core machine several smaller replicas answer
+    concurrent questions faster than one model with every core. Each replica generates with `threads`
+    threads and, with `pin_cpus`, is pinned to cores of its own so replicas don't steal each other's caches.
+
+    Generations go to the replica with the fewest requests in flight. Replicas that exit are started again.
+    `start()` returns `PooledLLM`, the LangChain LLM the rest of the app uses instead of the in-process model.
+    """
+
+    def __init__(self, replicas: int, threads: int = 0, pin_cpus: bool = True):
+        self.size = replicas
+        self.threads = threads
+        self.pin_cpus = pin_cpus
+        self.context_length = None
+        self.config = {}
+        self._replicas: List[_Replica] = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._static_prefix = ""
+        self._closing = False
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self, static_prefix: str = "") -> "PooledLLM":
+        """
+        Start the replicas and wait until all of them have loaded the model.
+
+        Args:
+            static_prefix (str): Start shared by all prompts, kept evaluated in every replica (see llm_loader.py).
+
+        Returns:
+            PooledLLM: The LLM that dispatches prompts to the replicas.
+
+        Raises:
+            RuntimeError: If a replica fails to load the model.
+        """
+        self._static_prefix = static_prefix
+        if hasattr(os, "sched_getaffinity"):
+            cpu_ids = sorted(os.sched_getaffinity(0))
+        else:
+            cpu_ids = list(range(os.cpu_count() or 1))
+        threads = self.threads or max(1, len(cpu_ids) // self.size)
+        # Pinning replicas to shared cores would only make them wait for each other.
+        pin_cpus = self.pin_cpus and hasattr(os, "sched_setaffinity") and threads * self.size <= len(cpu_ids)
+        if self.pin_cpus and not pin_cpus:
+            print(f"Not pinning the {self.size} LLM replicas of {threads} threads to the {len(cpu_ids)} cores")
+        self._replicas = [_Replica(index, threads, cpu_ids[index * threads:(index + 1) * threads] if pin_cpus else None)
+                          for index in range(self.size)]
+
+        started_at = time.perf_counter()
+        # Spawn all replicas before waiting for any, so they load the model at the same time.
+        # "spawn" gives every replica a clean interpreter instead of forking the API process with its loaded models.
+        for replica in self._replicas:
+            self._spawn(replica)
+        for replica in self._replicas:
+            info = self._wait_ready(replica)
+            self.context_length = info["context_length"]
+            self.config = info["config"]
+            threading.Thread(target=self._read, args=(replica,), name=f"llm-replica-{replica.index}-reader",
+                             daemon=True).start()
+        print(f"Started {self.size} LLM replicas of {threads} threads in {time.perf_counter() - started_at:.2f}s")
+        return PooledLLM(pool=self, client=_ReplicaTokenizer(self), config=dict(self.config))
+
+    def _spawn(self, replica: _Replica):
+        conn, child_conn = self._context.Pipe()
+        replica.process = self._context.Process(target=_replica_main,
+                                                args=(child_conn, self._static_prefix, replica.threads, replica.cpus),
+                                                name=f"llm-replica-{replica.index}", daemon=True)
+        replica.process.start()
+        # Only the replica holds its end now, so reading gets EOFError as soon as the replica exits.
+        child_conn.close()
+        replica.conn = conn
+
+    def _wait_ready(self, replica: _Replica) -> dict:
+        try:
+            kind, _, payload = replica.conn.recv()
+        except (EOFError, OSError):
+            kind, payload = "failed", f"exit code {replica.process.exitcode}"
+        if kind != "ready":
+            replica.process.join(timeout=5)
+            raise RuntimeError(f"LLM replica {replica.index} failed to load the model: {payload}")
+        with self._lock:
+            if replica.pid is None:
+                replica.started_at = time.perf_counter()
+            replica.pid = payload["pid"]
+            replica.alive = True
+        return payload
+
+    def _read(self, replica: _Replica):
+        # Routes the messages of one replica to the requests waiting for them, and restarts the replica when it exits.
+        while True:
+            try:
+                kind, request_id, payload = replica.conn.recv()
+            except (EOFError, OSError):
+                if not self._restart(replica):
+                    return
+                continue
+            if kind == "token":
+                with self._lock:
+                    request = replica.requests.get(request_id)
+                if request is not None:
+                    request.events.put((kind, payload))
+                continue
+            with self._lock:
+                request = replica.requests.pop(request_id, None)
+                if request is not None and request.kind == "generate":
+                    self._finish_generation(replica, request, kind)
+            if request is not None:
+                request.events.put((kind, payload))
+
+    def _finish_generation(self, replica: _Replica, request: _Request, kind: str):
+        # Called with the lock held.
+        now = time.perf_counter()
+        replica.in_flight -= 1
+        if replica.in_flight == 0:
+            replica.busy_seconds += now - replica.busy_since
+            replica.busy_since = None
+        replica.generation_seconds += now - request.started_at
+        if kind == "result":
+            replica.completed += 1
+        elif kind == "cancelled":
+            replica.cancelled += 1
+        else:
+            replica.errors += 1
+
+    def _restart(self, replica: _Replica) -> bool:
+        with self._lock:
+            replica.alive = False
+            lost = list(replica.requests.values())
+            for request in lost:
+                if request.kind == "generate":
+                    self._finish_generation(replica, request, "lost")
+            replica.requests.clear()
+            closing = self._closing
+        replica.conn.close()
+        for request in lost:
+            request.events.put(("lost", f"LLM replica {replica.index} exited"))
+        if closing:
+            return False
+        print(f"LLM replica {replica.index} (pid {replica.pid}) exited with code {replica.process.exitcode}, "
+              f"restarting it")
+        try:
+            self._spawn(replica)
+            self._wait_ready(replica)
+        except RuntimeError as e:
+            print(e)
+            return False
+        with self._lock:
+            replica.restarts += 1
+        return True
+
+    def submit(self, prompt: str, stop: Optional[List[str]] = None, max_new_tokens: Optional[int] = None):
+        """
+        Send a prompt to the replica with the fewest requests in flight.
+
+        Returns:
+            Tuple[_Replica, int, _Request]: The replica, the request id and the request, whose `events` get
+            the generated tokens and then the outcome.
+
+        Raises:
+            ReplicaUnavailable: If no replica is running.
+        """
+        with self._lock:
+            alive = [replica for replica in self._replicas if replica.alive]
+            if not alive:
+                raise ReplicaUnavailable("No LLM replica is running")
+            replica = min(alive, key=lambda candidate: (candidate.in_flight, candidate.busy_seconds))
+            request_id = next(self._ids)
+            request = _Request("generate")
+            replica.requests[request_id] = request
+            if replica.in_flight == 0:
+                replica.busy_since = request.started_at
+            replica.in_flight += 1
+            replica.dispatched += 1
+        replica.send(("generate", request_id, (prompt, stop, max_new_tokens)))
+        return replica, request_id, request
+
+    def cancel(self, replica: _Replica, request_id: int):
+        """Stop a generation at its next token, or drop it if the replica hasn't started it yet."""
+        replica.send(("cancel", request_id, None))
+
+    def call(self, kind: str, *payload):
+        """
+        Run a tokenizer call ("tokenize" or "detokenize") on the first running replica and return its result.
+
+        Always the same replica while it runs, so tokens and texts go through the same vocabulary.
+        """
+        with self._lock:
+            replica = next((replica for replica in self._replicas if replica.alive), None)
+            if replica is None:
+                raise ReplicaUnavailable("No LLM replica is running")
+            request_id = next(self._ids)
+            request = _Request(kind)
+            replica.requests[request_id] = request
+        replica.send((kind, request_id, payload))
+        outcome, result = request.events.get()
+        if outcome == "lost":
+            raise ReplicaUnavailable(result)
+        if outcome != "result":
+            raise RuntimeError(result)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            self._closing = True
+            replicas = list(self._replicas)
+        for replica in replicas:
+            replica.send(("stop", None, None))
+        for replica in replicas:
+            replica.process.join(timeout=5)
+            if replica.process.is_alive():
+                replica.process.terminate()
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.perf_counter()
+            replicas = []
+            for replica in self._replicas:
+                busy_seconds = replica.busy_seconds + (now - replica.busy_since if replica.in_flight else 0.0)
+                finished = replica.completed + replica.errors + replica.cancelled
+                replicas.append({
+                    "index": replica.index,
+                    "pid": replica.pid,
+                    "alive": replica.alive,
+                    "threads": replica.threads,
+                    "cpus": replica.cpus,
+                    "in_flight": replica.in_flight,
+                    "dispatched": replica.dispatched,
+                    "completed": replica.completed,
+                    "errors": replica.errors,
+                    "cancelled": replica.cancelled,
+                    "restarts": replica.restarts,
+                    "busy_seconds": round(busy_seconds, 3),
+                    # Share of the time since the replica first started that it spent generating.
+                    "utilization": round(busy_seconds / max(now - replica.started_at, 1e-9), 4),
+                    "average_generation_seconds": round(replica.generation_seconds / finished, 3) if finished else 0.0,
+                })
+            return {"replicas": len(replicas), "in_flight": sum(replica["in_flight"] for replica in replicas),
+                    "per_replica": replicas}
+
+
+class _ReplicaTokenizer:
+    """The tokenizer part of the ctransformers client API (see PromptTokenizer), answered by the replicas."""
+
+    def __init__(self, pool: LLMReplicaPool):
+        self._pool = pool
+
+    def tokenize(self, text: str, add_bos_token: Optional[bool] = None) -> List[int]:
+        return self._pool.call("tokenize", text, add_bos_token)
+
+    def detokenize(self, tokens, decode: bool = True):
+        return self._pool.call("detokenize", list(tokens), decode)
+
+    @property
+    def context_length(self) -> int:
+        return self._pool.context_length
+
+
+class PooledLLM(LLM):
+    """
+    LangChain LLM that generates on the replicas of an `LLMReplicaPool`.
+
+    Tokens are handed to the callbacks as the replica produces them. If a callback raises (e.g. the
+    client of a streamed answer disconnected), the replica stops the generation at its next token.
+    """
+
+    pool: Any = None
+    # Tokenizer of the replicas, under the name PromptTokenizer looks for on CTransformers models.
+    client: Any = None
+    config: dict = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm_replica_pool"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"replicas": self.pool.size, "config": self.config}
+
+    def _call(self, prompt: str, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None,
+              max_new_tokens: Optional[int] = None, **kwargs) -> str:
+        replica, request_id, request = self.pool.submit(prompt, stop=stop, max_new_tokens=max_new_tokens)
+        while True:
+            kind, payload = request.events.get()
+            if kind == "token":
+                if run_manager is None:
+                    continue
+                try:
+                    run_manager.on_llm_new_token(payload, verbose=self.verbose)
+                except BaseException:
+                    self.pool.cancel(replica, request_id)
+                    raise
+            elif kind == "result":
+                return payload
+            elif kind == "lost":
+                raise ReplicaUnavailable(payload)
+            else:
+                raise RuntimeError(f"Generation failed on LLM replica {replica.index}: {payload}")
+
+
+llm_replica_pool = LLMReplicaPool(replicas=settings.LLM_REPLICAS, threads=settings.LLM_REPLICA_THREADS,
+                                  pin_cpus=settings.LLM_REPLICA_PIN_CPUS)
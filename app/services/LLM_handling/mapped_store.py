@@ -0,0 +1,469 @@
+import json
+import os
+import re
+import threading
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from app.services.LLM_handling.ann_index import INDEX_FLAT, INDEX_IVF, recall_latency_report, set_search_params
+from app.services.LLM_handling.quantization import (PRECISION_FLOAT32, build_code_index, decode_code_index,
+                                                   load_code_index, rescore)
+from app.services.LLM_handling.vector_store import TombstoneFilter, UserVectorStore, passes_score_threshold
+
+FORMAT_NAME = "chat-with-your-data/vector-store"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+LEGACY_FILES = ("index.faiss", "index.pkl")
+
+# Files of one generation of a store, written next to manifest.json:
+#   vectors.<generation>.npy: float32 vectors, one row per chunk, opened memory-mapped. Left out of
+#       reduced-precision stores that don't re-score with float32.
+#   codes.<generation>.faiss: float16 or int8 scalar-quantized vectors of reduced-precision stores, in a
+#       faiss index that is memory-mapped and scanned instead of the float32 vectors.
+#   docstore.<generation>.data: UTF-8 JSON records {"id", "page_content", "metadata"}, concatenated.
+#   docstore.<generation>.offsets.npy: int64 byte offsets of the records (row count + 1 entries).
+#   ann.<generation>.faiss: optional HNSW/IVF index over the same rows, added by attach_ann_index().
+_GENERATION_FILE = re.compile(r"^(vectors|codes|docstore|ann)\.(\d+)\.")
+
+
+class UnsupportedStoreFormat(Exception):
+    """Raised when a store on disk was written with an unknown format or a newer format version."""
+
+
+def _manifest_path(folder_path) -> str:
+    return os.path.join(str(folder_path), MANIFEST_FILE)
+
+
+def has_mapped_store(folder_path) -> bool:
+    return os.path.isfile(_manifest_path(folder_path))
+
+
+def has_legacy_store(folder_path) -> bool:
+    return all(os.path.isfile(os.path.join(str(folder_path), name)) for name in LEGACY_FILES)
+
+
+def read_manifest(folder_path) -> dict:
+    """
+    Read and check the version header of a store.
+
+    Raises:
+        FileNotFoundError: If the folder has no store in this format.
+        UnsupportedStoreFormat: If the store was written with another format or a newer version.
+    """
+    with open(_manifest_path(folder_path)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_NAME or manifest.get("version", 0) > FORMAT_VERSION:
+        raise UnsupportedStoreFormat(f"Unsupported vector store format in {folder_path}: "
+                                     f"{manifest.get('format')} version {manifest.get('version')}")
+    return manifest
+
+
+def _generation_files(generation: int, precision: str, keep_float32: bool) -> dict:
+    files = {"docstore_data": f"docstore.{generation}.data",
+             "docstore_offsets": f"docstore.{generation}.offsets.npy"}
+    if precision == PRECISION_FLOAT32 or keep_float32:
+        files["vectors"] = f"vectors.{generation}.npy"
+    if precision != PRECISION_FLOAT32:
+        files["codes"] = f"codes.{generation}.faiss"
+    return files
+
+
+def _remove_files(folder_path, names):
+    for name in names:
+        try:
+            os.remove(os.path.join(folder_path, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # On Windows a file that is still mapped by a reader can't be removed, the next save retries.
+            print(f"Could not remove {name} from {folder_path}: {e}")
+
+
+def save_store(db: FAISS, folder_path, remove_legacy: bool = True, precision: str = PRECISION_FLOAT32,
+               keep_float32: bool = True) -> int:
+    """
+    Write an in-memory FAISS store in the memory-mapped format.
+
+    Every save writes a new generation of the data files and then switches manifest.json to it
+    atomically, so readers that already opened the previous generation keep working. The files of the
+    previous generation are kept until the next save, since a reader may have read the previous manifest
+    but not opened its files yet; older generations are removed.
+
+    Args:
+        db (FAISS): The store to write (a flat index).
+        folder_path (str): Folder of the user's store.
+        remove_legacy (bool): Remove the index.faiss/index.pkl files of the previous format.
+        precision (str): "float32", or "float16"/"int8" to store and scan scalar-quantized vectors.
+        keep_float32 (bool): For reduced precisions, also keep the float32 vectors to re-score candidates.
+
+    Returns:
+        int: The generation that was written.
+    """
+    folder_path = str(folder_path)
+    os.makedirs(folder_path, exist_ok=True)
+    generation = 1
+    previous_files = {}
+    if has_mapped_store(folder_path):
+        with open(_manifest_path(folder_path)) as f:
+            previous = json.load(f)
+        generation = previous.get("generation", 0) + 1
+        previous_files = previous.get("files", {})
+    files = _generation_files(generation, precision, keep_float32)
+
+    count = db.index.ntotal
+    vectors = db.index.reconstruct_n(0, count) if count else np.zeros((0, db.index.d), dtype=np.float32)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if "vectors" in files:
+        np.save(os.path.join(folder_path, files["vectors"]), vectors)
+    if "codes" in files:
+        codes = build_code_index(vectors, precision, distance_metric(db.distance_strategy))
+        faiss.write_index(codes, os.path.join(folder_path, files["codes"]))
+
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    with open(os.path.join(folder_path, files["docstore_data"]), "wb") as f:
+        for row in range(count):
+            doc_id = db.index_to_docstore_id[row]
+            doc = db.docstore.search(doc_id)
+            record = json.dumps({"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata},
+                                ensure_ascii=False).encode("utf-8")
+            f.write(record)
+            offsets[row + 1] = offsets[row] + len(record)
+    np.save(os.path.join(folder_path, files["docstore_offsets"]), offsets)
+
+    manifest = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "generation": generation,
+                "count": count, "dim": db.index.d, "index_type": INDEX_FLAT, "precision": precision,
+                "distance_strategy": DistanceStrategy(db.distance_strategy).value,
+                "normalize_L2": db._normalize_L2, "files": files}
+    _write_manifest(folder_path, manifest)
+
+    kept = set(files.values()) | set(previous_files.values())
+    _remove_files(folder_path, [name for name in os.listdir(folder_path)
+                                if _GENERATION_FILE.match(name) and name not in kept])
+    if remove_legacy:
+        _remove_files(folder_path, LEGACY_FILES)
+    return generation
+
+
+def _write_manifest(folder_path, manifest: dict):
+    tmp_path = _manifest_path(folder_path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, _manifest_path(folder_path))
+
+
+def distance_metric(distance_strategy) -> int:
+    if DistanceStrategy(distance_strategy) == DistanceStrategy.MAX_INNER_PRODUCT:
+        return faiss.METRIC_INNER_PRODUCT
+    return faiss.METRIC_L2
+
+
+def attach_ann_index(folder_path, generation: int, index_type: str, index: faiss.Index) -> bool:
+    """
+    Add an approximate index built from the vectors of `generation` to the store. The caller holds the
+    store lock, so the manifest can't change in between.
+
+    Returns:
+        bool: False if the store was saved again meanwhile and `index` no longer matches its rows.
+    """
+    folder_path = str(folder_path)
+    manifest = read_manifest(folder_path)
+    if manifest["generation"] != generation:
+        return False
+    ann_name = f"ann.{generation}.faiss"
+    faiss.write_index(index, os.path.join(folder_path, ann_name))
+    manifest["files"]["ann"] = ann_name
+    manifest["index_type"] = index_type
+    _write_manifest(folder_path, manifest)
+    return True
+
+
+def read_vectors(folder_path, manifest: dict) -> np.ndarray:
+    """
+    Return the float32 vectors of a store: memory-mapped if they were kept, else decoded from the codes
+    into memory.
+    """
+    files = manifest["files"]
+    if "vectors" in files:
+        return np.load(os.path.join(str(folder_path), files["vectors"]), mmap_mode="r")
+    return decode_code_index(load_code_index(os.path.join(str(folder_path), files["codes"])))
+
+
+def _iter_records(data_path, offsets):
+    with open(data_path, "rb") as f:
+        for row in range(len(offsets) - 1):
+            yield json.loads(f.read(int(offsets[row + 1] - offsets[row])))
+
+
+def iter_store_records(folder_path):
+    """Yield the docstore records {"id", "page_content", "metadata"} of a store in the memory-mapped format."""
+    folder_path = str(folder_path)
+    files = read_manifest(folder_path)["files"]
+    offsets = np.load(os.path.join(folder_path, files["docstore_offsets"]))
+    yield from _iter_records(os.path.join(folder_path, files["docstore_data"]), offsets)
+
+
+def load_store_for_update(folder_path, embeddings) -> UserVectorStore:
+    """
+    Load a store in the memory-mapped format fully into memory, to add or delete vectors and save it again.
+
+    Args:
+        folder_path (str): Folder of the user's store.
+        embeddings (Embeddings): The embedding model of the store.
+
+    Returns:
+        UserVectorStore: The in-memory store.
+    """
+    folder_path = str(folder_path)
+    manifest = read_manifest(folder_path)
+    files = manifest["files"]
+    distance_strategy = DistanceStrategy(manifest["distance_strategy"])
+
+    vectors = np.ascontiguousarray(read_vectors(folder_path, manifest))
+    if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        index = faiss.IndexFlatIP(manifest["dim"])
+    else:
+        index = faiss.IndexFlatL2(manifest["dim"])
+    index.add(vectors)
+
+    offsets = np.load(os.path.join(folder_path, files["docstore_offsets"]))
+    docs = {}
+    index_to_docstore_id = {}
+    for row, record in enumerate(_iter_records(os.path.join(folder_path, files["docstore_data"]), offsets)):
+        docs[record["id"]] = Document(page_content=record["page_content"], metadata=record["metadata"])
+        index_to_docstore_id[row] = record["id"]
+
+    db = UserVectorStore(embeddings, index, InMemoryDocstore(docs), index_to_docstore_id,
+                         normalize_L2=manifest["normalize_L2"], distance_strategy=distance_strategy)
+    db.folder_path = folder_path
+    return db
+
+
+def select_documents(hits, k: int, tombstones, filter, score_threshold, distance_strategy) -> list:
+    """
+    Turn search hits into the top k (Document, score) pairs, skipping tombstoned and filtered out records.
+
+    Args:
+        hits (Iterable[Tuple[float, MappedVectorStore, int]]): Score, store and row of every candidate, best first.
+        k (int): Number of documents to return.
+        tombstones (Set[str]): Ids of deleted vectors.
+        filter (dict | Callable, optional): Metadata filter, same as FAISS.
+        score_threshold (float, optional): Worst score to keep, same as FAISS.
+        distance_strategy (DistanceStrategy): Distance of the scores.
+
+    Returns:
+        List[Tuple[Document, float]]: At most k documents with their scores.
+    """
+    filter_func = FAISS._create_filter_func(filter) if filter is not None else None
+    docs = []
+    for score, store, row in hits:
+        if row == -1:
+            continue
+        record = store.get_record(int(row))
+        if record["id"] in tombstones:
+            continue
+        if filter_func is not None and not filter_func(record["metadata"]):
+            continue
+        if not passes_score_threshold(score, score_threshold, distance_strategy):
+            continue
+        docs.append((Document(page_content=record["page_content"], metadata=record["metadata"]), float(score)))
+        if len(docs) == k:
+            break
+    return docs
+
+
+class ReadOnlyVectorStore(VectorStore):
+    """
+    Query side of the stores read from disk: subclasses implement `similarity_search_with_score_by_vector`
+    and set `_embeddings` and `distance_strategy`.
+    """
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, filter=None, fetch_k=20, **kwargs):
+        """
+        `similarity_search_with_score_by_vector` for several query vectors at once, one result list per
+        query. Subclasses search all queries with a single multi-query faiss search.
+        """
+        return [self.similarity_search_with_score_by_vector(embedding, k, filter, fetch_k, **kwargs)
+                for embedding in embeddings]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, fetch_k=20, **kwargs):
+        return self.similarity_search_with_score_by_vector(self._embeddings.embed_query(query), k, filter,
+                                                           fetch_k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter, fetch_k, **kwargs)]
+
+    def similarity_search(self, query, k=4, filter=None, fetch_k=20, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter, fetch_k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        if self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            return self._max_inner_product_relevance_score_fn
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError(f"{type(self).__name__} is read-only, update stores with load_store_for_update()")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError("Build stores with UserVectorStore and write them with save_store()")
+
+
+class MappedVectorStore(TombstoneFilter, ReadOnlyVectorStore):
+    """
+    Read-only user store in the memory-mapped format, used on the query path.
+
+    Loading only maps the vectors and the record offsets, so it takes constant time and adds almost
+    nothing to the process's private memory; the OS pages the vectors in on the first search and shares
+    them between processes. Only the records of the top-k hits are read and decoded.
+
+    Large stores also carry an HNSW or IVF index (see ann_index.py), which is searched instead of
+    scanning every vector. Until it is built in the background, searches fall back to the exact scan.
+
+    Reduced-precision stores scan float16/int8 codes (see quantization.py) instead of float32 vectors,
+    halving or quartering the pages a search touches. When the float32 vectors were kept, the best
+    `rescore_factor` * k candidates are re-ranked with their exact distances.
+    """
+
+    def __init__(self, folder_path, embeddings, manifest: dict, search_params: dict = None):
+        self.folder_path = str(folder_path)
+        self._embeddings = embeddings
+        self.generation = manifest["generation"]
+        self.distance_strategy = DistanceStrategy(manifest["distance_strategy"])
+        self._normalize_L2 = manifest["normalize_L2"]
+        files = manifest["files"]
+        self.count = manifest["count"]
+        self.precision = manifest.get("precision", PRECISION_FLOAT32)
+        search_params = dict(search_params or {})
+        self.rescore_factor = search_params.pop("rescore_factor", 1) or 1
+        self.vectors = None
+        if "vectors" in files:
+            self.vectors = np.load(os.path.join(self.folder_path, files["vectors"]), mmap_mode="r")
+        self.codes = None
+        self._codes_bytes = 0
+        if "codes" in files:
+            codes_path = os.path.join(self.folder_path, files["codes"])
+            self.codes = load_code_index(codes_path)
+            self._codes_bytes = os.path.getsize(codes_path)
+        self._offsets = np.load(os.path.join(self.folder_path, files["docstore_offsets"]), mmap_mode="r")
+        # Keep the data file open, so a later save that removes this generation doesn't break this reader.
+        self._data = open(os.path.join(self.folder_path, files["docstore_data"]), "rb")
+        self._data_lock = threading.Lock()
+
+        self.index_type = INDEX_FLAT
+        self.ann = None
+        self._ann_bytes = 0
+        if "ann" in files:
+            ann_path = os.path.join(self.folder_path, files["ann"])
+            self.index_type = manifest["index_type"]
+            # IVF inverted lists can be memory-mapped like the vectors, HNSW graphs are read into memory.
+            self.ann = faiss.read_index(ann_path, faiss.IO_FLAG_MMAP if self.index_type == INDEX_IVF else 0)
+            self._ann_bytes = os.path.getsize(ann_path)
+            set_search_params(self.ann, **search_params)
+
+    @classmethod
+    def load(cls, folder_path, embeddings, search_params: dict = None) -> "MappedVectorStore":
+        """
+        Open a store in the memory-mapped format.
+
+        Args:
+            folder_path (str): Folder of the user's store.
+            embeddings (Embeddings): The embedding model, used to embed queries.
+            search_params (dict, optional): "ef_search" and/or "nprobe" for the approximate index, and
+                "rescore_factor" for reduced-precision stores (1 disables re-scoring).
+        """
+        manifest = read_manifest(folder_path)
+        try:
+            store = cls(folder_path, embeddings, manifest, search_params)
+        except (OSError, RuntimeError):
+            # faiss raises RuntimeError for missing files. If two saves happened between reading the
+            # manifest and opening its files, the files are gone: open the new generation instead.
+            latest = read_manifest(folder_path)
+            if latest["generation"] == manifest["generation"]:
+                raise
+            store = cls(folder_path, embeddings, latest, search_params)
+        store.refresh_tombstones()
+        return store
+
+    @property
+    def metric(self) -> int:
+        return distance_metric(self.distance_strategy)
+
+    def __len__(self):
+        return self.count
+
+    def memory_size(self) -> int:
+        """Bytes that end up resident once the store is searched (the scanned vectors or codes and the index)."""
+        scanned_bytes = self._codes_bytes if self.codes is not None else self.vectors.nbytes
+        return scanned_bytes + self._offsets.nbytes + self._ann_bytes
+
+    def index_version(self):
+        """Changes whenever the searchable content of the store changes (a new generation or a delete)."""
+        self.refresh_tombstones()
+        return self.generation, self._tombstones_mtime
+
+    def get_record(self, row: int) -> dict:
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        with self._data_lock:
+            self._data.seek(start)
+            data = self._data.read(end - start)
+        return json.loads(data)
+
+    def _search(self, vector: np.ndarray, k: int, row_range: tuple = None):
+        """
+        Top-k rows of the store for every query vector in `vector` (shape (n, dim)), or of rows [start, end)
+        only when `row_range` is given (the rows of one owner in a shard segment, see sharded_store.py;
+        segments have no approximate index).
+        """
+        start, end = row_range if row_range is not None else (0, self.count)
+        rescoring = self.precision != PRECISION_FLOAT32 and self.vectors is not None and self.rescore_factor > 1
+        search_k = min(k * self.rescore_factor, end - start) if rescoring else min(k, end - start)
+        if self.codes is not None and (self.ann is None or row_range is not None):
+            params = None
+            if row_range is not None:
+                params = faiss.SearchParametersIVF(sel=faiss.IDSelectorRange(start, end), nprobe=1)
+            scores, rows = self.codes.search(vector, search_k, params=params)
+        elif self.ann is not None and row_range is None:
+            scores, rows = self.ann.search(vector, search_k)
+        else:
+            scores, rows = faiss.knn(vector, self.vectors[start:end], search_k, metric=self.metric)
+            rows = np.where(rows >= 0, rows + start, -1)
+        if rescoring:
+            scores, rows = rescore(vector, self.vectors, rows, k, self.metric)
+        return scores, rows
+
+    def _search_rows(self, vector: np.ndarray, k: int):
+        scores, rows = self._search(vector, k)
+        return scores[0], rows[0]
+
+    def recall_report(self, k: int = 10, sample_size: int = 100) -> dict:
+        """Recall@k and latency of this store's index at several search settings, see `recall_latency_report`."""
+        vectors = self.vectors if self.vectors is not None else decode_code_index(self.codes)
+        report = recall_latency_report(vectors, self.ann, self.index_type, self.metric, k, sample_size,
+                                       store_search=self._search)
+        return {"generation": self.generation, "precision": self.precision, "rescore_factor": self.rescore_factor,
+                **report}
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        return self.similarity_search_with_score_by_vectors([embedding], k, filter, fetch_k, **kwargs)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, filter=None, fetch_k=20, **kwargs):
+        self.refresh_tombstones()
+        if len(self) == 0:
+            return [[] for _ in embeddings]
+        vectors = np.array(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vectors)
+        # Fetch enough extra candidates to still have k live ones after skipping the tombstoned vectors.
+        search_k = min((k if filter is None else fetch_k) + len(self.tombstones), len(self))
+        all_scores, all_rows = self._search(vectors, search_k)
+        return [select_documents(((score, self, row) for score, row in zip(scores, rows)), k, self.tombstones,
+                                 filter, kwargs.get("score_threshold"), self.distance_strategy)
+                for scores, rows in zip(all_scores, all_rows)]
@@ -0,0 +1,127 @@
+"""
+One-shot migration of the per-user vector stores (<user folder>/vector_store/db_faiss) into the shared
+shards of the sharded backend.
+
+Usage (from the repository root, with no ingestion running):
+    python -m app.services.LLM_handling.migrate_to_shards [--remove-per-user]
+
+Users are read from the `users` table. Vectors keep their ids, so the vector ids recorded on the `files`
+rows stay valid; tombstoned vectors are left out. Users already found in their shard are skipped, so an
+interrupted migration can simply be run again. Set VECTOR_STORE_BACKEND=sharded once it is done.
+"""
+import argparse
+import os
+import shutil
+import time
+from collections import defaultdict
+from app.core.config import settings
+from app.services.LLM_handling.convert_vector_stores import NoEmbeddings
+from app.services.LLM_handling.embedding import _precision_options, vector_store_lock
+from app.services.LLM_handling.mapped_store import has_legacy_store, has_mapped_store, load_store_for_update
+from app.services.LLM_handling.sharded_store import (per_user_store_path, read_owner_ranges, read_segments,
+                                                    shard_path, write_segment)
+from app.services.LLM_handling.vector_store import UserVectorStore, apply_tombstones
+
+# Vectors merged in memory before they are written as one segment of a shard.
+DEFAULT_SEGMENT_VECTORS = 500000
+
+
+def _load_user_store(db_faiss_path):
+    embeddings = NoEmbeddings()
+    if has_mapped_store(db_faiss_path):
+        return load_store_for_update(db_faiss_path, embeddings)
+    if has_legacy_store(db_faiss_path):
+        return UserVectorStore.load_local(db_faiss_path, embeddings, allow_dangerous_deserialization=True)
+    return None
+
+
+def _migrated_owners(shard_folder) -> set:
+    owners = set()
+    for name in read_segments(shard_folder)["segments"]:
+        owners.update(int(owner) for owner in read_owner_ranges(os.path.join(shard_folder, name))[0])
+    return owners
+
+
+def migrate_shard(shard_folder, users, remove_per_user: bool = False,
+                  segment_vectors: int = DEFAULT_SEGMENT_VECTORS) -> int:
+    """
+    Copy the per-user stores of the users of one shard into it.
+
+    Args:
+        shard_folder (str): Folder of the shard.
+        users (Iterable[Tuple[int, str]]): Id and per-user store folder of every user of the shard.
+        remove_per_user (bool): Delete the per-user stores once their vectors are in the shard.
+        segment_vectors (int): Write a segment whenever this many vectors are merged in memory.
+
+    Returns:
+        int: The number of migrated vectors.
+    """
+    migrated = 0
+    with vector_store_lock(shard_folder):
+        done_owners = _migrated_owners(shard_folder)
+        merged, owner_ids, sources = None, [], []
+
+        def _flush():
+            nonlocal merged, owner_ids, sources, migrated
+            if merged is not None:
+                write_segment(shard_folder, merged, owner_ids, **_precision_options())
+                migrated += merged.index.ntotal
+            if remove_per_user:
+                for source in sources:
+                    shutil.rmtree(source, ignore_errors=True)
+            merged, owner_ids, sources = None, [], []
+
+        for user_id, db_faiss_path in users:
+            if user_id in done_owners:
+                continue
+            db = _load_user_store(db_faiss_path)
+            if db is None:
+                continue
+            apply_tombstones(db, db_faiss_path)
+            owner_ids.extend([user_id] * db.index.ntotal)
+            sources.append(db_faiss_path)
+            if merged is None:
+                merged = db
+            else:
+                merged.merge_from(db)
+            if merged.index.ntotal >= segment_vectors:
+                _flush()
+        _flush()
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--remove-per-user", action="store_true",
+                        help="Delete the per-user stores once they are migrated")
+    parser.add_argument("--segment-vectors", type=int, default=DEFAULT_SEGMENT_VECTORS,
+                        help="Vectors merged in memory per written segment")
+    args = parser.parse_args()
+
+    from app.db import models
+    from app.db.database import SessionLocal
+    db = SessionLocal()
+    try:
+        users = db.query(models.User.id, models.User.user_folder_name).all()
+    finally:
+        db.close()
+
+    users_by_shard = defaultdict(list)
+    for user_id, user_folder_name in users:
+        user_folder = settings.BASE_DIR + "\\" + user_folder_name
+        users_by_shard[shard_path(user_id)].append((user_id, per_user_store_path(user_folder)))
+
+    for shard_folder, shard_users in sorted(users_by_shard.items()):
+        started_at = time.perf_counter()
+        try:
+            count = migrate_shard(shard_folder, shard_users, remove_per_user=args.remove_per_user,
+                                  segment_vectors=args.segment_vectors)
+        except Exception as e:
+            print(f"Failed to migrate the users of {shard_folder}: {e}")
+            continue
+        print(f"Migrated {len(shard_users)} users to {shard_folder}: {count} vectors "
+              f"in {time.perf_counter() - started_at:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+from langchain_core.documents import Document
+
+# This module is imported by the parsing worker processes, keep its imports light.
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+# Reader of the file a parsing worker is currently extracting, reused by the following ranges of the same file.
+_worker_reader = None
+_worker_reader_key = None
+
+
+def _get_pool(max_workers: int) -> ProcessPoolExecutor:
+    # One pool per process, created on first use and reused for every following file.
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != max_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = max_workers
+        return _pool
+
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> list:
+    # Parsing the cross-reference table costs about as much as extracting a dozen pages, so do it once per file.
+    global _worker_reader, _worker_reader_key
+    reader_key = (file_path, os.path.getmtime(file_path))
+    if reader_key != _worker_reader_key:
+        _worker_reader = PdfReader(file_path)
+        _worker_reader_key = reader_key
+    reader = _worker_reader
+    return [reader.pages[page_number].extract_text() for page_number in range(start, stop)]
+
+
+def _page_document(file_path: str, page_number: int, text: str) -> Document:
+    # Same metadata as PyPDFLoader, so chunks look the same whichever path extracted them.
+    return Document(page_content=text, metadata={"source": file_path, "page": page_number})
+
+
+def iter_pdf_pages(file_path: str, max_workers: int = 1, min_pages_for_parallel: int = 50, pages_per_task: int = 16):
+    """
+    Yield one Document per page of a PDF, in page order.
+
+    Large PDFs are split into page ranges that are extracted in parallel on a process pool. At most
+    two ranges per worker are in flight, so memory stays bounded while the caller consumes the pages.
+    Small PDFs (or `max_workers` <= 1) are extracted in this process to skip the pool overhead.
+
+    Args:
+        file_path (str): Path of the PDF.
+        max_workers (int): Size of the parsing process pool.
+        min_pages_for_parallel (int): PDFs with fewer pages are extracted serially.
+        pages_per_task (int): Number of pages extracted by one pool task.
+
+    Yields:
+        Document: The text of a page with its "source" and "page" metadata.
+    """
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+
+    if max_workers <= 1 or page_count < min_pages_for_parallel:
+        for page_number, page in enumerate(reader.pages):
+            yield _page_document(file_path, page_number, page.extract_text())
+        return
+
+    pool = _get_pool(max_workers)
+    page_ranges = iter([(start, min(start + pages_per_task, page_count))
+                        for start in range(0, page_count, pages_per_task)])
+    in_flight = deque()
+
+    def _submit_next():
+        page_range = next(page_ranges, None)
+        if page_range is not None:
+            in_flight.append((page_range[0], pool.submit(_extract_page_range, file_path, *page_range)))
+
+    for _ in range(2 * max_workers):
+        _submit_next()
+    while in_flight:
+        start, future = in_flight.popleft()
+        texts = future.result()
+        _submit_next()
+        for offset, text in enumerate(texts):
+            yield _page_document(file_path, start + offset, text)
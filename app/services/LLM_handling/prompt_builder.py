@@ -0,0 +1,154 @@
+import re
+from langchain_core.documents import Document
+from langchain_core.prompts import PromptTemplate
+
+_WORD = re.compile(r"\w+")
+
+
+class PromptTokenizer:
+    """
+    Counts and truncates text in tokens of the loaded model.
+
+    CTransformers models are tokenized with their own tokenizer (`llm.client`), so the counts are exact.
+    The LLM replica pool exposes the tokenizer of its replicas the same way, and the remote backend's client
+    the tokenizer set by REMOTE_LLM_TOKENIZER.
+    Other LangChain LLMs fall back to `get_token_ids` (their own tokenizer, or GPT-2's by default).
+    """
+
+    def __init__(self, llm):
+        self._llm = llm
+        client = getattr(llm, "client", None)
+        self._client = client if hasattr(client, "tokenize") and hasattr(client, "detokenize") else None
+
+    def encode(self, text: str) -> list:
+        if self._client is not None:
+            return self._client.tokenize(text, add_bos_token=False)
+        return self._llm.get_token_ids(text)
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """The longest start of `text` that is at most `max_tokens` tokens long."""
+        tokens = self.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        if self._client is not None:
+            return self._client.detokenize(tokens[:max_tokens])
+        # Without a detokenizer, keep as many whole words as fit.
+        words = text.split(" ")
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(" ".join(words[:middle])) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return " ".join(words[:low])
+
+    def context_length(self):
+        """Context window of the model (prompt plus generated tokens), None if unknown."""
+        if self._client is None:
+            return None
+        context_length = self._client.context_length
+        return context_length if context_length > 0 else None
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = _WORD.findall(text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+
+def _similarity(shingles: set, other: set) -> float:
+    if not shingles or not other:
+        return 0.0
+    return len(shingles & other) / len(shingles | other)
+
+
+class PromptBuilder:
+    """
+    Fills a prompt template with as many retrieved chunks as fit in a token budget.
+
+    Chunks are taken in retrieval order (most similar first). A chunk whose word 3-grams overlap an
+    already selected chunk by `duplicate_similarity` (Jaccard) or more is skipped, e.g. the same page of a
+    file uploaded twice. The first chunk that doesn't fit in what is left of the budget is trimmed to it,
+    unless less than `min_chunk_tokens` are left, and no chunk is added after it.
+
+    The budget is `context_tokens`, lowered if needed so that the whole prompt plus `max_new_tokens` stays
+    within the context window of the model.
+
+    A template with a `{history}` variable also takes the conversation so far (see chat_memory.py), which
+    is counted against the context window like the question.
+    """
+
+    def __init__(self, llm, prompt: PromptTemplate, context_tokens: int, max_chunks: int,
+                 duplicate_similarity: float, max_new_tokens: int = 0, min_chunk_tokens: int = 32):
+        self.llm = llm
+        self.tokenizer = PromptTokenizer(llm)
+        self.prompt = prompt
+        self.context_tokens = context_tokens
+        self.max_chunks = max_chunks
+        self.duplicate_similarity = duplicate_similarity
+        self.max_new_tokens = max_new_tokens
+        self.min_chunk_tokens = min_chunk_tokens
+        self.separator = "\n\n"
+        self._separator_tokens = self.tokenizer.count(self.separator)
+        # The fixed instructions cost the same in every prompt, count them once.
+        self._template_tokens = self.tokenizer.count(self._format("", "", ""))
+
+    def _format(self, context: str, question: str, history: str) -> str:
+        if "history" in self.prompt.input_variables:
+            return self.prompt.format(history=history, context=context, question=question)
+        return self.prompt.format(context=context, question=question)
+
+    def _context_budget(self, question_tokens: int, max_new_tokens: int) -> int:
+        budget = self.context_tokens
+        context_length = self.tokenizer.context_length()
+        if context_length is not None:
+            budget = min(budget, context_length - max_new_tokens - self._template_tokens - question_tokens)
+        return max(budget, 0)
+
+    def build(self, question: str, docs, max_new_tokens: int = None, history: str = "") -> dict:
+        """
+        Build the prompt of a question.
+
+        Args:
+            question (str): The user question.
+            docs (List[Document]): Retrieved chunks, most similar first.
+            max_new_tokens (int, optional): Most tokens of this answer, when the request asks for fewer than
+                                            `max_new_tokens`: the room left in the context window is for chunks.
+            history (str, optional): The conversation so far, for templates with a `{history}` variable.
+
+        Returns:
+            dict: "prompt" (str), "documents" (the chunks in the prompt, trimmed ones with their trimmed
+            text), "prompt_tokens", "context_tokens", "duplicates_dropped" and "chunks_trimmed".
+        """
+        question_tokens = self.tokenizer.count(question) + (self.tokenizer.count(history) if history else 0)
+        budget = self._context_budget(question_tokens, max_new_tokens or self.max_new_tokens)
+        selected, selected_shingles = [], []
+        used_tokens, duplicates, trimmed = 0, 0, 0
+        for doc in docs:
+            if len(selected) == self.max_chunks:
+                break
+            shingles = _shingles(doc.page_content)
+            if any(_similarity(shingles, other) >= self.duplicate_similarity for other in selected_shingles):
+                duplicates += 1
+                continue
+            separator_tokens = self._separator_tokens if selected else 0
+            remaining = budget - used_tokens - separator_tokens
+            tokens = self.tokenizer.count(doc.page_content)
+            if tokens <= remaining:
+                selected.append(doc)
+                selected_shingles.append(shingles)
+                used_tokens += separator_tokens + tokens
+                continue
+            if remaining >= self.min_chunk_tokens:
+                text = self.tokenizer.truncate(doc.page_content, remaining)
+                selected.append(Document(page_content=text, metadata=doc.metadata))
+                used_tokens += separator_tokens + self.tokenizer.count(text)
+                trimmed += 1
+            break
+
+        prompt = self._format(self.separator.join(doc.page_content for doc in selected), question, history)
+        return {"prompt": prompt, "documents": selected, "prompt_tokens": self.tokenizer.count(prompt),
+                "context_tokens": used_tokens, "duplicates_dropped": duplicates, "chunks_trimmed": trimmed}
@@ -0,0 +1,97 @@
+import faiss
+import numpy as np
+
+PRECISION_FLOAT32 = "float32"
+PRECISION_FLOAT16 = "float16"
+PRECISION_INT8 = "int8"
+PRECISIONS = (PRECISION_FLOAT32, PRECISION_FLOAT16, PRECISION_INT8)
+
+
+def scalar_quantizer_type(precision: str) -> int:
+    """faiss scalar quantizer type of a reduced precision: float16 halves the vectors, int8 quarters them."""
+    if precision == PRECISION_FLOAT16:
+        return faiss.ScalarQuantizer.QT_fp16
+    if precision == PRECISION_INT8:
+        return faiss.ScalarQuantizer.QT_8bit
+    raise ValueError(f"Unknown reduced vector precision {precision}")
+
+
+def build_code_index(vectors: np.ndarray, precision: str, metric: int) -> faiss.Index:
+    """
+    Scalar-quantize vectors into an exhaustive-search index, rows keep the order of `vectors`.
+
+    The index is an IVF with a single list, so it scans every code like a flat index, but faiss can
+    memory-map its codes on load (IO_FLAG_MMAP only applies to IVF lists) and compares the query with
+    the codes directly, without decoding them to float32 first.
+
+    Args:
+        vectors (np.ndarray): float32 vectors, shape (count, dim).
+        precision (str): PRECISION_FLOAT16 or PRECISION_INT8.
+        metric (int): faiss.METRIC_L2 or faiss.METRIC_INNER_PRODUCT.
+
+    Returns:
+        faiss.Index: The filled index.
+    """
+    dim = vectors.shape[1]
+    quantizer = faiss.IndexFlatIP(dim) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(dim)
+    # Codes aren't relative to the centroid (by_residual=False), so the single list needs no k-means.
+    quantizer.add(np.zeros((1, dim), dtype=np.float32))
+    index = faiss.IndexIVFScalarQuantizer(quantizer, dim, 1, scalar_quantizer_type(precision), metric, False)
+    # int8 learns the value range of every dimension, float16 needs no training.
+    index.train(vectors if len(vectors) else np.zeros((1, dim), dtype=np.float32))
+    index.add(vectors)
+    return index
+
+
+def load_code_index(path: str) -> faiss.Index:
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    index.nprobe = 1
+    return index
+
+
+def decode_code_index(index: faiss.Index) -> np.ndarray:
+    """Decode the vectors of a `build_code_index` index back to (approximate) float32, in row order."""
+    invlists = index.invlists
+    count = invlists.list_size(0)
+    vectors = np.zeros((count, index.d), dtype=np.float32)
+    if count:
+        codes = faiss.rev_swig_ptr(invlists.get_codes(0), count * index.code_size).reshape(count, index.code_size)
+        rows = faiss.rev_swig_ptr(invlists.get_ids(0), count)
+        vectors[rows] = index.sq.decode(np.array(codes))
+    return vectors
+
+
+def rescore(queries: np.ndarray, vectors: np.ndarray, rows: np.ndarray, k: int, metric: int):
+    """
+    Re-rank candidates found on quantized vectors with their exact float32 distances.
+
+    Only the candidate rows of `vectors` are read, so with memory-mapped vectors this touches a few pages.
+
+    Args:
+        queries (np.ndarray): float32 query vectors, shape (n, dim).
+        vectors (np.ndarray): The float32 vectors of the store.
+        rows (np.ndarray): Candidate rows of every query, shape (n, m), -1 for missing results.
+        k (int): Number of results to keep.
+        metric (int): faiss.METRIC_L2 or faiss.METRIC_INNER_PRODUCT.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Scores and rows, shape (n, k) at most, best first and padded with
+        -1 rows like faiss.
+    """
+    width = min(k, rows.shape[1])
+    all_scores = np.full((len(queries), width), np.inf if metric != faiss.METRIC_INNER_PRODUCT else -np.inf,
+                         dtype=np.float32)
+    all_rows = np.full((len(queries), width), -1, dtype=np.int64)
+    for i, query in enumerate(queries):
+        # Sorted rows read the memory-mapped file front to back.
+        candidates = np.sort(rows[i][rows[i] >= 0])
+        candidate_vectors = np.asarray(vectors[candidates], dtype=np.float32)
+        if metric == faiss.METRIC_INNER_PRODUCT:
+            scores = candidate_vectors @ query
+            order = np.argsort(-scores, kind="stable")[:k]
+        else:
+            scores = ((candidate_vectors - query) ** 2).sum(axis=1)
+            order = np.argsort(scores, kind="stable")[:k]
+        all_scores[i, :len(order)] = scores[order]
+        all_rows[i, :len(order)] = candidates[order]
+    return all_scores, all_rows
@@ -0,0 +1,102 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from app.core.config import settings
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a query the way the tokenizer would see it anyway: Unicode NFC and collapsed whitespace.
+
+    Case is kept, so the cache stays exact for cased embedding models too.
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings, keyed by embedding model name and normalized query text.
+
+    Questions are re-sent often (dashboards, retries, the answer cache lookup followed by the retrieval of
+    the same question), and each embedding otherwise costs a forward pass of the model. Keying by model
+    name means a model change never serves vectors of the previous model.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (model name, normalized text) -> float32 vector, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, model_name: str, texts, embed_texts):
+        """
+        Return the embeddings of `texts`, computing only the ones that aren't cached.
+
+        Args:
+            model_name (str): Name of the embedding model, part of the cache key.
+            texts (List[str]): The query texts.
+            embed_texts (Callable[[List[str]], List[List[float]]]): Embeds the missing texts in one call.
+
+        Returns:
+            List[List[float]]: One embedding per text, in the order of `texts`.
+        """
+        keys = [(model_name, normalize_query(text)) for text in texts]
+        vectors = [None] * len(keys)
+        with self._lock:
+            for position, key in enumerate(keys):
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    vectors[position] = vector
+            hit_count = sum(vector is not None for vector in vectors)
+            self.hits += hit_count
+            self.misses += len(keys) - hit_count
+
+        missing = {}  # normalized text -> positions, so a text repeated in `texts` is embedded once
+        for position, key in enumerate(keys):
+            if vectors[position] is None:
+                missing.setdefault(key[1], []).append(position)
+        if missing:
+            # Embed outside of the lock so a slow model call doesn't block cache hits of other requests.
+            new_vectors = embed_texts(list(missing))
+            with self._lock:
+                for (text, positions), vector in zip(missing.items(), new_vectors):
+                    vector = np.asarray(vector, dtype=np.float32)
+                    for position in positions:
+                        vectors[position] = vector
+                    if self.max_entries > 0:
+                        self._entries[(model_name, text)] = vector
+                        self._entries.move_to_end((model_name, text))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return [vector.tolist() for vector in vectors]
+
+    def get(self, model_name: str, text: str, embed_texts) -> list:
+        """Return the embedding of one query text, see `get_many`."""
+        return self.get_many(model_name, [text], embed_texts)[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+query_embedding_cache = QueryEmbeddingCache(max_entries=settings.QUERY_EMBEDDING_CACHE_MAX_ENTRIES)
@@ -1,27 +1,42 @@
+import ntpath
+import os
+import threading
 from langchain.prompts import PromptTemplate
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_community.vectorstores.utils import DistanceStrategy
+from app.core.config import settings
 from app.services.LLM_handling.llm_loader import load_llm
+from app.services.LLM_handling.embedding_registry import get_embeddings
+from app.services.LLM_handling.generation_control import (FINISH_DEADLINE, FINISH_STOP, GenerationCancelled,
+                                                          GenerationControl, generation_stats)
+from app.services.LLM_handling.prompt_builder import PromptBuilder
+from app.services.LLM_handling.vector_store import UserVectorStore
+from app.services.LLM_handling.mapped_store import (MappedVectorStore, has_legacy_store, has_mapped_store,
+                                                    iter_store_records)
+from app.services.LLM_handling.sharded_store import BACKEND_SHARDED, VectorShard, has_shard, iter_owner_records
+from app.services.LLM_handling.vector_store_cache import vector_store_cache
 
 # Setting the custom prompt which has 2 variables as its dynamic content ['context', 'question']
 # Context: is the top similar context we got from the vector database.
 # Question: is the original user que
+# The template is flush left, indentation would only add tokens the model has to process on every request.
+# All instructions come before the context, so that this static start of the prompt stays evaluated in the
+# model between requests (see prompt_static_prefix) and only the context and the question need prefill.
 def set_custom_prompt():
     custom_prompt_template = """Use the following pieces of information to answer the user's question.
-    If you don't know the answer, just say that you don't know, don't try to make up an answer.
-    
-    if the user doesn't ask for a link, return the answer from the context and the question, if you did not find the answer in the context, 
-    try to answer it from your own knowledge, but make sure to mention that you are answering from your own knowledge.
+If you don't know the answer, just say that you don't know, don't try to make up an answer.
 
-    Context: {context}
-    Question: {question}
+if the user doesn't ask for a link, return the answer from the context and the question, if you did not find the answer in the context,
+try to answer it from your own knowledge, but make sure to mention that you are answering from your own knowledge.
 
-    If the user asks for a link, only return the link from the context, and nothing else. and the user will ask it like
-    open this or that or get me the link to this or that.
+If the user asks for a link, only return the link from the context, and nothing else. and the user will ask it like
+open this or that or get me the link to this or that.
 
-    Helpful answer:
-    """
+Context: {context}
+Question: {question}
+
+Helpful answer:
+"""
 
     prompt = PromptTemplate(
         template=custom_prompt_template,
@@ -31,30 +46,375 @@ def set_custom_prompt():
     return prompt
 
 
-def retrieval_qa_chain(llm, prompt, db):
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type='stuff',
-        retriever=db.as_retriever(search_kwargs={'k': 2}),
-        return_source_documents=False,
-        chain_type_kwargs={'prompt': prompt}
-    )
+def set_chat_prompt():
+    """
+    The custom prompt with the conversation so far (summary and recent turns, see chat_memory.py) before the
+    context. It starts with the same instructions, so the static prefix evaluated in the model is shared.
+    """
+    template = set_custom_prompt().template.replace("Context: {context}", "{history}Context: {context}")
+    return PromptTemplate(template=template, input_variables=['history', 'context', 'question'])
 
-    return qa_chain
 
+def prompt_static_prefix() -> str:
+    """
+    The part of every prompt before its first variable, up to a line break so that the rest of the prompt
+    can be tokenized on its own (see PrefixCachedCTransformers in llm_loader.py).
+    """
+    template = set_custom_prompt().template
+    head = template[:template.index("{context}")]
+    return head[:head.rfind("\n") + 1]
 
-def qa_bot(db_faiss_path, llm_model):
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
-    )
-    db = FAISS.load_local(db_faiss_path, embeddings, allow_dangerous_deserialization=True)
+
+_prompt_builders = {}
+_prompt_builders_lock = threading.Lock()
+
+
+def get_prompt_builder(llm, chat: bool = False) -> PromptBuilder:
+    """
+    The prompt builder of a loaded model, created once since it tokenizes the fixed template.
+    `chat` selects the template with the conversation so far (`set_chat_prompt`).
+    """
+    with _prompt_builders_lock:
+        builder = _prompt_builders.get((id(llm), chat))
+        # The id of a model that was unloaded may be reused by another one.
+        if builder is None or builder.llm is not llm:
+            config = getattr(llm, "config", None) or {}
+            builder = PromptBuilder(llm, set_chat_prompt() if chat else set_custom_prompt(),
+                                    context_tokens=settings.PROMPT_CONTEXT_TOKENS,
+                                    max_chunks=settings.PROMPT_MAX_CHUNKS,
+                                    duplicate_similarity=settings.PROMPT_DUPLICATE_SIMILARITY,
+                                    max_new_tokens=config.get("max_new_tokens", 0))
+            _prompt_builders[(id(llm), chat)] = builder
+        return builder
+
+
+def build_prompt(llm, query: str, docs, max_new_tokens: int = None, history: str = None) -> dict:
+    """
+    Build the prompt of a question from its retrieved chunks, see `PromptBuilder.build`, and log its size.
+    With a `history` (even empty), the chat prompt is used.
+    """
+    builder = get_prompt_builder(llm, chat=history is not None)
+    built = builder.build(query, docs, max_new_tokens=max_new_tokens, history=history or "")
+    print(f"Prompt of {built['prompt_tokens']} tokens: {len(built['documents'])} of {len(docs)} chunks "
+          f"({built['context_tokens']} tokens), {built['duplicates_dropped']} duplicates dropped, "
+          f"{built['chunks_trimmed']} trimmed")
+    return built
+
+
+def retrieval_candidates() -> int:
+    # Retrieve more chunks than fit, so dropped duplicates are replaced by the next most similar chunks.
+    return 2 * settings.PROMPT_MAX_CHUNKS
+
+
+class QABot:
+    """
+    Retrieval-augmented question answering over a user's store: the most similar chunks are retrieved,
+    a prompt is built from the ones that fit the token budget (see prompt_builder.py) and the model
+    generates the answer.
+    """
+
+    def __init__(self, db, llm):
+        self.db = db
+        self.llm = llm
+
+    def invoke(self, query: str, control: GenerationControl = None, on_token=None, history: str = None) -> dict:
+        """
+        Answer a question. This call blocks until generation is finished, so run it on the inference executor.
+
+        Args:
+            query (str): The user question.
+            control (GenerationControl, optional): Token limit, deadline and cancellation of the generation.
+            on_token (Callable[[str], None], optional): Called with every new chunk of generated text.
+            history (str, optional): The conversation so far, to answer with the chat prompt (see chat_memory.py).
+
+        Returns:
+            dict: The "result" (the answer, partial if the deadline passed), the "source_documents" put in the
+                  prompt, the "prompt_tokens" and the "finish_reason" (FINISH_STOP or FINISH_DEADLINE).
+
+        Raises:
+            GenerationCancelled: If `control` was cancelled before generation finished.
+        """
+        control = control or GenerationControl()
+        try:
+            control.start()
+        except GenerationCancelled as e:
+            return _stopped_before_start(control, e)
+        docs = self.db.similarity_search(query, k=retrieval_candidates())
+        return _generate(self.llm, query, docs, control, on_token, history)
+
+    def run(self, query: str) -> str:
+        return self.invoke(query)["result"]
+
+
+def vector_index_search_params() -> dict:
+    return {"ef_search": settings.VECTOR_INDEX_HNSW_EF_SEARCH, "nprobe": settings.VECTOR_INDEX_IVF_NPROBE,
+            "rescore_factor": settings.VECTOR_STORE_RESCORE_FACTOR}
+
+
+def _load_vector_store(db_faiss_path):
+    embeddings = get_embeddings()
+    if has_mapped_store(db_faiss_path):
+        return MappedVectorStore.load(db_faiss_path, embeddings, search_params=vector_index_search_params())
+    # Stores that were not converted yet (see convert_vector_stores.py) are still unpickled into memory.
+    return UserVectorStore.load_local(db_faiss_path, embeddings, allow_dangerous_deserialization=True)
+
+
+def _load_vector_shard(shard_folder):
+    return VectorShard.load(shard_folder, get_embeddings(), search_params=vector_index_search_params())
+
+
+def get_user_vector_store(db_faiss_path, owner_id=None):
+    """
+    Return the store a user searches, from the in-process cache.
+
+    Args:
+        db_faiss_path (str): Folder of the user's store, or of the user's shard with the sharded backend.
+        owner_id (int, optional): Id of the user, needed with the sharded backend to only search their vectors.
+    """
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+        # The shard (open segments) is cached and shared by its users, the per-user view is cheap to create.
+        return vector_store_cache.get(db_faiss_path, _load_vector_shard).for_owner(owner_id)
+    return vector_store_cache.get(db_faiss_path, _load_vector_store)
+
+
+def vector_store_exists(db_faiss_path) -> bool:
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+        return has_shard(db_faiss_path)
+    return has_mapped_store(db_faiss_path) or has_legacy_store(db_faiss_path)
+
+
+def file_vector_ids(db_faiss_path, file_name: str, owner_id=None) -> list:
+    """
+    Ids of the vectors of a file, found by the metadata of its chunks: "file_name", or the base name of the
+    "source" path for chunks indexed before that was recorded. For files whose vector ids weren't recorded
+    at ingestion.
+
+    Args:
+        db_faiss_path (str): Folder of the user's store, or of the user's shard with the sharded backend.
+        file_name (str): Name of the uploaded file.
+        owner_id (int, optional): Id of the user, needed with the sharded backend.
+
+    Returns:
+        List[str]: Docstore ids of the file's vectors (tombstoned ones included).
+    """
+    if not vector_store_exists(db_faiss_path):
+        return []
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+        records = iter_owner_records(db_faiss_path, owner_id)
+    elif has_mapped_store(db_faiss_path):
+        records = iter_store_records(db_faiss_path)
+    else:
+        db = get_user_vector_store(db_faiss_path)
+        records = ({"id": doc_id, "metadata": doc.metadata} for doc_id, doc in db.docstore._dict.items())
+    # ntpath.basename splits on both separators, sources are Windows paths (see BASE_DIR).
+    return [record["id"] for record in records
+            if (record["metadata"].get("file_name") or ntpath.basename(record["metadata"].get("source", "")))
+            == file_name]
+
+
+def similarity_score(score: float, distance_strategy) -> float:
+    """
+    Turn a raw store score into a similarity between -1 and 1, higher is more similar.
+
+    For normalized embeddings (all-MiniLM-L6-v2 normalizes them) this is the cosine similarity: FAISS
+    returns squared L2 distances, and between unit vectors that distance is 2 - 2 * cosine.
+    """
+    if DistanceStrategy(distance_strategy) == DistanceStrategy.MAX_INNER_PRODUCT:
+        return float(score)
+    return 1 - float(score) / 2
+
+
+def _score_threshold(min_similarity: float, distance_strategy) -> float:
+    # The inverse of similarity_score, the stores compare thresholds with their raw scores.
+    if DistanceStrategy(distance_strategy) == DistanceStrategy.MAX_INNER_PRODUCT:
+        return min_similarity
+    return 2 * (1 - min_similarity)
+
+
+def search_chunks(db_faiss_path, query: str, k: int = 4, min_score: float = None, file_names=None,
+                  owner_id=None):
+    """
+    Retrieve the chunks of a user's store that are most similar to a query, without running the LLM.
+
+    Args:
+        db_faiss_path (str): Folder of the user's store, or of the user's shard with the sharded backend.
+        query (str): The text to search for.
+        k (int): Number of chunks to return at most.
+        min_score (float, optional): Only return chunks with at least this similarity (see `similarity_score`).
+        file_names (List[str], optional): Only search the chunks of these files.
+        owner_id (int, optional): Id of the user, needed with the sharded backend.
+
+    Returns:
+        List[dict]: "content", "score", "file_name" and "page" of every chunk, most similar first, or None
+        if the user has no store yet.
+    """
+    if not vector_store_exists(db_faiss_path):
+        return None
+    db = get_user_vector_store(db_faiss_path, owner_id)
+    embedding = get_embeddings().embed_query(query)
+    kwargs = {}
+    if min_score is not None:
+        kwargs["score_threshold"] = _score_threshold(min_score, db.distance_strategy)
+    # With a file filter the stores search fetch_k candidates and keep the k that match.
+    docs = db.similarity_search_with_score_by_vector(embedding, k=k,
+                                                      filter={"file_name": list(file_names)} if file_names else None,
+                                                      fetch_k=max(20, 8 * k), **kwargs)
+    return [{"content": doc.page_content,
+             "score": similarity_score(score, db.distance_strategy),
+             "file_name": doc.metadata.get("file_name") or os.path.basename(doc.metadata.get("source", "")),
+             "page": doc.metadata.get("page")}
+            for doc, score in docs]
+
+
+def vector_store_report(db_faiss_path, k=10, sample_size=100):
+    """
+    Recall@k against exact search and per-query latency of a user's store, at the configured and
+    at several other efSearch/nprobe values.
+
+    Returns:
+        dict: The report, or None if the user has no store of their own in the memory-mapped format.
+    """
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED or not has_mapped_store(db_faiss_path):
+        return None
+    # A separate instance, because the report switches search settings while it runs. Stored vectors
+    # are used as queries, so no embedding model is needed.
+    search_params = vector_index_search_params()
+    db = MappedVectorStore.load(db_faiss_path, None, search_params=search_params)
+    return {**db.recall_report(k, sample_size), "search_params": search_params}
+
+
+def answer_cache_key(db_faiss_path, query: str, owner_id=None):
+    """
+    Embedding of a question and current version of the user's store, which identify a cached answer
+    (see answer_cache.py).
+
+    Returns:
+        Tuple[List[float], Hashable]: The question embedding and the store version.
+    """
+    db = get_user_vector_store(db_faiss_path, owner_id)
+    return get_embeddings().embed_query(query), db.index_version()
+
+
+def qa_bot(db_faiss_path, llm_model, owner_id=None):
+    # Repeat queries of an active user are served from the in-process cache without touching disk.
+    db = get_user_vector_store(db_faiss_path, owner_id)
     llm = llm_model
-    qa_prompt = set_custom_prompt()
-    qa = retrieval_qa_chain(llm, qa_prompt, db)
+    qa = QABot(db, llm)
 
     return qa
 
+
+def retrieve_batch(db_faiss_path, queries, k: int = None, owner_id=None):
+    """
+    Retrieve the context chunks of many questions against one user's store at once: all questions that
+    aren't in the query embedding cache are embedded in a single forward pass of the embedding model, and
+    all are searched with a single multi-query search.
+
+    Args:
+        db_faiss_path (str): Folder of the user's store, or of the user's shard with the sharded backend.
+        queries (List[str]): The questions.
+        k (int, optional): Number of chunks per question, defaults to the prompt builder's candidates.
+        owner_id (int, optional): Id of the user, needed with the sharded backend.
+
+    Returns:
+        List[List[Document]]: The chunks of every question, in the order of `queries`, or None if the user
+        has no store yet.
+    """
+    if not vector_store_exists(db_faiss_path):
+        return None
+    db = get_user_vector_store(db_faiss_path, owner_id)
+    embeddings = get_embeddings().embed_queries(list(queries))
+    return [[doc for doc, _ in docs]
+            for docs in db.similarity_search_with_score_by_vectors(embeddings, k=k or retrieval_candidates())]
+
+
+def _stopped_before_start(control: GenerationControl, e: GenerationCancelled) -> dict:
+    # The deadline passed while the request waited in the inference queue: an empty partial answer.
+    generation_stats.record(control, e.reason)
+    if e.reason != FINISH_DEADLINE:
+        raise e
+    return {"result": "", "source_documents": [], "prompt_tokens": 0, "finish_reason": FINISH_DEADLINE}
+
+
+def _generate(llm, query, docs, control: GenerationControl, on_token=None, history: str = None) -> dict:
+    built = build_prompt(llm, query, docs, max_new_tokens=control.max_tokens, history=history)
+    kwargs = {"max_new_tokens": control.max_tokens} if control.max_tokens else {}
+    handler = _TokenStreamHandler(on_token or (lambda token: None), control)
+    try:
+        result = llm.invoke(built["prompt"], config={"callbacks": [handler]}, **kwargs)
+        finish_reason = FINISH_STOP
+    except GenerationCancelled as e:
+        generation_stats.record(control, e.reason)
+        if e.reason != FINISH_DEADLINE:
+            raise
+        # Past the deadline the text generated so far is the answer.
+        result, finish_reason = control.text(), FINISH_DEADLINE
+    else:
+        generation_stats.record(control, FINISH_STOP)
+    return {"result": result, "source_documents": built["documents"], "prompt_tokens": built["prompt_tokens"],
+            "finish_reason": finish_reason}
+
+
+def answer_from_documents(llm, query, docs, control: GenerationControl = None) -> dict:
+    """
+    Generate the answer to a question from already retrieved chunks, with the same prompt as `qa_bot`.
+
+    This call blocks until generation is finished, so run it on the inference executor.
+
+    Args:
+        llm (LLM): The loaded model.
+        query (str): The user question.
+        docs (List[Document]): The retrieved chunks, most similar first.
+        control (GenerationControl, optional): Token limit, deadline and cancellation of the generation.
+
+    Returns:
+        dict: Same as `QABot.invoke`.
+
+    Raises:
+        GenerationCancelled: If `control` was cancelled before generation finished.
+    """
+    control = control or GenerationControl()
+    try:
+        control.start()
+    except GenerationCancelled as e:
+        return _stopped_before_start(control, e)
+    return _generate(llm, query, docs, control)
+
+
+class _TokenStreamHandler(BaseCallbackHandler):
+    # Without raise_error LangChain only logs exceptions raised by callbacks and generation would go on.
+    raise_error = True
+
+    def __init__(self, on_token, control: GenerationControl):
+        self.on_token = on_token
+        self.control = control
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        # Raises GenerationCancelled when the client went away or the deadline passed
+        self.control.on_token(token)
+        self.on_token(token)
+
+
+def stream_answer(qa, query, on_token, control: GenerationControl):
+    """
+    Run a `qa_bot` chain and hand every generated token to `on_token` as soon as the model produces it.
+
+    This call blocks until generation is finished, so run it on the inference executor.
+
+    Args:
+        qa (QABot): Built by `qa_bot`.
+        query (str): The user question.
+        on_token (Callable[[str], None]): Called with every new chunk of generated text.
+        control (GenerationControl): Token limit, deadline and cancellation of the generation.
+
+    Returns:
+        dict: The full "result" and the "source_documents" put in the prompt, see `QABot.invoke`.
+
+    Raises:
+        GenerationCancelled: If `control` was cancelled before generation finished.
+    """
+    return qa.invoke(query, control=control, on_token=on_token)
+
 # Output function
 def get_llm_answer(query):
     qa_result = qa_bot()
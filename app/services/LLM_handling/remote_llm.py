@@ -0,0 +1,337 @@
+import asyncio
+import functools
+import json
+import queue
+import random
+import threading
+import time
+import httpx
+from app.core.config import settings
+
+# Values of LLM_BACKEND
+LLM_BACKEND_LOCAL = "local"
+LLM_BACKEND_REMOTE = "remote"
+
+# Responses worth sending the request again for: rate limited, or the server is overloaded or restarting.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Values of REMOTE_LLM_TOKENIZER, besides the name or folder of a Hugging Face tokenizer
+REMOTE_TOKENIZER_SERVER = "server"
+REMOTE_TOKENIZER_ESTIMATE = "estimate"
+# Characters per token of the "estimate" tokenizer
+ESTIMATED_CHARS_PER_TOKEN = 4
+# Texts whose tokens are remembered, so the instructions and chunks of every prompt aren't tokenized again
+TOKENIZE_CACHE_SIZE = 4096
+
+_DONE = object()
+
+
+class RemoteLLMError(Exception):
+    """Raised when the inference server rejects a request, or keeps failing after all retries."""
+
+
+class _RetryableError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after_seconds(response: httpx.Response):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+class RemoteLLMClient:
+    """
+    Client of an OpenAI-compatible inference server (vLLM, llama.cpp server, OpenAI itself...).
+
+    One `httpx.AsyncClient` is kept for the life of the process, so requests reuse pooled keep-alive
+    connections instead of paying a TCP (and TLS) handshake each. It runs on an event loop thread of its
+    own: generations are started from the inference executor threads, and the API event loop never
+    waits for the server.
+
+    At most `max_concurrency` requests are sent at once, the rest wait for a slot in this process.
+    Connection errors, timeouts and 429/5xx responses are retried up to `max_retries` times, waiting a
+    random time up to `retry_backoff * 2 ** attempt` seconds (capped at `retry_max_backoff`, "full jitter")
+    or the server's Retry-After, so clients that failed together don't retry together. A request is not
+    retried once it has streamed text, since that text was already handed to the caller.
+
+    It also tokenizes prompts for their token budgets (see PromptTokenizer), with the tokenizer set by
+    `tokenizer`: "server" for the /tokenize and /detokenize endpoints the llama.cpp server and vLLM serve
+    next to /v1, the name or folder of the model's Hugging Face tokenizer, or "estimate" for one token per
+    ESTIMATED_CHARS_PER_TOKEN characters, approximate but needing no tokenizer at all.
+    """
+
+    def __init__(self, base_url: str, api_key: str, model: str, chat: bool, max_concurrency: int,
+                 connect_timeout: float, read_timeout: float, max_retries: int, retry_backoff: float,
+                 retry_max_backoff: float, tokenizer: str = REMOTE_TOKENIZER_SERVER, context_length: int = 0):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.chat = chat
+        self.max_concurrency = max_concurrency
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_max_backoff = retry_max_backoff
+        self.tokenizer = tokenizer
+        # Context window of the served model, 0 if unknown (read by PromptTokenizer like the local model's)
+        self.context_length = context_length
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.failures = 0
+        self.cancelled = 0
+        self._total_seconds = 0.0
+        self._total_first_token_seconds = 0.0
+        self._first_tokens = 0
+        self._tokenizer_lock = threading.Lock()
+        self._hf_tokenizer = None
+        self._tokenizer_client = None
+        self._tokenize_cached = functools.lru_cache(maxsize=TOKENIZE_CACHE_SIZE)(self._tokenize)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="remote-llm", daemon=True).start()
+            # The client and the semaphore belong to the loop they are used on.
+            asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            self._loop = loop
+
+    async def _open(self):
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        # The read timeout bounds the wait for every next piece of a streamed answer, not the whole answer.
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url, headers=headers,
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=None),
+            limits=httpx.Limits(max_connections=self.max_concurrency,
+                                max_keepalive_connections=self.max_concurrency))
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def generate(self, prompt: str, on_token, stop=None, max_tokens: int = None, temperature: float = None) -> str:
+        """
+        Generate the completion of a prompt, handing every streamed piece of text to `on_token`.
+
+        This call blocks until the answer is complete. `on_token` runs on the calling thread: if it raises,
+        the request is cancelled (the connection is closed, so the server stops generating) and the
+        exception is raised from here.
+
+        Args:
+            prompt (str): The whole prompt.
+            on_token (Callable[[str], None]): Called with every new piece of the answer.
+            stop (List[str], optional): Sequences that end the answer.
+            max_tokens (int, optional): Most tokens to generate.
+            temperature (float, optional): Sampling temperature.
+
+        Returns:
+            str: The answer.
+
+        Raises:
+            RemoteLLMError: If the server rejected the request or couldn't answer it after all retries.
+        """
+        self._ensure_started()
+        tokens = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self.stream(prompt, tokens.put, stop=stop, max_tokens=max_tokens, temperature=temperature), self._loop)
+        future.add_done_callback(lambda _: tokens.put(_DONE))
+        while True:
+            token = tokens.get()
+            if token is _DONE:
+                return future.result()
+            try:
+                on_token(token)
+            except BaseException:
+                future.cancel()
+                raise
+
+    async def stream(self, prompt: str, on_token, stop=None, max_tokens: int = None,
+                     temperature: float = None) -> str:
+        """Same as `generate`, as a coroutine of the client's event loop."""
+        payload = {"model": self.model, "stream": True}
+        if self.chat:
+            payload["messages"] = [{"role": "user", "content": prompt}]
+        else:
+            payload["prompt"] = prompt
+        if stop:
+            payload["stop"] = stop
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if temperature is not None:
+            payload["temperature"] = temperature
+
+        async with self._semaphore:
+            with self._lock:
+                self.requests += 1
+                self.in_flight += 1
+            started_at = time.perf_counter()
+            chunks = []
+
+            def _on_chunk(text: str):
+                if not chunks:
+                    with self._lock:
+                        self._total_first_token_seconds += time.perf_counter() - started_at
+                        self._first_tokens += 1
+                chunks.append(text)
+                on_token(text)
+
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        await self._stream_once(payload, _on_chunk)
+                        return "".join(chunks)
+                    except (httpx.TransportError, _RetryableError) as e:
+                        if chunks or attempt >= self.max_retries:
+                            raise RemoteLLMError(f"The inference server failed after {attempt + 1} attempts: "
+                                                 f"{type(e).__name__} {e}") from e
+                        delay = random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * 2 ** attempt))
+                        if getattr(e, "retry_after", None) is not None:
+                            delay = min(e.retry_after, self.retry_max_backoff)
+                        attempt += 1
+                        with self._lock:
+                            self.retries += 1
+                        await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                with self._lock:
+                    self.cancelled += 1
+                raise
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                raise
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self._total_seconds += time.perf_counter() - started_at
+
+    async def _stream_once(self, payload: dict, on_chunk):
+        path = "/chat/completions" if self.chat else "/completions"
+        async with self._client.stream("POST", path, json=payload) as response:
+            if response.status_code in RETRY_STATUS_CODES:
+                raise _RetryableError(f"HTTP {response.status_code}", _retry_after_seconds(response))
+            if response.status_code >= 400:
+                body = (await response.aread()).decode(errors="replace")
+                raise RemoteLLMError(f"The inference server rejected the request: HTTP {response.status_code} "
+                                     f"{body[:500]}")
+            # Server-sent events, one "data: {json}" line per piece of the answer, then "data: [DONE]".
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                choices = json.loads(data).get("choices") or [{}]
+                text = choices[0].get("delta", {}).get("content") if self.chat else choices[0].get("text")
+                if text:
+                    on_chunk(text)
+
+    def load_tokenizer(self):
+        """Load the Hugging Face tokenizer set by `tokenizer`, if any. Returns None for the other tokenizers."""
+        if self.tokenizer in (REMOTE_TOKENIZER_SERVER, REMOTE_TOKENIZER_ESTIMATE):
+            return None
+        with self._tokenizer_lock:
+            if self._hf_tokenizer is None:
+                from transformers import AutoTokenizer
+                self._hf_tokenizer = AutoTokenizer.from_pretrained(self.tokenizer)
+            return self._hf_tokenizer
+
+    def tokenize(self, text: str, add_bos_token: bool = False) -> list:
+        """
+        Tokens of `text` in the served model's tokenizer (pieces of text with the "estimate" tokenizer).
+
+        `add_bos_token` is there for the interface of the local model, prompt budgets never count the BOS token.
+
+        Raises:
+            RemoteLLMError: If the "server" tokenizer is set and the server couldn't tokenize the text.
+        """
+        return list(self._tokenize_cached(text))
+
+    def detokenize(self, tokens) -> str:
+        if self.tokenizer == REMOTE_TOKENIZER_ESTIMATE:
+            return "".join(tokens)
+        if self.tokenizer == REMOTE_TOKENIZER_SERVER:
+            response = self._tokenizer_request("/detokenize", {"model": self.model, "tokens": list(tokens)})
+            # llama.cpp server answers {"content"}, vLLM {"prompt"}
+            return response.get("content", response.get("prompt", ""))
+        return self.load_tokenizer().decode(tokens)
+
+    def _tokenize(self, text: str) -> tuple:
+        if self.tokenizer == REMOTE_TOKENIZER_ESTIMATE:
+            return tuple(text[i:i + ESTIMATED_CHARS_PER_TOKEN] for i in range(0, len(text), ESTIMATED_CHARS_PER_TOKEN))
+        if self.tokenizer == REMOTE_TOKENIZER_SERVER:
+            # The fields of both the llama.cpp server ("content") and vLLM ("prompt"), each ignores the others.
+            return tuple(self._tokenizer_request("/tokenize", {"model": self.model, "content": text, "prompt": text,
+                                                               "add_special": False,
+                                                               "add_special_tokens": False})["tokens"])
+        return tuple(self.load_tokenizer().encode(text, add_special_tokens=False))
+
+    def _tokenizer_request(self, path: str, payload: dict) -> dict:
+        with self._tokenizer_lock:
+            if self._tokenizer_client is None:
+                # A small blocking client of its own: tokenizing runs on the threads building prompts, and must
+                # not wait for a connection of the pool held by streamed answers.
+                root = self.base_url[:-len("/v1")] if self.base_url.endswith("/v1") else self.base_url
+                headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+                self._tokenizer_client = httpx.Client(
+                    base_url=root, headers=headers,
+                    timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout))
+            client = self._tokenizer_client
+        try:
+            response = client.post(path, json=payload)
+        except httpx.TransportError as e:
+            raise RemoteLLMError(f"The inference server couldn't tokenize the prompt: {type(e).__name__} {e}") from e
+        if response.status_code >= 400:
+            raise RemoteLLMError(f"The inference server couldn't tokenize the prompt: HTTP {response.status_code} "
+                                 f"{response.text[:500]} (set REMOTE_LLM_TOKENIZER if it has no {path} endpoint)")
+        return response.json()
+
+    def close(self):
+        with self._tokenizer_lock:
+            tokenizer_client, self._tokenizer_client = self._tokenizer_client, None
+        if tokenizer_client is not None:
+            tokenizer_client.close()
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self.requests - self.in_flight
+            return {
+                "base_url": self.base_url,
+                "max_concurrency": self.max_concurrency,
+                "tokenizer": self.tokenizer,
+                "tokenize_cache_hits": self._tokenize_cached.cache_info().hits,
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "retries": self.retries,
+                "failures": self.failures,
+                "cancelled": self.cancelled,
+                "average_seconds": round(self._total_seconds / finished, 3) if finished else 0.0,
+                "average_time_to_first_token_seconds": (round(self._total_first_token_seconds / self._first_tokens, 3)
+                                                        if self._first_tokens else 0.0),
+            }
+
+
+remote_llm_client = RemoteLLMClient(base_url=settings.REMOTE_LLM_BASE_URL, api_key=settings.REMOTE_LLM_API_KEY,
+                                    model=settings.REMOTE_LLM_MODEL, chat=settings.REMOTE_LLM_CHAT,
+                                    max_concurrency=settings.REMOTE_LLM_MAX_CONCURRENCY,
+                                    connect_timeout=settings.REMOTE_LLM_CONNECT_TIMEOUT_SECONDS,
+                                    read_timeout=settings.REMOTE_LLM_READ_TIMEOUT_SECONDS,
+                                    max_retries=settings.REMOTE_LLM_MAX_RETRIES,
+                                    retry_backoff=settings.REMOTE_LLM_RETRY_BACKOFF_SECONDS,
+                                    retry_max_backoff=settings.REMOTE_LLM_RETRY_MAX_BACKOFF_SECONDS,
+                                    tokenizer=settings.REMOTE_LLM_TOKENIZER,
+                                    context_length=settings.REMOTE_LLM_CONTEXT_LENGTH)
@@ -0,0 +1,341 @@
+"""
+Shared vector stores holding the vectors of many users, as an alternative to one store per user folder.
+
+Users are spread over a fixed number of shards by a hash of their id. A shard folder holds:
+    segments.json: the live segments, switched atomically (os.replace) like the manifest of a store.
+    segment-<n>/: an immutable store in the memory-mapped format (see mapped_store.py) whose rows are
+        sorted by owner, plus owners.npy (the owner ids, sorted) and owner_offsets.npy (the first row of
+        every owner, and the row count at the end).
+    tombstones.json: deleted vector ids of all owners of the shard (see vector_store.py).
+
+Every ingestion appends a new segment with the vectors of one file, deletes only add tombstones, and a
+compaction merges all segments of a shard into one. Since the rows of an owner are contiguous in every
+segment, a search only scans the vectors of the user who asks, which also keeps results isolated.
+"""
+import json
+import os
+import shutil
+import zlib
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from app.core.config import settings
+from app.services.LLM_handling.mapped_store import (MappedVectorStore, ReadOnlyVectorStore, UnsupportedStoreFormat,
+                                                   _iter_records, read_manifest, read_vectors, save_store,
+                                                   select_documents)
+from app.services.LLM_handling.quantization import PRECISION_FLOAT32
+from app.services.LLM_handling.vector_store import TombstoneFilter, UserVectorStore
+
+BACKEND_PER_USER = "per_user"
+BACKEND_SHARDED = "sharded"
+
+SHARD_FORMAT_NAME = "chat-with-your-data/vector-shard"
+SHARD_FORMAT_VERSION = 1
+SEGMENTS_FILE = "segments.json"
+OWNERS_FILE = "owners.npy"
+OWNER_OFFSETS_FILE = "owner_offsets.npy"
+
+
+def shard_index(owner_id: int, shard_count: int) -> int:
+    # crc32 rather than hash(): it must give the same shard in every process and after a restart.
+    return zlib.crc32(str(owner_id).encode("utf-8")) % shard_count
+
+
+def shards_dir() -> str:
+    return settings.VECTOR_STORE_SHARDS_DIR or os.path.join(settings.BASE_DIR, "vector_shards")
+
+
+def shard_path(owner_id: int) -> str:
+    return os.path.join(shards_dir(), f"shard-{shard_index(owner_id, settings.VECTOR_STORE_SHARDS):04d}")
+
+
+def per_user_store_path(user_folder: str) -> str:
+    return user_folder + "\\vector_store\\db_faiss"
+
+
+def user_store_path(user_folder: str, user_id: int) -> str:
+    """
+    Folder of the store holding a user's vectors: a shared shard with the sharded backend, the user's
+    own store otherwise.
+    """
+    if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+        return shard_path(user_id)
+    return per_user_store_path(user_folder)
+
+
+def _segments_path(shard_folder) -> str:
+    return os.path.join(str(shard_folder), SEGMENTS_FILE)
+
+
+def has_shard(shard_folder) -> bool:
+    return os.path.isfile(_segments_path(shard_folder))
+
+
+def read_segments(shard_folder) -> dict:
+    """
+    Read the segment list of a shard, an empty one if the shard was never written.
+
+    Raises:
+        UnsupportedStoreFormat: If the shard was written with another format or a newer version.
+    """
+    try:
+        with open(_segments_path(shard_folder)) as f:
+            segments = json.load(f)
+    except FileNotFoundError:
+        return {"format": SHARD_FORMAT_NAME, "version": SHARD_FORMAT_VERSION, "segments": [], "next_segment": 1}
+    if segments.get("format") != SHARD_FORMAT_NAME or segments.get("version", 0) > SHARD_FORMAT_VERSION:
+        raise UnsupportedStoreFormat(f"Unsupported vector shard format in {shard_folder}: "
+                                     f"{segments.get('format')} version {segments.get('version')}")
+    return segments
+
+
+def _write_segments(shard_folder, segments: dict):
+    tmp_path = _segments_path(shard_folder) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(segments, f, indent=2)
+    os.replace(tmp_path, _segments_path(shard_folder))
+
+
+def read_owner_ranges(segment_folder):
+    owners = np.load(os.path.join(segment_folder, OWNERS_FILE))
+    owner_offsets = np.load(os.path.join(segment_folder, OWNER_OFFSETS_FILE))
+    return owners, owner_offsets
+
+
+def _owner_range(owners: np.ndarray, owner_offsets: np.ndarray, owner_id: int):
+    position = int(np.searchsorted(owners, owner_id))
+    if position == len(owners) or owners[position] != owner_id:
+        return None
+    return int(owner_offsets[position]), int(owner_offsets[position + 1])
+
+
+def shard_vector_count(shard_folder) -> int:
+    """Number of vectors physically in a shard, tombstoned ones included."""
+    return sum(read_manifest(os.path.join(str(shard_folder), name))["count"]
+               for name in read_segments(shard_folder)["segments"])
+
+
+def write_segment(shard_folder, db: FAISS, owner_ids, replaces=(), precision: str = PRECISION_FLOAT32,
+                  keep_float32: bool = True) -> str:
+    """
+    Add the vectors of an in-memory store to a shard as a new segment. The caller holds the shard lock.
+
+    Args:
+        shard_folder (str): Folder of the shard.
+        db (FAISS): The vectors to add (a flat index), may be empty when `replaces` is given.
+        owner_ids (Sequence[int]): The owner of every row of `db`.
+        replaces (Iterable[str]): Segments whose vectors are all in `db` (a compaction), removed from the shard.
+        precision (str): Precision of the stored vectors, see save_store().
+        keep_float32 (bool): For reduced precisions, also keep the float32 vectors to re-score candidates.
+
+    Returns:
+        str: The name of the new segment, None if `db` was empty.
+    """
+    shard_folder = str(shard_folder)
+    os.makedirs(shard_folder, exist_ok=True)
+    segments = read_segments(shard_folder)
+    count = db.index.ntotal
+    name = None
+    if count:
+        name = f"segment-{segments['next_segment']:06d}"
+        segment_folder = os.path.join(shard_folder, name)
+        tmp_folder = segment_folder + ".tmp"
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+        # Rows sorted by owner, so every owner is one contiguous range of the segment.
+        owner_ids = np.asarray(owner_ids, dtype=np.int64)
+        order = np.argsort(owner_ids, kind="stable")
+        index = faiss.IndexFlatIP(db.index.d) if db.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT \
+            else faiss.IndexFlatL2(db.index.d)
+        index.add(np.ascontiguousarray(db.index.reconstruct_n(0, count)[order]))
+        sorted_db = UserVectorStore(db.embedding_function, index, db.docstore,
+                                    {row: db.index_to_docstore_id[int(old_row)] for row, old_row in enumerate(order)},
+                                    normalize_L2=db._normalize_L2, distance_strategy=db.distance_strategy)
+        save_store(sorted_db, tmp_folder, remove_legacy=False, precision=precision, keep_float32=keep_float32)
+
+        owners, first_rows = np.unique(owner_ids[order], return_index=True)
+        np.save(os.path.join(tmp_folder, OWNERS_FILE), owners)
+        np.save(os.path.join(tmp_folder, OWNER_OFFSETS_FILE), np.append(first_rows, count).astype(np.int64))
+        os.replace(tmp_folder, segment_folder)
+        segments["next_segment"] += 1
+
+    replaced = set(replaces)
+    segments["segments"] = [segment for segment in segments["segments"] if segment not in replaced]
+    if name is not None:
+        segments["segments"].append(name)
+    _write_segments(shard_folder, segments)
+
+    for segment in replaced:
+        try:
+            shutil.rmtree(os.path.join(shard_folder, segment))
+        except OSError as e:
+            # On Windows files that are still mapped by a reader can't be removed.
+            print(f"Could not remove {segment} from {shard_folder}: {e}")
+    return name
+
+
+def load_shard_for_update(shard_folder, embeddings, drop_ids=()):
+    """
+    Load all segments of a shard into one in-memory store, to merge them.
+
+    Args:
+        shard_folder (str): Folder of the shard.
+        embeddings (Embeddings): The embedding model of the store.
+        drop_ids (Iterable[str]): Vector ids to leave out (the tombstones).
+
+    Returns:
+        Tuple[UserVectorStore, np.ndarray, List[str]]: The store (None if the shard has no segments), the
+        owner of every row and the segments that were loaded.
+    """
+    shard_folder = str(shard_folder)
+    drop_ids = set(drop_ids)
+    segment_names = read_segments(shard_folder)["segments"]
+    db, all_owner_ids = None, []
+    for name in segment_names:
+        segment_folder = os.path.join(shard_folder, name)
+        manifest = read_manifest(segment_folder)
+        owners, owner_offsets = read_owner_ranges(segment_folder)
+        row_owners = np.repeat(owners, np.diff(owner_offsets))
+        offsets = np.load(os.path.join(segment_folder, manifest["files"]["docstore_offsets"]))
+        records = list(_iter_records(os.path.join(segment_folder, manifest["files"]["docstore_data"]), offsets))
+        keep = np.array([record["id"] not in drop_ids for record in records], dtype=bool)
+        if db is None:
+            distance_strategy = DistanceStrategy(manifest["distance_strategy"])
+            index = faiss.IndexFlatIP(manifest["dim"]) if distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT \
+                else faiss.IndexFlatL2(manifest["dim"])
+            db = UserVectorStore(embeddings, index, InMemoryDocstore({}), {},
+                                 normalize_L2=manifest["normalize_L2"], distance_strategy=distance_strategy)
+        if not keep.any():
+            continue
+        vectors = np.ascontiguousarray(read_vectors(segment_folder, manifest)[keep])
+        first_row = db.index.ntotal
+        db.index.add(vectors)
+        kept_records = [record for record, kept in zip(records, keep) if kept]
+        db.docstore.add({record["id"]: Document(page_content=record["page_content"], metadata=record["metadata"])
+                         for record in kept_records})
+        for row, record in enumerate(kept_records, start=first_row):
+            db.index_to_docstore_id[row] = record["id"]
+        all_owner_ids.append(row_owners[keep])
+    owner_ids = np.concatenate(all_owner_ids) if all_owner_ids else np.zeros(0, dtype=np.int64)
+    return db, owner_ids, segment_names
+
+
+def iter_owner_records(shard_folder, owner_id: int):
+    """Yield the docstore records of one owner in every segment of a shard (tombstoned ones included)."""
+    shard_folder = str(shard_folder)
+    for name in read_segments(shard_folder)["segments"]:
+        segment = MappedVectorStore.load(os.path.join(shard_folder, name), None)
+        row_range = _owner_range(*read_owner_ranges(segment.folder_path), owner_id)
+        if row_range is None:
+            continue
+        for row in range(*row_range):
+            yield segment.get_record(row)
+
+
+class VectorShard(TombstoneFilter):
+    """
+    Read side of a shard, cached per process like a user store. `for_owner` returns the store one user
+    searches.
+
+    Segments are opened like MappedVectorStore (memory-mapped), and re-listed when segments.json changes.
+    """
+
+    def __init__(self, folder_path, embeddings, search_params: dict = None):
+        self.folder_path = str(folder_path)
+        self._embeddings = embeddings
+        self._search_params = search_params
+        self._segments_mtime = None
+        self.segments = []  # (MappedVectorStore, owners, owner offsets)
+        self.refresh()
+
+    @classmethod
+    def load(cls, folder_path, embeddings, search_params: dict = None) -> "VectorShard":
+        return cls(folder_path, embeddings, search_params)
+
+    def refresh(self):
+        self.refresh_tombstones()
+        try:
+            mtime = os.path.getmtime(_segments_path(self.folder_path))
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._segments_mtime:
+            return
+        opened = {segment.folder_path: (segment, owners, owner_offsets)
+                  for segment, owners, owner_offsets in self.segments}
+        segments = []
+        for name in read_segments(self.folder_path)["segments"]:
+            segment_folder = os.path.join(self.folder_path, name)
+            if segment_folder not in opened:
+                segment = MappedVectorStore(segment_folder, self._embeddings, read_manifest(segment_folder),
+                                            self._search_params)
+                opened[segment_folder] = (segment, *read_owner_ranges(segment_folder))
+            segments.append(opened[segment_folder])
+        self.segments = segments
+        self._segments_mtime = mtime
+
+    def memory_size(self) -> int:
+        """
+        Bytes the shard keeps for itself: the owner tables and record offsets. Unlike a per-user store, a
+        search only pages in the vectors of one owner, which stay in the OS page cache.
+        """
+        return sum(owners.nbytes + owner_offsets.nbytes + segment._offsets.nbytes
+                   for segment, owners, owner_offsets in self.segments)
+
+    def for_owner(self, owner_id: int) -> "TenantVectorStore":
+        if owner_id is None:
+            raise ValueError("Searching a shared vector shard needs the id of the user")
+        return TenantVectorStore(self, owner_id)
+
+
+class TenantVectorStore(ReadOnlyVectorStore):
+    """The vectors of one user in a shard: every search is restricted to the rows of `owner_id`."""
+
+    def __init__(self, shard: VectorShard, owner_id: int):
+        self.shard = shard
+        self.owner_id = owner_id
+        self._embeddings = shard._embeddings
+        self.distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+        if shard.segments:
+            self.distance_strategy = shard.segments[0][0].distance_strategy
+
+    def index_version(self):
+        """
+        Changes whenever the owner's vectors change: a segment with their vectors is added or merged, or a
+        vector of the shard is deleted (tombstones are kept per shard).
+        """
+        self.shard.refresh()
+        segments = []
+        for segment, owners, owner_offsets in self.shard.segments:
+            row_range = _owner_range(owners, owner_offsets, self.owner_id)
+            if row_range is not None:
+                segments.append((segment.folder_path, row_range))
+        return tuple(segments), self.shard._tombstones_mtime
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        return self.similarity_search_with_score_by_vectors([embedding], k, filter, fetch_k, **kwargs)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, filter=None, fetch_k=20, **kwargs):
+        self.shard.refresh()
+        tombstones = self.shard.tombstones
+        hits = [[] for _ in embeddings]
+        for segment, owners, owner_offsets in self.shard.segments:
+            row_range = _owner_range(owners, owner_offsets, self.owner_id)
+            if row_range is None:
+                continue
+            vectors = np.array(embeddings, dtype=np.float32)
+            if segment._normalize_L2:
+                faiss.normalize_L2(vectors)
+            # Fetch enough extra candidates to still have k live ones after skipping the tombstoned vectors.
+            search_k = (k if filter is None else fetch_k) + len(tombstones)
+            all_scores, all_rows = segment._search(vectors, search_k, row_range=row_range)
+            for query_hits, scores, rows in zip(hits, all_scores, all_rows):
+                query_hits.extend((float(score), segment, int(row)) for score, row in zip(scores, rows) if row != -1)
+        reverse = self.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+        for query_hits in hits:
+            query_hits.sort(key=lambda hit: hit[0], reverse=reverse)
+        return [select_documents(query_hits, k, tombstones, filter, kwargs.get("score_threshold"),
+                                 self.distance_strategy)
+                for query_hits in hits]
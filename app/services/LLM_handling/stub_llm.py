@@ -0,0 +1,91 @@
+import re
+import time
+from types import SimpleNamespace
+
+# Value of LLM_MODEL_PATH that loads StubModel instead of a GGUF file.
+STUB_MODEL = "stub"
+
+_PIECE = re.compile(r"\s*\S+|\s+")
+
+
+class StubModel:
+    """
+    Tiny stand-in for a ctransformers model, for tests and benchmarks without the GGUF file.
+
+    It implements the part of the ctransformers `LLM` API the app uses (tokenize, detokenize, eval,
+    generate, prepare_inputs_for_generation, reset, context_length, config), including the reuse of the
+    context prefix shared with the previous prompt. Tokens are whitespace-separated words. Evaluating
+    prompt tokens and generating answer tokens sleep for a configurable time per token, so latencies
+    scale like a real model's without using any CPU. The answer repeats the words of the question.
+    """
+
+    def __init__(self, max_new_tokens: int = 256, context_length: int = 4096, stop=None,
+                 prefill_seconds_per_token: float = 0.0002, seconds_per_token: float = 0.02,
+                 answer_tokens: int = 16):
+        self.config = SimpleNamespace(max_new_tokens=max_new_tokens, context_length=context_length, stop=stop,
+                                      reset=True)
+        self.prefill_seconds_per_token = prefill_seconds_per_token
+        self.seconds_per_token = seconds_per_token
+        self.answer_tokens = answer_tokens
+        self._pieces = ["<s>", "</s>"]
+        self._ids = {"<s>": 0, "</s>": 1}
+        self._context = []
+
+    @property
+    def bos_token_id(self) -> int:
+        return 0
+
+    @property
+    def eos_token_id(self) -> int:
+        return 1
+
+    @property
+    def context_length(self) -> int:
+        return self.config.context_length
+
+    def is_eos_token(self, token: int) -> bool:
+        return token == self.eos_token_id
+
+    def tokenize(self, text: str, add_bos_token: bool = None) -> list:
+        tokens = [self.bos_token_id] if add_bos_token is None or add_bos_token else []
+        for piece in _PIECE.findall(text):
+            if piece not in self._ids:
+                self._ids[piece] = len(self._pieces)
+                self._pieces.append(piece)
+            tokens.append(self._ids[piece])
+        return tokens
+
+    def detokenize(self, tokens, decode: bool = True):
+        if isinstance(tokens, int):
+            tokens = [tokens]
+        text = "".join(self._pieces[token] for token in tokens if token > self.eos_token_id)
+        return text if decode else text.encode()
+
+    def reset(self):
+        self._context.clear()
+
+    def prepare_inputs_for_generation(self, tokens, reset: bool = None):
+        """Same as ctransformers: drop the tokens already in the context, keep at least one."""
+        if reset is False:
+            return tokens
+        n = min(len(tokens) - 1, len(self._context))
+        common = 0
+        while common < n and tokens[common] == self._context[common]:
+            common += 1
+        self._context = self._context[:common]
+        return tokens[common:]
+
+    def eval(self, tokens, batch_size: int = None, threads: int = None):
+        time.sleep(self.prefill_seconds_per_token * len(tokens))
+        self._context.extend(tokens)
+
+    def generate(self, tokens, reset: bool = None, **kwargs):
+        tokens = self.prepare_inputs_for_generation(tokens, reset=reset)
+        self.eval(tokens)
+        question = self.detokenize(self._context).rsplit("Question:", 1)[-1].split("\n", 1)[0].split() or ["stub"]
+        for position in range(self.answer_tokens):
+            time.sleep(self.seconds_per_token)
+            token = self.tokenize(" " + question[position % len(question)], add_bos_token=False)[0]
+            self._context.append(token)
+            yield token
+        self._context.append(self.eos_token_id)
@@ -0,0 +1,108 @@
+"""
+Stub OpenAI-compatible inference server, to run the remote LLM backend (remote_llm.py) without a GPU server.
+
+It serves /v1/completions and /v1/chat/completions, streamed (server-sent events) or not, with answers
+generated by StubModel: they repeat the words of the question and take a configurable time per token.
+Run it next to the API:
+    uvicorn app.services.LLM_handling.stub_server:app --port 8001
+and start the API with LLM_BACKEND=remote (REMOTE_LLM_BASE_URL defaults to http://localhost:8001/v1).
+
+STUB_SERVER_FAILURE_RATE (0 to 1) answers that share of the requests with a 503, to exercise the retries.
+/tokenize and /detokenize work like the llama.cpp server's, for REMOTE_LLM_TOKENIZER=server.
+"""
+import json
+import os
+import random
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.services.LLM_handling.stub_llm import StubModel
+
+FAILURE_RATE = float(os.environ.get("STUB_SERVER_FAILURE_RATE", "0"))
+SECONDS_PER_TOKEN = float(os.environ.get("STUB_SERVER_SECONDS_PER_TOKEN", "0.02"))
+
+app = FastAPI(title="Stub inference server")
+
+# The stub tokenizer numbers pieces of text as it sees them, so one instance serves every tokenize request.
+_tokenizer = StubModel()
+
+
+def _generate(prompt: str, max_tokens: int, stop):
+    """Pieces of the answer, one per token, cut at the first stop sequence."""
+    model = StubModel(seconds_per_token=SECONDS_PER_TOKEN, answer_tokens=max_tokens)
+    stop = [stop] if isinstance(stop, str) else stop or []
+    text = ""
+    for token in model.generate(model.tokenize(prompt)):
+        piece = model.detokenize([token])
+        text += piece
+        if any(sequence in text for sequence in stop):
+            return
+        yield piece
+
+
+async def _handle(body: dict, chat: bool):
+    if FAILURE_RATE and random.random() < FAILURE_RATE:
+        return JSONResponse({"error": {"message": "Overloaded"}}, status_code=503, headers={"Retry-After": "0"})
+    if chat:
+        prompt = "\n".join(message["content"] for message in body["messages"])
+    else:
+        prompt = body["prompt"]
+    max_tokens = body.get("max_tokens") or 16
+    completion_id = f"cmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def _choice(text: str, finished: bool) -> dict:
+        choice = {"index": 0, "finish_reason": "stop" if finished else None}
+        if chat:
+            choice["delta" if body.get("stream") else "message"] = {"role": "assistant", "content": text}
+        else:
+            choice["text"] = text
+        return choice
+
+    def _chunk(text: str, finished: bool = False) -> str:
+        return "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk" if chat
+                                      else "text_completion", "created": created, "model": body.get("model"),
+                                      "choices": [_choice(text, finished)]}) + "\n\n"
+
+    if body.get("stream"):
+        def _events():
+            # A sync generator: StreamingResponse iterates it on a worker thread, so the sleeps don't block.
+            for piece in _generate(prompt, max_tokens, body.get("stop")):
+                yield _chunk(piece)
+            yield _chunk("", finished=True)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_events(), media_type="text/event-stream")
+
+    text = await run_in_threadpool(lambda: "".join(_generate(prompt, max_tokens, body.get("stop"))))
+    return {"id": completion_id, "object": "chat.completion" if chat else "text_completion", "created": created,
+            "model": body.get("model"), "choices": [_choice(text, True)]}
+
+
+@app.get("/v1/models")
+def list_models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+
+
+@app.post("/v1/completions")
+async def completions(request: Request):
+    return await _handle(await request.json(), chat=False)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    return await _handle(await request.json(), chat=True)
+
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    body = await request.json()
+    return {"tokens": _tokenizer.tokenize(body["content"], add_bos_token=body.get("add_special", True))}
+
+
+@app.post("/detokenize")
+async def detokenize(request: Request):
+    body = await request.json()
+    return {"content": _tokenizer.detokenize(body["tokens"])}
@@ -0,0 +1,181 @@
+import json
+import os
+import numpy as np
+from filelock import FileLock
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+
+def _tombstones_path(db_faiss_path) -> str:
+    return os.path.join(str(db_faiss_path), "tombstones.json")
+
+
+def tombstones_lock(db_faiss_path) -> FileLock:
+    # Separate from the store lock, so deleting a file never waits for a long running ingestion.
+    return FileLock(str(db_faiss_path) + ".tombstones.lock")
+
+
+def read_tombstones(db_faiss_path) -> set:
+    """Return the ids of the vectors that were deleted but are still physically in the index."""
+    try:
+        with open(_tombstones_path(db_faiss_path)) as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        return set()
+
+
+def _write_tombstones(db_faiss_path, ids):
+    os.makedirs(str(db_faiss_path), exist_ok=True)
+    tmp_path = _tombstones_path(db_faiss_path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(ids), f)
+    os.replace(tmp_path, _tombstones_path(db_faiss_path))
+
+
+def add_tombstones(db_faiss_path, ids) -> int:
+    """
+    Mark vectors as deleted. They stop showing up in searches right away and are removed from
+    the index by the next compaction.
+
+    Args:
+        db_faiss_path (str): Folder of the user's FAISS store.
+        ids (Iterable[str]): Docstore ids of the deleted vectors.
+
+    Returns:
+        int: The number of tombstoned vectors waiting for compaction.
+    """
+    with tombstones_lock(db_faiss_path):
+        tombstones = read_tombstones(db_faiss_path) | set(ids)
+        _write_tombstones(db_faiss_path, tombstones)
+        return len(tombstones)
+
+
+def forget_tombstones(db_faiss_path, ids=None):
+    """
+    Drop tombstones once the saved index no longer contains their vectors.
+
+    Args:
+        db_faiss_path (str): Folder of the user's FAISS store.
+        ids (Iterable[str], optional): The tombstones to drop, all of them if None (e.g. after a full rebuild).
+    """
+    with tombstones_lock(db_faiss_path):
+        remaining = read_tombstones(db_faiss_path) - set(ids) if ids is not None else set()
+        _write_tombstones(db_faiss_path, remaining)
+
+
+def apply_tombstones(db, db_faiss_path) -> set:
+    """
+    Physically remove the tombstoned vectors from a loaded store. The caller holds the store lock, saves
+    the store and then passes the returned ids to `forget_tombstones`, so a crash before the save loses nothing.
+
+    Args:
+        db (FAISS): The loaded store of `db_faiss_path`.
+        db_faiss_path (str): Folder of the user's FAISS store.
+
+    Returns:
+        set: The tombstones handled, including ids that were already gone from the index.
+    """
+    tombstones = read_tombstones(db_faiss_path)
+    present = tombstones & set(db.index_to_docstore_id.values())
+    if present:
+        db.delete(list(present))
+        print(f"Removed {len(present)} deleted vectors from {db_faiss_path}")
+    return tombstones
+
+
+class TombstoneFilter:
+    """
+    Mixin for user stores that hides the vectors of deleted files until the index is compacted.
+
+    Deleting a file only adds its vector ids to `tombstones.json` next to the index. Searches call
+    `refresh_tombstones`, which re-reads that file when it changes, and skip tombstoned vectors, so
+    a delete takes effect immediately without rewriting the index.
+    """
+
+    folder_path = None
+    tombstones = frozenset()
+    _tombstones_mtime = None
+
+    def refresh_tombstones(self):
+        if self.folder_path is None:
+            return
+        try:
+            mtime = os.path.getmtime(_tombstones_path(self.folder_path))
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._tombstones_mtime:
+            self.tombstones = frozenset(read_tombstones(self.folder_path))
+            self._tombstones_mtime = mtime
+
+
+def passes_score_threshold(score: float, score_threshold, distance_strategy) -> bool:
+    # Same comparison as FAISS: distances must be small enough, similarities big enough.
+    if score_threshold is None:
+        return True
+    if distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD):
+        return score >= score_threshold
+    return score <= score_threshold
+
+
+class UserVectorStore(TombstoneFilter, FAISS):
+    """In-memory FAISS store of one user, used to build and update the index and to read legacy stores."""
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, **kwargs):
+        db = super().load_local(folder_path, embeddings, **kwargs)
+        db.folder_path = str(folder_path)
+        db.refresh_tombstones()
+        return db
+
+    def index_version(self):
+        """Changes whenever the searchable content of the store changes (a rewrite or a delete)."""
+        self.refresh_tombstones()
+        index_mtime = None
+        if self.folder_path is not None and os.path.exists(os.path.join(self.folder_path, "index.faiss")):
+            index_mtime = os.path.getmtime(os.path.join(self.folder_path, "index.faiss"))
+        return index_mtime, self._tombstones_mtime
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        self.refresh_tombstones()
+        if not self.tombstones:
+            return super().similarity_search_with_score_by_vector(embedding, k, filter, fetch_k, **kwargs)
+        return self.similarity_search_with_score_by_vectors([embedding], k, filter, fetch_k, **kwargs)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, filter=None, fetch_k=20, **kwargs):
+        """
+        `similarity_search_with_score_by_vector` for several query vectors at once, with a single
+        multi-query faiss search. Returns one result list per query.
+        """
+        self.refresh_tombstones()
+        # Fetch enough extra candidates to still have k live ones after skipping the tombstoned vectors.
+        tombstones = self.tombstones
+        vectors = np.array(embeddings, dtype=np.float32)
+        if self._normalize_L2:
+            import faiss
+            faiss.normalize_L2(vectors)
+        search_k = min((k if filter is None else fetch_k) + len(tombstones), self.index.ntotal)
+        if search_k == 0:
+            return [[] for _ in embeddings]
+        all_scores, all_indices = self.index.search(vectors, search_k)
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        score_threshold = kwargs.get("score_threshold")
+
+        results = []
+        for scores, indices in zip(all_scores, all_indices):
+            docs = []
+            for score, i in zip(scores, indices):
+                if i == -1:
+                    continue
+                doc_id = self.index_to_docstore_id[i]
+                if doc_id in tombstones:
+                    continue
+                doc = self.docstore.search(doc_id)
+                if not isinstance(doc, Document):
+                    raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+                if filter_func is None or filter_func(doc.metadata):
+                    docs.append((doc, score))
+            docs = [(doc, score) for doc, score in docs
+                    if passes_score_threshold(score, score_threshold, self.distance_strategy)]
+            results.append(docs[:k])
+        return results
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from app.core.config import settings
+
+
+def _estimate_size(db) -> int:
+    """Approximate in-memory size of a loaded FAISS store: the vector codes plus the docstore text."""
+    if hasattr(db, "memory_size"):
+        return db.memory_size()
+    index = db.index
+    code_size = getattr(index, "code_size", index.d * 4)
+    size = index.ntotal * code_size
+    for doc in getattr(db.docstore, "_dict", {}).values():
+        size += len(doc.page_content) + len(str(doc.metadata))
+    return size
+
+
+class VectorStoreCache:
+    """
+    In-process LRU cache of loaded per-user vector stores, keyed by the store path inside the user folder.
+
+    Entries are evicted least-recently-used first once the estimated size of all cached stores
+    goes over `max_bytes`. A store bigger than the whole budget is never cached.
+
+    Every path has an invalidation counter: a store loaded on a miss is only cached if the path wasn't
+    invalidated while it was loading, otherwise it may be the store from before the write.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # db_faiss_path -> (store, size in bytes)
+        self._current_bytes = 0
+        self._invalidations = {}  # db_faiss_path -> times it was invalidated
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, db_faiss_path: str, loader):
+        """
+        Return the cached store for `db_faiss_path`, loading it with `loader(db_faiss_path)` on a miss.
+
+        Args:
+            db_faiss_path (str): Folder of the user's FAISS store.
+            loader (Callable): Function that loads the store from disk.
+
+        Returns:
+            FAISS: The loaded vector store.
+        """
+        with self._lock:
+            entry = self._entries.get(db_faiss_path)
+            if entry is not None:
+                self._entries.move_to_end(db_faiss_path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            invalidations = self._invalidations.get(db_faiss_path, 0)
+
+        # Load outside of the lock so a slow disk read doesn't block queries of other users.
+        db = loader(db_faiss_path)
+        self.put(db_faiss_path, db, invalidations=invalidations)
+        return db
+
+    def put(self, db_faiss_path: str, db, invalidations: int = None):
+        """
+        Add or refresh the cached store for `db_faiss_path` (e.g. after the index was rewritten).
+
+        Args:
+            db_faiss_path (str): Folder of the user's FAISS store.
+            db (FAISS): The loaded vector store.
+            invalidations (int, optional): The invalidation count of the path when `db` started loading,
+                                           the store is not cached if it changed since.
+        """
+        size = _estimate_size(db)
+        with self._lock:
+            if invalidations is not None and self._invalidations.get(db_faiss_path, 0) != invalidations:
+                return
+            self._pop(db_faiss_path)
+            if size > self.max_bytes:
+                return
+            self._entries[db_faiss_path] = (db, size)
+            self._current_bytes += size
+            while self._current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, db_faiss_path: str):
+        """Drop the cached store for `db_faiss_path`, so the next query reloads it from disk."""
+        with self._lock:
+            self._invalidations[db_faiss_path] = self._invalidations.get(db_faiss_path, 0) + 1
+            self._pop(db_faiss_path)
+
+    def _pop(self, db_faiss_path: str):
+        entry = self._entries.pop(db_faiss_path, None)
+        if entry is not None:
+            self._current_bytes -= entry[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "current_bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+vector_store_cache = VectorStoreCache(max_bytes=settings.VECTOR_STORE_CACHE_MAX_BYTES)
@@ -0,0 +1,222 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from app.core.config import settings
+from app.db import models, crud
+from app.db.database import SessionLocal
+from app.services.LLM_handling.vector_store_cache import vector_store_cache
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+def _update_job(job_id: str, only_if_status: str = None, **fields) -> bool:
+    """
+    Update an ingestion job row from a worker process.
+
+    Args:
+        job_id (str): The id of the job to update.
+        only_if_status (str, optional): Only update the row if the job currently has this status.
+        **fields: Column values to set.
+
+    Returns:
+        bool: True if the row was updated.
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(models.IngestionJob).filter(models.IngestionJob.id == job_id)
+        if only_if_status is not None:
+            query = query.filter(models.IngestionJob.status == only_if_status)
+        updated = query.update({**fields, "updated_at": datetime.now(timezone.utc)}, synchronize_session=False)
+        db.commit()
+        return updated > 0
+    finally:
+        db.close()
+
+
+def _record_vector_ids(user_id: int, db_faiss_path: str, vector_ids: dict):
+    """
+    Store the ids of the new vectors on the user's `files` rows, so deleting a file can remove them later.
+
+    Vectors of a file whose row was deleted while it was being indexed are tombstoned right away.
+    """
+    from app.services.LLM_handling.vector_store import add_tombstones
+    orphaned_ids = []
+    db = SessionLocal()
+    try:
+        files = db.query(models.File).filter(models.File.user_id == user_id).order_by(models.File.id).all()
+        files_by_name = {}
+        for db_file in files:
+            files_by_name.setdefault(db_file.filename, []).append(db_file)
+        for file_name, ids in vector_ids.items():
+            db_files = files_by_name.get(file_name)
+            if not db_files:
+                orphaned_ids.extend(ids)
+                continue
+            # Older uploads could leave several rows with the same name, the newest one owns the vectors.
+            for db_file in db_files[:-1]:
+                db_file.vector_ids = []
+            db_files[-1].vector_ids = ids
+        db.commit()
+    finally:
+        db.close()
+    if orphaned_ids:
+        add_tombstones(db_faiss_path, orphaned_ids)
+
+
+def _init_worker():
+    # Load the embedding model once per worker process instead of once per job.
+    from app.services.LLM_handling.embedding_registry import embedding_registry
+    embedding_registry.load()
+
+
+def _run_ingestion_job(job_id: str, user_id: int, file_path: str, user_folder: str, db_faiss_path: str):
+    """Index one uploaded file. Runs inside a worker process of the ingestion pool."""
+    from app.services.LLM_handling.embedding import add_file_to_shard, add_file_to_vector_db
+    from app.services.LLM_handling.sharded_store import BACKEND_SHARDED
+
+    # Claim the job, so a job that was queued twice (e.g. after a restart) is only indexed once.
+    if not _update_job(job_id, only_if_status=JOB_QUEUED, status=JOB_RUNNING, progress=0.0):
+        return
+    try:
+        progress_callback = lambda progress: _update_job(job_id, progress=progress)
+        if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+            stats = add_file_to_shard(file_path, user_id, db_faiss_path, progress_callback=progress_callback)
+        else:
+            stats = add_file_to_vector_db(file_path, user_folder, db_faiss_path, progress_callback=progress_callback)
+        _record_vector_ids(user_id, db_faiss_path, stats["vector_ids"])
+    except Exception as e:
+        print(f"Ingestion job {job_id} failed: {e}")
+        _update_job(job_id, status=JOB_FAILED, error=str(e))
+        return
+    print(f"Ingestion job {job_id} done, embedding cache hit ratio = {stats['embedding_cache_hit_ratio']:.2f}")
+    _update_job(job_id, status=JOB_SUCCEEDED, progress=1.0,
+                embedding_cache_hit_ratio=stats["embedding_cache_hit_ratio"])
+
+
+def _run_compaction(db_faiss_path: str):
+    """Rewrite a user store without its tombstoned vectors. Runs inside a worker process of the ingestion pool."""
+    from app.services.LLM_handling.embedding import compact_shard, compact_vector_db
+    from app.services.LLM_handling.sharded_store import BACKEND_SHARDED
+    try:
+        if settings.VECTOR_STORE_BACKEND == BACKEND_SHARDED:
+            remaining = compact_shard(db_faiss_path)
+        else:
+            remaining = compact_vector_db(db_faiss_path)
+    except Exception as e:
+        print(f"Compaction of {db_faiss_path} failed: {e}")
+        return
+    print(f"Compacted {db_faiss_path}, {remaining} vectors left")
+
+
+def _run_index_build(db_faiss_path: str):
+    """Build the approximate index of a user store. Runs inside a worker process of the ingestion pool."""
+    from app.services.LLM_handling.embedding import rebuild_vector_index
+    try:
+        rebuild_vector_index(db_faiss_path)
+    except Exception as e:
+        print(f"Building the index of {db_faiss_path} failed: {e}")
+
+
+class IngestionQueue:
+    """
+    Bounded pool of worker processes that index uploaded files in the background.
+
+    Jobs are persisted in the `ingestion_jobs` table before they are submitted, so work that was
+    queued or running when the server stopped is picked up again by `start()`.
+
+    The same pool runs store maintenance: compactions after deletes, and (re)builds of the approximate
+    index after every change of a store that is big enough to need one.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pending = set()
+        self._store_tasks = set()  # (task name, db_faiss_path) of the maintenance tasks queued or running
+        self._lock = threading.Lock()
+
+    async def start(self):
+        # "spawn" gives every worker a clean interpreter instead of forking the API process with its loaded models.
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker)
+        db = SessionLocal()
+        try:
+            unfinished_jobs = await crud.get_unfinished_ingestion_jobs(db)
+            for job in unfinished_jobs:
+                # A job that was running when the server stopped is started again from scratch.
+                job.status = JOB_QUEUED
+                job.progress = 0.0
+            db.commit()
+            for job in unfinished_jobs:
+                self.submit(job)
+            if unfinished_jobs:
+                print(f"Resumed {len(unfinished_jobs)} unfinished ingestion jobs")
+        finally:
+            db.close()
+
+    def submit(self, job: models.IngestionJob):
+        """Queue an ingestion job row for indexing in a worker process."""
+        future = self._executor.submit(_run_ingestion_job, job.id, job.user_id, job.file_path, job.user_folder,
+                                       job.db_faiss_path)
+        self._track(future, job.db_faiss_path, rebuild_index=True)
+
+    def submit_compaction(self, db_faiss_path: str):
+        """Queue a rewrite of a user store without its tombstoned vectors, unless one is already queued."""
+        self._submit_store_task(_run_compaction, db_faiss_path, rebuild_index=True)
+
+    def submit_index_build(self, db_faiss_path: str):
+        """Queue a build of the approximate index of a user store, unless one is already queued."""
+        self._submit_store_task(_run_index_build, db_faiss_path)
+
+    def _submit_store_task(self, task, db_faiss_path: str, rebuild_index: bool = False):
+        key = (task.__name__, db_faiss_path)
+        with self._lock:
+            if key in self._store_tasks or self._executor is None:
+                return
+            self._store_tasks.add(key)
+        try:
+            future = self._executor.submit(task, db_faiss_path)
+        except RuntimeError:
+            # The pool is shutting down.
+            with self._lock:
+                self._store_tasks.discard(key)
+            return
+        self._track(future, db_faiss_path, rebuild_index=rebuild_index, store_task=key)
+
+    def _track(self, future, db_faiss_path: str, rebuild_index: bool = False, store_task: tuple = None):
+        with self._lock:
+            self._pending.add(future)
+
+        def _on_done(done_future):
+            from app.services.LLM_handling.sharded_store import BACKEND_SHARDED
+            with self._lock:
+                self._pending.discard(done_future)
+                self._store_tasks.discard(store_task)
+            # The worker rewrote the index on disk, so the next query must reload it.
+            vector_store_cache.invalidate(db_faiss_path)
+            # Shard segments are only scanned one owner range at a time, they never get an approximate index.
+            if rebuild_index and not done_future.cancelled() and settings.VECTOR_STORE_BACKEND != BACKEND_SHARDED:
+                # The new rows are searchable right away with an exact scan, the approximate index follows.
+                self.submit_index_build(db_faiss_path)
+
+        future.add_done_callback(_on_done)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"max_workers": self.max_workers, "pending_jobs": len(self._pending),
+                    "pending_compactions": sum(1 for name, _ in self._store_tasks if name == _run_compaction.__name__),
+                    "pending_index_builds": sum(1 for name, _ in self._store_tasks
+                                                if name == _run_index_build.__name__)}
+
+
+ingestion_queue = IngestionQueue(max_workers=settings.INGESTION_WORKERS)
@@ -0,0 +1,165 @@
+import gc
+import importlib
+import threading
+import time
+from app.core.config import settings
+
+COMPONENT_LOADING = "loading"
+COMPONENT_READY = "ready"
+COMPONENT_FAILED = "failed"
+
+# Retry-After (seconds) of the 503 responses sent while a model is still loading
+LOADING_RETRY_AFTER_SECONDS = 5
+
+_COMPONENT_NAMES = {"embeddings": "embedding model", "llm": "LLM"}
+
+
+class ModelNotReady(Exception):
+    """Raised when a request needs a model that is still loading, or that failed to load."""
+
+    def __init__(self, component: str, status: str, error: str = None):
+        if status == COMPONENT_FAILED:
+            message = f"The {_COMPONENT_NAMES[component]} failed to load: {error}"
+        else:
+            message = f"The {_COMPONENT_NAMES[component]} is still loading, please retry later."
+        super().__init__(message)
+        self.component = component
+        self.status = status
+        self.retry_after = LOADING_RETRY_AFTER_SECONDS
+
+
+class ModelLoader:
+    """
+    Loads the embedding model and the LLM on a background thread after the server has started.
+
+    Loading the GGUF weights and importing the ML libraries (langchain, FAISS, torch) takes long, so the
+    server accepts requests (health checks, logins, uploads) right away and only the routes that need a
+    model answer 503 until it is loaded. Those libraries are first imported by this thread too: the API
+    modules only import them inside the functions that use them.
+
+    The embedding model is loaded first, since /search only needs it, then the LLM (or the LLM replica
+    pool when LLM_REPLICAS is set, or the client of the inference server with LLM_BACKEND = "remote").
+    """
+
+    def __init__(self):
+        self.llm = None
+        self._components = {name: {"status": COMPONENT_LOADING, "seconds": None, "error": None}
+                            for name in ("embeddings", "llm")}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._embedding_registry = None
+        self._replica_pool = None
+        self._remote_client = None
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        """Start loading the models in the background, this returns right away."""
+        self.started_at = time.perf_counter()
+        # A daemon thread, so stopping the server while a model loads doesn't wait for it.
+        self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        self._load_component("embeddings", self._load_embeddings)
+        self._load_component("llm", self._load_llm)
+        self.finished_at = time.perf_counter()
+
+    def _load_component(self, name: str, load):
+        started_at = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            print(f"Loading the {_COMPONENT_NAMES[name]} failed: {e}")
+            with self._lock:
+                self._components[name].update(status=COMPONENT_FAILED, error=str(e))
+            return
+        seconds = time.perf_counter() - started_at
+        print(f"{_COMPONENT_NAMES[name]} loaded in {seconds:.2f}s")
+        with self._lock:
+            self._components[name].update(status=COMPONENT_READY, seconds=round(seconds, 3))
+
+    def _load_embeddings(self):
+        # Importing querying brings in langchain and FAISS, so the routes that import it lazily find it loaded.
+        importlib.import_module("app.services.LLM_handling.querying")
+        from app.services.LLM_handling.embedding_registry import embedding_registry
+        self._embedding_registry = embedding_registry
+        # Load the embedding model once so every request reuses the same instance
+        embedding_registry.load()
+
+    def _load_llm(self):
+        from app.services.LLM_handling.querying import prompt_static_prefix
+        from app.services.LLM_handling.remote_llm import LLM_BACKEND_REMOTE, remote_llm_client
+        if settings.LLM_BACKEND == LLM_BACKEND_REMOTE:
+            # Nothing to load, answers are generated by the inference server
+            from app.services.LLM_handling.llm_loader import load_llm
+            self._remote_client = remote_llm_client
+            remote_llm_client.load_tokenizer()
+            self.llm = load_llm(local=False)
+        # The instructions every prompt starts with are kept evaluated in the model
+        elif settings.LLM_REPLICAS > 0:
+            # Every replica process loads its own copy, queries go to the least loaded one
+            from app.services.LLM_handling.llm_pool import llm_replica_pool
+            self._replica_pool = llm_replica_pool
+            self.llm = llm_replica_pool.start(static_prefix=prompt_static_prefix())
+        else:
+            from app.services.LLM_handling.llm_loader import load_llm
+            self.llm = load_llm(local=True, static_prefix=prompt_static_prefix())
+
+    def require(self, *components: str):
+        """
+        Check that models are loaded.
+
+        Raises:
+            ModelNotReady: If one of `components` ("embeddings", "llm") is still loading or failed to load.
+        """
+        with self._lock:
+            for name in components:
+                component = self._components[name]
+                if component["status"] != COMPONENT_READY:
+                    raise ModelNotReady(name, component["status"], component["error"])
+
+    def get_llm(self):
+        """
+        The loaded LLM, once the embedding model it is queried with is loaded too.
+
+        Raises:
+            ModelNotReady: If one of them is still loading or failed to load.
+        """
+        self.require("embeddings", "llm")
+        return self.llm
+
+    def shutdown(self):
+        if self._replica_pool is not None:
+            self._replica_pool.shutdown()
+        if self._remote_client is not None:
+            self._remote_client.close()
+        if self._embedding_registry is not None:
+            self._embedding_registry.unload_all()
+        if self.llm is not None:
+            print("Unloading the LLM...")
+            self.llm = None  # Dereference the LLM
+            gc.collect()  # Force garbage collection to free memory
+            print("LLM unloaded successfully")
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [component["status"] for component in self._components.values()]
+            if COMPONENT_FAILED in statuses:
+                status = COMPONENT_FAILED
+            elif all(status == COMPONENT_READY for status in statuses):
+                status = COMPONENT_READY
+            else:
+                status = COMPONENT_LOADING
+            load_seconds = None
+            if self.started_at is not None:
+                load_seconds = round((self.finished_at or time.perf_counter()) - self.started_at, 3)
+            return {
+                "status": status,
+                # Time spent loading so far, or until the last model was loaded
+                "load_seconds": load_seconds,
+                "components": {name: dict(component) for name, component in self._components.items()},
+            }
+
+
+model_loader = ModelLoader()
@@ -0,0 +1,90 @@
+"""
+Throughput and latency of concurrent questions answered by pools of LLM replica processes
+(llm_pool.py) against the single model in the API process.
+
+Run from the repository root with the local model in place (the app settings are read from .env as usual):
+    python -m benchmarks.bench_llm_replicas --replicas 0 1 2 4 --questions 32 --concurrency 8
+
+`--replicas 0` is the single in-process model, which runs one generation at a time like the inference
+executor does with LLM_MAX_CONCURRENCY = 1. Replica threads default to the cores split evenly between them.
+
+`--stub` uses the stub model instead of the GGUF file (LLM_MODEL_PATH=stub). It sleeps instead of
+computing, so it measures the dispatch overhead and the load balancing of the pool, not the CPU scaling.
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def make_prompts(count: int) -> list:
+    from app.services.LLM_handling.querying import set_custom_prompt
+    prompt = set_custom_prompt()
+    context = ("The customer may cancel an annual subscription within 30 days of payment and get a full refund. "
+               "After that period the subscription runs until the end of the contract term.")
+    return [prompt.format(context=f"{context} (section {number})",
+                          question=f"What does section {number} say about refunds?")
+            for number in range(count)]
+
+
+def run(llm, prompts: list, concurrency: int, max_new_tokens: int, lock=None) -> dict:
+    def _answer(prompt):
+        started_at = time.perf_counter()
+        if lock is None:
+            llm.invoke(prompt, max_new_tokens=max_new_tokens)
+        else:
+            with lock:
+                llm.invoke(prompt, max_new_tokens=max_new_tokens)
+        return time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(_answer, prompts))
+    elapsed = time.perf_counter() - started_at
+    return {"throughput": len(prompts) / elapsed, "p50": statistics.median(latencies),
+            "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Pool sizes, 0 is the in-process model")
+    parser.add_argument("--questions", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8, help="Questions sent at the same time")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="Tokens generated per question")
+    parser.add_argument("--threads", type=int, default=0, help="Threads per replica, 0 splits the cores evenly")
+    parser.add_argument("--stub", action="store_true", help="Use the stub model instead of the GGUF file")
+    args = parser.parse_args()
+
+    if args.stub:
+        # Read by the settings of this process and of the spawned replicas.
+        os.environ["LLM_MODEL_PATH"] = "stub"
+    from app.services.LLM_handling.llm_loader import load_llm
+    from app.services.LLM_handling.llm_pool import LLMReplicaPool
+    from app.services.LLM_handling.querying import prompt_static_prefix
+
+    prompts = make_prompts(args.questions)
+    print(f"{args.questions} questions, {args.concurrency} at a time, {args.max_new_tokens} tokens each, "
+          f"{os.cpu_count()} cores")
+    print(f"{'replicas':>8} {'questions/s':>12} {'p50 s':>8} {'p95 s':>8} {'utilisation':>24}")
+    for replicas in args.replicas:
+        if replicas == 0:
+            llm = load_llm(local=True, static_prefix=prompt_static_prefix())
+            result = run(llm, prompts, args.concurrency, args.max_new_tokens, lock=threading.Lock())
+            utilisation = ""
+        else:
+            pool = LLMReplicaPool(replicas, threads=args.threads)
+            llm = pool.start(static_prefix=prompt_static_prefix())
+            try:
+                result = run(llm, prompts, args.concurrency, args.max_new_tokens)
+                utilisation = " ".join(f"{replica['utilization']:.2f}" for replica in pool.stats()["per_replica"])
+            finally:
+                pool.shutdown()
+        print(f"{replicas:>8} {result['throughput']:>12.2f} {result['p50']:>8.2f} {result['p95']:>8.2f} "
+              f"{utilisation:>24}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Disk size, scanned memory, search latency and recall@k of user stores saved in float32, float16 and
+int8 precision, with and without float32 re-scoring.
+
+Run from the repository root:
+    python -m benchmarks.bench_precision --chunks 100000
+
+Vectors are synthetic unit-length vectors drawn around a few hundred topics, like sentence embeddings
+of a document corpus. Recall is measured against exact float32 search.
+"""
+import argparse
+import os
+import tempfile
+import time
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+from app.services.LLM_handling.mapped_store import MappedVectorStore, save_store
+from app.services.LLM_handling.vector_store import UserVectorStore
+
+DIM = 384  # all-MiniLM-L6-v2
+
+MODES = [
+    # (label, precision, keep float32 vectors, rescore factor)
+    ("float32", "float32", True, 1),
+    ("float16", "float16", False, 1),
+    ("float16+rescore", "float16", True, 4),
+    ("int8", "int8", False, 1),
+    ("int8+rescore", "int8", True, 4),
+]
+
+
+def synthetic_vectors(count: int, rng) -> np.ndarray:
+    topics = rng.standard_normal((max(1, count // 200), DIM), dtype=np.float32)
+    vectors = topics[rng.integers(0, len(topics), count)] + 0.6 * rng.standard_normal((count, DIM), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build_store(vectors: np.ndarray) -> UserVectorStore:
+    index = faiss.IndexFlatL2(DIM)
+    index.add(vectors)
+    docs = {str(row): Document(page_content=f"chunk {row}", metadata={"page": row}) for row in range(len(vectors))}
+    return UserVectorStore(None, index, InMemoryDocstore(docs), {row: str(row) for row in range(len(vectors))})
+
+
+def _folder_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+               if name.startswith(("vectors.", "codes.")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic_vectors(args.chunks, rng)
+    queries = vectors[rng.choice(args.chunks, args.queries, replace=False)]
+    queries = queries + 0.3 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(DIM)
+    _, exact_rows = faiss.knn(queries, vectors, args.k)
+    db = build_store(vectors)
+
+    print(f"{args.chunks} chunks, {args.queries} queries, k={args.k}")
+    print(f"{'mode':16} {'vector disk MB':>14} {'scanned MB':>11} {'latency ms':>11} {'recall@k':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, precision, keep_float32, rescore_factor in MODES:
+            folder = os.path.join(tmp_dir, label)
+            save_store(db, folder, precision=precision, keep_float32=keep_float32)
+            store = MappedVectorStore.load(folder, None, search_params={"rescore_factor": rescore_factor})
+
+            hits = 0
+            started_at = time.perf_counter()
+            for query, exact in zip(queries, exact_rows):
+                _, rows = store._search(query[None, :], args.k)
+                hits += len(set(rows[0].tolist()) & set(exact.tolist()))
+            latency_ms = 1000 * (time.perf_counter() - started_at) / args.queries
+
+            print(f"{label:16} {_folder_size(folder) / 2**20:14.1f} {store.memory_size() / 2**20:11.1f} "
+                  f"{latency_ms:11.2f} {hits / (args.queries * args.k):9.4f}")
+
+
+if __name__ == "__main__":
+    main()
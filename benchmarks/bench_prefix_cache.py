@@ -0,0 +1,88 @@
+"""
+Time to first token of /query prompts with and without reuse of the evaluated static prompt prefix
+(PrefixCachedCTransformers in llm_loader.py).
+
+Run from the repository root with the local model in place (the app settings are read from .env as usual):
+    python -m benchmarks.bench_prefix_cache --questions 10
+
+Every question gets a different synthetic context, built like in the app with PromptBuilder. "reuse" is
+the app's behaviour: the prefix is evaluated once at load and kept in the model context. "no reuse"
+clears the model context before every question, so the whole prompt is evaluated each time.
+"""
+import argparse
+import random
+import statistics
+import time
+import warnings
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+
+
+class _FirstTokenTimer(BaseCallbackHandler):
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+
+def make_contexts(count: int, chunk_chars: int = 500) -> list:
+    rng = random.Random(0)
+    vocabulary = ["refund", "policy", "customer", "subscription", "annual", "contract", "payment", "term",
+                  "service", "notice", "period", "cancel", "agreement", "invoice", "days", "written", "the",
+                  "of", "and", "within", "to", "a", "is", "for", "any", "shall", "be", "by", "on", "with"]
+    contexts = []
+    for _ in range(count):
+        docs = []
+        for _ in range(2):
+            words = []
+            while sum(len(word) + 1 for word in words) < chunk_chars:
+                words.append(rng.choice(vocabulary))
+            docs.append(Document(page_content=" ".join(words)[:chunk_chars]))
+        contexts.append(docs)
+    return contexts
+
+
+def time_to_first_token(llm, prompt: str, max_new_tokens: int) -> float:
+    timer = _FirstTokenTimer()
+    llm.invoke(prompt, config={"callbacks": [timer]}, max_new_tokens=max_new_tokens)
+    return timer.first_token_at - timer.started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--max-new-tokens", type=int, default=4, help="Tokens generated per question")
+    args = parser.parse_args()
+
+    from app.services.LLM_handling.llm_loader import load_llm
+    from app.services.LLM_handling.querying import build_prompt, prompt_static_prefix
+
+    llm = load_llm(local=True, static_prefix=prompt_static_prefix())
+    questions = [f"What does section {number} say about refunds?" for number in range(args.questions)]
+    prompts = [build_prompt(llm, question, docs)["prompt"]
+               for question, docs in zip(questions, make_contexts(args.questions))]
+
+    results = {}
+    for mode in ("no reuse", "reuse"):
+        if mode == "reuse":
+            llm.warm_prefix()
+        timings, prefill_tokens = [], []
+        for prompt in prompts:
+            if mode == "no reuse":
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    llm.client.reset()
+            timings.append(time_to_first_token(llm, prompt, args.max_new_tokens))
+            prefill_tokens.append(llm.last_prefill_tokens)
+        results[mode] = timings
+        print(f"{mode:<9} prefill tokens {statistics.mean(prefill_tokens):>7.1f}  "
+              f"TTFT p50 {1000 * statistics.median(timings):>8.1f} ms  max {1000 * max(timings):>8.1f} ms")
+    saved = 1 - statistics.median(results["reuse"]) / statistics.median(results["no reuse"])
+    print(f"static prefix of {len(llm.prefix_tokens)} tokens, median TTFT {100 * saved:.0f}% lower with reuse")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Prompt size and prefill time of the token-budgeted prompts (prompt_builder.py) against the prompts the
+RetrievalQA "stuff" chain used to build (the indented template with the top-k chunks pasted verbatim).
+
+Run from the repository root with the local model in place (the app settings are read from .env as usual):
+    python -m benchmarks.bench_prompt_budget --k 2 4 8 --budgets 128 256 512
+
+Chunks are synthetic 500-character chunks like the ingestion splitter makes, every `--duplicate-every`-th
+one a copy of the previous chunk (the same file uploaded twice). Prefill is the time the model takes to
+evaluate the prompt tokens before it can sample the first answer token, measured from an empty context.
+"""
+import argparse
+import random
+import statistics
+import time
+import warnings
+from langchain_core.documents import Document
+from langchain_core.prompts import PromptTemplate
+
+# set_custom_prompt() before prompts were assembled by PromptBuilder.
+LEGACY_TEMPLATE = """Use the following pieces of information to answer the user's question.
+    If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+    if the user doesn't ask for a link, return the answer from the context and the question, if you did not find the answer in the context,
+    try to answer it from your own knowledge, but make sure to mention that you are answering from your own knowledge.
+
+    Context: {context}
+    Question: {question}
+
+    If the user asks for a link, only return the link from the context, and nothing else. and the user will ask it like
+    open this or that or get me the link to this or that.
+
+    Helpful answer:
+    """
+
+QUESTION = "What does the contract say about the refund policy for annual subscriptions?"
+
+
+def make_chunks(count: int, duplicate_every: int, chunk_chars: int = 500) -> list:
+    rng = random.Random(0)
+    vocabulary = ["refund", "policy", "customer", "subscription", "annual", "contract", "payment", "term",
+                  "service", "notice", "period", "cancel", "agreement", "invoice", "days", "written", "the",
+                  "of", "and", "within", "to", "a", "is", "for", "any", "shall", "be", "by", "on", "with"]
+    chunks = []
+    for position in range(count):
+        if duplicate_every and position % duplicate_every == duplicate_every - 1 and chunks:
+            chunks.append(chunks[-1])
+            continue
+        words = []
+        while sum(len(word) + 1 for word in words) < chunk_chars:
+            words.append(rng.choice(vocabulary))
+        chunks.append(Document(page_content=" ".join(words)[:chunk_chars], metadata={"page": position}))
+    return chunks
+
+
+def prefill_seconds(client, prompt: str, runs: int) -> float:
+    """Median time to evaluate the prompt tokens from an empty context."""
+    tokens = client.tokenize(prompt)
+    timings = []
+    for _ in range(runs):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            client.reset()
+        started_at = time.perf_counter()
+        client.eval(tokens)
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 4, 8], help="Chunks retrieved per question")
+    parser.add_argument("--budgets", type=int, nargs="+", default=[128, 256, 512],
+                        help="Context token budgets (PROMPT_CONTEXT_TOKENS)")
+    parser.add_argument("--duplicate-every", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    from app.core.config import settings
+    from app.services.LLM_handling.llm_loader import load_llm
+    from app.services.LLM_handling.prompt_builder import PromptBuilder
+    from app.services.LLM_handling.querying import set_custom_prompt
+
+    llm = load_llm(local=True)
+    client = llm.client
+    legacy_prompt = PromptTemplate(template=LEGACY_TEMPLATE, input_variables=["context", "question"])
+    print(f"context length {client.context_length}, duplicate every {args.duplicate_every} chunks, "
+          f"median of {args.runs} runs")
+    print(f"{'k':>3} {'prompt':<14} {'chunks':>6} {'tokens':>7} {'prefill ms':>11} {'saved':>7}")
+    for k in args.k:
+        # The builder gets twice as many candidates as it may use, like QABot retrieves them.
+        candidates = make_chunks(2 * k, args.duplicate_every)
+        legacy = legacy_prompt.format(context="\n\n".join(doc.page_content for doc in candidates[:k]),
+                                      question=QUESTION)
+        legacy_seconds = prefill_seconds(client, legacy, args.runs)
+        print(f"{k:>3} {'stuff (old)':<14} {k:>6} {len(client.tokenize(legacy)):>7} "
+              f"{1000 * legacy_seconds:>11.1f} {'':>7}")
+        for budget in args.budgets:
+            builder = PromptBuilder(llm, set_custom_prompt(), context_tokens=budget, max_chunks=k,
+                                    duplicate_similarity=settings.PROMPT_DUPLICATE_SIMILARITY,
+                                    max_new_tokens=llm.config.get("max_new_tokens", 0))
+            built = builder.build(QUESTION, candidates)
+            seconds = prefill_seconds(client, built["prompt"], args.runs)
+            print(f"{k:>3} {f'budget {budget}':<14} {len(built['documents']):>6} {built['prompt_tokens']:>7} "
+                  f"{1000 * seconds:>11.1f} {100 * (1 - seconds / legacy_seconds):>6.0f}%")
+
+
+if __name__ == "__main__":
+    main()
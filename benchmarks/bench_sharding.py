@@ -0,0 +1,176 @@
+"""
+Per-user stores against the shared sharded stores (VECTOR_STORE_BACKEND = "sharded") with many small users:
+files on disk, memory of the query process and query latency, including store loads on cache misses.
+
+Run from the repository root (the app settings are read from .env as usual):
+    python -m benchmarks.bench_sharding --users 1000 10000 100000
+
+For every user count, per-user stores are written with random sizes (geometric, `--chunks-per-user` on
+average), then migrated into the shards with migrate_to_shards. Every layout is queried in a fresh
+interpreter through a VectorStoreCache with the configured budget, by users picked uniformly at random,
+in two passes over the same users (cold, then warm).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import psutil
+
+DIM = 384  # all-MiniLM-L6-v2
+
+
+def build_per_user_stores(folder: str, user_count: int, chunks_per_user: int, dim: int) -> list:
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+    from app.services.LLM_handling.convert_vector_stores import NoEmbeddings
+    from app.services.LLM_handling.mapped_store import save_store
+    from app.services.LLM_handling.sharded_store import per_user_store_path
+    from app.services.LLM_handling.vector_store import UserVectorStore
+
+    rng = np.random.default_rng(0)
+    users = []
+    for user_id in range(1, user_count + 1):
+        chunk_count = int(rng.geometric(1 / chunks_per_user))
+        index = faiss.IndexFlatL2(dim)
+        index.add(rng.standard_normal((chunk_count, dim), dtype=np.float32))
+        docs, index_to_docstore_id = {}, {}
+        for row in range(chunk_count):
+            doc_id = f"user-{user_id}-chunk-{row}"
+            docs[doc_id] = Document(page_content=f"text of chunk {row} of user {user_id} " * 8,
+                                    metadata={"file_name": "bench.pdf", "page": row // 4})
+            index_to_docstore_id[row] = doc_id
+        db = UserVectorStore(NoEmbeddings(), index, InMemoryDocstore(docs), index_to_docstore_id)
+        db_faiss_path = per_user_store_path(os.path.join(folder, "users", str(user_id)))
+        save_store(db, db_faiss_path)
+        users.append((user_id, db_faiss_path))
+    return users
+
+
+def migrate(users: list) -> float:
+    from collections import defaultdict
+    from app.services.LLM_handling.migrate_to_shards import migrate_shard
+    from app.services.LLM_handling.sharded_store import shard_path
+
+    users_by_shard = defaultdict(list)
+    for user_id, db_faiss_path in users:
+        users_by_shard[shard_path(user_id)].append((user_id, db_faiss_path))
+    started_at = time.perf_counter()
+    for shard_folder, shard_users in users_by_shard.items():
+        migrate_shard(shard_folder, shard_users)
+    return time.perf_counter() - started_at
+
+
+def _disk_usage(folder: str):
+    file_count, size = 0, 0
+    for root, _, names in os.walk(folder):
+        for name in names:
+            file_count += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return file_count, size
+
+
+def measure(layout: str, users_file: str, query_count: int, dim: int) -> dict:
+    """Query random users of one layout. Runs in the child interpreter."""
+    from app.core.config import settings
+    from app.services.LLM_handling.mapped_store import MappedVectorStore
+    from app.services.LLM_handling.sharded_store import VectorShard, shard_path
+    from app.services.LLM_handling.vector_store_cache import VectorStoreCache
+
+    with open(users_file) as f:
+        users = json.load(f)
+    rng = np.random.default_rng(1)
+    picked = rng.integers(0, len(users), size=query_count)
+    queries = rng.standard_normal((query_count, dim), dtype=np.float32)
+    cache = VectorStoreCache(max_bytes=settings.VECTOR_STORE_CACHE_MAX_BYTES)
+    process = psutil.Process()
+    memory_before = process.memory_info()
+
+    def _query(user_id, db_faiss_path, query):
+        if layout == "per_user":
+            store = cache.get(db_faiss_path, lambda path: MappedVectorStore.load(path, None))
+        else:
+            store = cache.get(shard_path(user_id), lambda path: VectorShard.load(path, None)).for_owner(user_id)
+        return store.similarity_search_with_score_by_vector(query.tolist(), k=4)
+
+    result = {"hits": 0}
+    for phase in ("cold", "warm"):
+        latencies = []
+        for position, query in zip(picked, queries):
+            user_id, db_faiss_path = users[position]
+            started_at = time.perf_counter()
+            try:
+                docs = _query(user_id, db_faiss_path, query)
+            except OSError as e:
+                # e.g. "Too many open files" once enough per-user stores are cached.
+                return {"error": str(e)}
+            latencies.append(time.perf_counter() - started_at)
+            result["hits"] += len(docs)
+        latencies = 1000 * np.array(latencies)
+        result[f"{phase}_p50_ms"] = round(float(np.percentile(latencies, 50)), 3)
+        result[f"{phase}_p99_ms"] = round(float(np.percentile(latencies, 99)), 3)
+    # Resident pages of the mapped store files are page cache the OS can reclaim, the heap is not.
+    memory = process.memory_info()
+    result["heap_mb"] = round(((memory.rss - memory.shared) - (memory_before.rss - memory_before.shared)) / 2 ** 20, 1)
+    result["mapped_mb"] = round((memory.shared - memory_before.shared) / 2 ** 20, 1)
+    result["open_files"] = process.num_fds() if hasattr(process, "num_fds") else len(process.open_files())
+    result["cached_stores"] = cache.stats()["entries"]
+    return result
+
+
+def _run_child(layout: str, users_file: str, query_count: int, dim: int, shards_folder: str) -> dict:
+    env = {**os.environ, "VECTOR_STORE_SHARDS_DIR": shards_folder}
+    output = subprocess.run([sys.executable, "-m", "benchmarks.bench_sharding", "--child", layout, users_file,
+                             "--queries", str(query_count), "--dim", str(dim)],
+                            check=True, capture_output=True, text=True, env=env).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunks-per-user", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=DIM)
+    parser.add_argument("--child", nargs=2, metavar=("LAYOUT", "USERS_FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child[0], args.child[1], args.queries, args.dim)))
+        return
+
+    from app.core.config import settings
+    print(f"{args.chunks_per_user} chunks per user on average, dim {args.dim}, {settings.VECTOR_STORE_SHARDS} shards, "
+          f"{args.queries} queries per pass, cache budget {settings.VECTOR_STORE_CACHE_MAX_BYTES / 2 ** 20:.0f} MB")
+    print(f"{'users':>7} {'layout':<9} {'files':>8} {'disk MB':>8} {'heap MB':>8} {'mapped MB':>9} {'fds':>6} "
+          f"{'cold p50':>9} {'cold p99':>9} {'warm p50':>9} {'warm p99':>9} {'hits':>6}")
+    for user_count in args.users:
+        with tempfile.TemporaryDirectory() as folder:
+            shards_folder = os.path.join(folder, "shards")
+            settings.VECTOR_STORE_SHARDS_DIR = shards_folder
+            users = build_per_user_stores(folder, user_count, args.chunks_per_user, args.dim)
+            users_file = os.path.join(folder, "users.json")
+            with open(users_file, "w") as f:
+                json.dump(users, f)
+            migration_seconds = migrate(users)
+
+            for layout, layout_folder in (("per_user", os.path.join(folder, "users")), ("sharded", shards_folder)):
+                file_count, size = _disk_usage(layout_folder)
+                result = _run_child(layout, users_file, args.queries, args.dim, shards_folder)
+                if "error" in result:
+                    print(f"{user_count:>7} {layout:<9} {file_count:>8} {size / 2 ** 20:>8.1f} "
+                          f"failed: {result['error']}")
+                    continue
+                print(f"{user_count:>7} {layout:<9} {file_count:>8} {size / 2 ** 20:>8.1f} {result['heap_mb']:>8.1f} "
+                      f"{result['mapped_mb']:>9.1f} {result['open_files']:>6} "
+                      f"{result['cold_p50_ms']:>9.3f} {result['cold_p99_ms']:>9.3f} "
+                      f"{result['warm_p50_ms']:>9.3f} {result['warm_p99_ms']:>9.3f} {result['hits']:>6}")
+            print(f"{user_count:>7} migration to shards took {migration_seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
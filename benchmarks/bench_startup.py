@@ -0,0 +1,86 @@
+"""
+Startup time of the API server: time until it accepts its first request (GET /health/live answers),
+and until the models are loaded (GET /health/ready answers 200).
+
+Run from the repository root with the database and the local model in place (the app settings are read
+from .env as usual):
+    python -m benchmarks.bench_startup --runs 3
+
+Every run starts `uvicorn app.main:app` in a new process, so the imports are timed too. `--stub` uses the
+stub model instead of the GGUF file (LLM_MODEL_PATH=stub), which leaves the embedding model and the
+imports as the load time.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def _get(url: str):
+    """Status code and JSON body of a GET request, None if the server doesn't accept connections yet."""
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return None
+
+
+def time_startup(port: int, env: dict, timeout: float) -> dict:
+    started_at = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+                               "--log-level", "warning"], env=env, stdout=subprocess.DEVNULL)
+    try:
+        live_seconds = ready_seconds = None
+        report = None
+        while time.perf_counter() - started_at < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"The server exited with code {server.returncode}")
+            if live_seconds is None:
+                if _get(f"http://127.0.0.1:{port}/health/live") is not None:
+                    live_seconds = time.perf_counter() - started_at
+            else:
+                status_code, report = _get(f"http://127.0.0.1:{port}/health/ready")
+                if status_code == 200 or report["status"] == "failed":
+                    ready_seconds = time.perf_counter() - started_at
+                    break
+            time.sleep(0.01)
+        if ready_seconds is None:
+            raise RuntimeError(f"The server wasn't ready after {timeout}s")
+        return {"live": live_seconds, "ready": ready_seconds, "report": report}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the models to load")
+    parser.add_argument("--stub", action="store_true", help="Use the stub model instead of the GGUF file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.stub:
+        env["LLM_MODEL_PATH"] = "stub"
+    runs = []
+    for run in range(args.runs):
+        result = time_startup(args.port, env, args.timeout)
+        components = result["report"]["components"]
+        print(f"run {run + 1}: first request accepted after {result['live']:.2f}s, ready after "
+              f"{result['ready']:.2f}s ({result['report']['status']}: embeddings "
+              f"{components['embeddings']['seconds']}s, llm {components['llm']['seconds']}s)")
+        runs.append(result)
+    print(f"median: first request accepted after {statistics.median(run['live'] for run in runs):.2f}s, "
+          f"ready after {statistics.median(run['ready'] for run in runs):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
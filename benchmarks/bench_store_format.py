@@ -0,0 +1,113 @@
+"""
+Cold-load time, memory and first-query latency of a user store in the pickled FAISS format
+(index.faiss + index.pkl) against the memory-mapped format.
+
+Run from the repository root:
+    python -m benchmarks.bench_store_format --chunks 50000
+
+Every load runs in a fresh interpreter, so the numbers include nothing cached by the Python process
+(the files themselves may still be in the OS page cache).
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import psutil
+
+DIM = 384  # all-MiniLM-L6-v2
+
+
+def build_stores(folder: str, chunk_count: int):
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from app.services.LLM_handling.mapped_store import save_store
+    from app.services.LLM_handling.vector_store import UserVectorStore
+
+    rng = np.random.default_rng(0)
+    words = "vector index chunk page refund policy invoice contract clause term payment".split()
+    index = faiss.IndexFlatL2(DIM)
+    index.add(rng.standard_normal((chunk_count, DIM), dtype=np.float32))
+    docs, index_to_docstore_id = {}, {}
+    for row in range(chunk_count):
+        doc_id = f"chunk-{row}"
+        text = " ".join(random.choice(words) for _ in range(80))
+        docs[doc_id] = Document(page_content=text, metadata={"source": "bench.pdf", "page": row // 4,
+                                                             "file_name": "bench.pdf"})
+        index_to_docstore_id[row] = doc_id
+    db = UserVectorStore(DeterministicFakeEmbedding(size=DIM), index, InMemoryDocstore(docs), index_to_docstore_id)
+
+    legacy_path = os.path.join(folder, "legacy")
+    mapped_path = os.path.join(folder, "mapped")
+    db.save_local(legacy_path)
+    save_store(db, mapped_path)
+    return legacy_path, mapped_path
+
+
+def _folder_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+def measure(store_format: str, folder: str) -> dict:
+    """Load a store and run one query. Runs in the child interpreter."""
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from app.services.LLM_handling.mapped_store import MappedVectorStore
+    from app.services.LLM_handling.vector_store import UserVectorStore
+
+    process = psutil.Process()
+    embeddings = DeterministicFakeEmbedding(size=DIM)
+    query = np.random.default_rng(1).standard_normal(DIM, dtype=np.float32).tolist()
+    rss_before = process.memory_info().rss
+
+    started_at = time.perf_counter()
+    if store_format == "legacy":
+        db = UserVectorStore.load_local(folder, embeddings, allow_dangerous_deserialization=True)
+    else:
+        db = MappedVectorStore.load(folder, embeddings)
+    load_seconds = time.perf_counter() - started_at
+    rss_loaded = process.memory_info().rss
+
+    started_at = time.perf_counter()
+    db.similarity_search_with_score_by_vector(query, k=4)
+    query_seconds = time.perf_counter() - started_at
+    memory = process.memory_info()
+
+    return {"load_seconds": load_seconds, "query_seconds": query_seconds,
+            "rss_after_load_mb": (rss_loaded - rss_before) / 2**20,
+            "rss_after_query_mb": (memory.rss - rss_before) / 2**20,
+            # File-backed pages of the mapped vectors are shared and reclaimable, unlike unpickled objects.
+            "shared_after_query_mb": memory.shared / 2**20}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--measure", nargs=2, metavar=("FORMAT", "FOLDER"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"Building a store of {args.chunks} chunks...")
+        legacy_path, mapped_path = build_stores(tmp_dir, args.chunks)
+        print(f"{'format':8} {'disk MB':>8} {'load s':>8} {'query s':>8} {'RSS load MB':>12} {'RSS query MB':>13} {'shared MB':>10}")
+        for store_format, folder in (("legacy", legacy_path), ("mapped", mapped_path)):
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_store_format",
+                                     "--measure", store_format, folder],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{store_format:8} {_folder_size(folder) / 2**20:8.1f} {result['load_seconds']:8.3f} "
+                  f"{result['query_seconds']:8.3f} {result['rss_after_load_mb']:12.1f} "
+                  f"{result['rss_after_query_mb']:13.1f} {result['shared_after_query_mb']:10.1f}")
+
+
+if __name__ == "__main__":
+    main()